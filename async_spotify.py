@@ -0,0 +1,279 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from spotipy.exceptions import SpotifyException
+
+from scheduler import READ, WRITE, scheduler
+from spotify_client import (BACKOFF_FACTOR,
+                            BACKOFF_MAX,
+                            CONNECT_TIMEOUT,
+                            MAX_RETRIES,
+                            MAX_RETRY_AFTER,
+                            POOL_MAXSIZE,
+                            READ_TIMEOUT,
+                            RETRY_STATUSES)
+
+SPOTIFY_API_PREFIX = 'https://api.spotify.com/v1/'
+
+# Spotify requests one invocation may have in flight at once, which is also the size of its client's
+# connection pool.  httpx's pool does work per connection for every request, so invocations each get a
+# small pool rather than sharing one big one.
+MAX_CONCURRENCY = 8
+
+# Clients kept open between invocations, so warm instances keep about POOL_MAXSIZE connections
+MAX_IDLE_CLIENTS = POOL_MAXSIZE // MAX_CONCURRENCY
+
+# Worker threads for what must not run on the event loop: sorts and the result cache, whose calls wait
+# on fetches running on the loop.  The fetches' own Redis calls get fetch.cache_executor() instead, so
+# they never queue behind those waits.  asyncio's default of a few threads per core would let a handful
+# of waits hold up every sort.
+BLOCKING_WORKERS = 32
+
+_loop = None
+_loop_lock = threading.Lock()
+_idle_clients = []
+_ssl_context = None
+_invocations = 0
+_in_flight = 0
+
+
+def get_loop():
+    """
+    Returns:
+        asyncio.AbstractEventLoop: This instance's event loop, started in a background thread on first
+        use.  Every async invocation runs on it, so their network waits overlap.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=BLOCKING_WORKERS,
+                                                         thread_name_prefix='async-spotify'))
+            threading.Thread(target=loop.run_forever, name='async-spotify', daemon=True).start()
+            _loop = loop
+        return _loop
+
+
+def run(coro):
+    """
+    Runs a coroutine on the instance's event loop and waits for its result from the calling thread.
+
+    Args:
+        coro (coroutine): What to run, e.g. one request's sort.
+
+    Returns:
+        The coroutine's result.
+    """
+    global _invocations
+    with _loop_lock:
+        _invocations += 1
+    return asyncio.run_coroutine_threadsafe(_counted(coro), get_loop()).result()
+
+
+async def _counted(coro):
+    global _in_flight
+    _in_flight += 1
+    try:
+        return await coro
+    finally:
+        _in_flight -= 1
+
+
+def build_client(max_connections=MAX_CONCURRENCY):
+    """
+    Returns:
+        httpx.AsyncClient: An HTTP client with its own small connection pool.
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        # Loading the CA bundle takes tens of ms, so every client shares one context
+        _ssl_context = httpx.create_ssl_context()
+    return httpx.AsyncClient(
+        verify=_ssl_context,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        # The pool is sized for one invocation, whose requests simply queue for a free connection
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=None),
+    )
+
+
+def checkout_client():
+    """
+    Returns:
+        httpx.AsyncClient: A client no other invocation is using, with its connections still open from an
+        earlier invocation when there is one.  Only call it from the instance's event loop.
+    """
+    return _idle_clients.pop() if _idle_clients else build_client()
+
+
+async def checkin_client(client):
+    """
+    Keeps a checked out client for the next invocation, or closes it when enough are kept already.
+    """
+    if len(_idle_clients) < MAX_IDLE_CLIENTS:
+        _idle_clients.append(client)
+    else:
+        await client.aclose()
+
+
+def client_stats():
+    """
+    Returns:
+        dict: Async invocations served by this instance, how many of them are running right now, the
+        number of clients kept open for the next ones and the request scheduler's stats.
+    """
+    return {'invocations': _invocations, 'in_flight': _in_flight, 'idle_clients': len(_idle_clients),
+            'scheduler': scheduler.stats()}
+
+
+def retry_delay(response, attempt):
+    """
+    Returns:
+        float: Seconds to wait before retrying a failed response: its Retry-After if it has one, otherwise
+        jittered exponential backoff like spotify_client.AdaptiveRetry.  None when the Retry-After is longer
+        than MAX_RETRY_AFTER and the error should go back to the caller instead.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            retry_after = float(retry_after)
+        except ValueError:
+            retry_after = None
+    if retry_after is not None:
+        return retry_after if retry_after <= MAX_RETRY_AFTER else None
+    return random.uniform(0, min(BACKOFF_FACTOR * 2 ** attempt, BACKOFF_MAX))
+
+
+class AsyncSpotify:
+    """
+    asyncio client for the Spotify Web API endpoints the sorter uses.
+
+    Methods mirror their Spotipy namesakes and return the same JSON, but take plain IDs rather than
+    URIs or URLs.  At most max_concurrency requests are in flight at once; the others wait their turn.
+    Every request also goes through the instance's scheduler.RequestScheduler, which it shares with the
+    sync clients.  Use it as an async context manager, so its HTTP client goes back to the instance's
+    idle clients.  Errors are raised as spotipy.SpotifyException with the response's status and headers,
+    after retrying 429s once the scheduler's pause is over, and 5xx responses to GETs and failed connects
+    with jittered backoff.
+    Every call is booked on a trace stage along with its retries and response bytes.
+    """
+
+    def __init__(self, access_token, prefix=None, max_concurrency=MAX_CONCURRENCY, trace=None, client=None):
+        """
+        Args:
+            access_token (str): The user's Spotify access token.
+            prefix (str): Optional API base URL, e.g. a fake_spotify.py server.
+            max_concurrency (int): Most requests this client has in flight at once.
+            trace (Trace): Trace to book the calls on.
+            client (httpx.AsyncClient): HTTP client to use instead of one checked out for this client.
+        """
+        self.prefix = prefix or SPOTIFY_API_PREFIX
+        self.trace = trace
+        self._headers = {'Authorization': f"Bearer {access_token}"}
+        self._owns_client = client is None
+        self._client = checkout_client() if client is None else client
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Hands the checked out HTTP client back for the next invocation.
+        """
+        if self._owns_client and self._client is not None:
+            await checkin_client(self._client)
+        self._client = None
+
+    async def current_user(self, stage='create'):
+        return await self._request('GET', 'me', stage)
+
+    async def playlist(self, playlist_id, fields=None, market=None, additional_types=('track',), stage='fetch_pages'):
+        params = {'fields': fields, 'market': market, 'additional_types': ','.join(additional_types)}
+        return await self._request('GET', f"playlists/{playlist_id}", stage, params=params)
+
+    async def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0, market=None,
+                              additional_types=('track',), stage='fetch_pages'):
+        params = {'fields': fields, 'limit': limit, 'offset': offset, 'market': market,
+                  'additional_types': ','.join(additional_types)}
+        return await self._request('GET', f"playlists/{playlist_id}/tracks", stage, params=params)
+
+    async def next(self, result, stage='fetch_pages'):
+        if result['next']:
+            return await self._request('GET', result['next'], stage)
+        return None
+
+    async def audio_features(self, tracks, stage='audio_features'):
+        result = await self._request('GET', 'audio-features', stage, params={'ids': ','.join(tracks)})
+        return result['audio_features']
+
+    async def user_playlist_create(self, user, name, public=True, collaborative=False, description='', stage='create'):
+        payload = {'name': name, 'public': public, 'collaborative': collaborative, 'description': description}
+        return await self._request('POST', f"users/{user}/playlists", stage, payload=payload)
+
+    async def playlist_add_items(self, playlist_id, items, position=None, stage='add_items'):
+        return await self._request('POST', f"playlists/{playlist_id}/tracks", stage, params={'position': position},
+                                   payload=items)
+
+    async def current_user_unfollow_playlist(self, playlist_id, stage='create'):
+        return await self._request('DELETE', f"playlists/{playlist_id}/followers", stage)
+
+    async def _request(self, method, path, stage, params=None, payload=None):
+        url = path if path.startswith('http') else self.prefix + path
+        # Leave the query of a full URL, like a page's next link, alone unless there is something to add
+        params = {name: value for name, value in (params or {}).items() if value is not None} or None
+        retries = 0
+        priority = READ if method == 'GET' else WRITE
+        # Retries keep their slot, so a rate-limited client backs off as a whole instead of piling on
+        async with self._semaphore:
+            started = time.perf_counter()
+            while True:
+                await scheduler.acquire_async(priority)
+                try:
+                    response = await self._client.request(method, url, headers=self._headers, params=params,
+                                                          json=payload)
+                except (httpx.ConnectError, httpx.ConnectTimeout):
+                    # The request never went out, so even a POST is safe to send again
+                    if retries >= MAX_RETRIES:
+                        self._book(stage, started, retries, 0)
+                        raise
+                    retries += 1
+                    await asyncio.sleep(random.uniform(0, min(BACKOFF_FACTOR * 2 ** retries, BACKOFF_MAX)))
+                    continue
+
+                status = response.status_code
+                if status == 429:
+                    # The scheduler holds every request back for the Retry-After, this one included
+                    delay = scheduler.rate_limited(response.headers.get('Retry-After'))
+                    if retries >= MAX_RETRIES or delay > MAX_RETRY_AFTER:
+                        break
+                    retries += 1
+                    print(f"Rate limited by Spotify, retrying in {delay}s (attempt {retries})")
+                    continue
+                # Like spotify_client.build_session(), only reads are resent on a 5xx; a write may have gone in
+                retryable = method == 'GET' and status in RETRY_STATUSES and retries < MAX_RETRIES
+                delay = retry_delay(response, retries) if retryable else None
+                if delay is None:
+                    break
+                retries += 1
+                await asyncio.sleep(delay)
+
+        self._book(stage, started, retries, len(response.content))
+        if status >= 400:
+            try:
+                error = response.json()['error']
+                msg, reason = error.get('message', response.text), error.get('reason')
+            except (ValueError, KeyError, TypeError, AttributeError):
+                msg, reason = response.text, None
+            raise SpotifyException(status, -1, f"{url}:\n {msg}", reason=reason, headers=dict(response.headers))
+        return response.json() if response.content else None
+
+    def _book(self, stage, started, retries, num_bytes):
+        if self.trace is not None:
+            self.trace.record_call(stage, started, time.perf_counter(), retries=retries, bytes=num_bytes)
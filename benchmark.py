@@ -0,0 +1,325 @@
+"""
+Offline benchmark of the sorting pipeline on synthetic playlists.
+
+Runs convert_tracks_dict_to_list(), shuffle_unsorted_tracks_list(), reorder_list() and max_five()
+with a fixed seed and prints time, peak memory and transition quality per playlist as JSON.
+
+    python benchmark.py                                   # all sizes and distributions
+    python benchmark.py --sizes 50 5000 --output run.json
+    python benchmark.py --baseline benchmark_baseline.json  # exits with 1 on a regression
+    python benchmark.py --save-baseline                   # refreshes benchmark_baseline.json
+    python benchmark.py --sizes 20000 50000 --workers 1 2 4  # parallel BPM ordering speed-up per core count
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from local_search import path_cost
+from partition import order_partitioned
+from scoring import camelot_cost_matrix, order_by_transition_cost, UNRELATED_KEY_COST
+from synthetic import DISTRIBUTIONS, generate_tracks_dict
+from tracks import PARALLEL_MIN_TRACKS, TrackTable
+from utils import (camelot_index,
+                   camelot_similarities,
+                   convert_tracks_dict_to_list,
+                   limit_runs,
+                   max_five,
+                   reorder_list,
+                   shuffle_unsorted_tracks_list,
+                   shuffled_indices)
+
+DEFAULT_SIZES = (50, 500, 5000, 50000)
+DEFAULT_DISTRIBUTIONS = DISTRIBUTIONS
+DEFAULT_SEED = 42
+DEFAULT_REPEATS = 5
+
+BASELINE_PATH = 'benchmark_baseline.json'
+
+# A run regresses when it is this much slower or bigger than the baseline...
+DEFAULT_TOLERANCE = 0.5
+# ...and by more than these absolute amounts, so noise on the small playlists doesn't count
+MIN_REGRESSION_MS = 5.0
+MIN_REGRESSION_KB = 64.0
+
+STAGES = ('convert', 'shuffle', 'reorder_list', 'max_five')
+
+# Most the parallel BPM ordering's mean transition cost may exceed the single-process one by.  Measured
+# on the synthetic playlists of 20,000 to 50,000 tracks it stays under 11% and is often lower, since
+# one greedy walk over the whole playlist strands more badly matched tracks at its end.
+PARALLEL_MAX_QUALITY_LOSS = 0.15
+
+
+def run_pipeline(tracks_dict, seed):
+    """
+    Runs every stage once, yielding (stage, result) as it goes so the caller can measure each one.
+    reorder_list() already ends with max_five(); the separate max_five stage measures it on its own.
+    """
+    tracks_list = convert_tracks_dict_to_list(tracks_dict)
+    yield 'convert', tracks_list
+    random.seed(seed)
+    shuffled = shuffle_unsorted_tracks_list(list(tracks_list))
+    yield 'shuffle', shuffled
+    reordered = reorder_list(shuffled, camelot_similarities)
+    yield 'reorder_list', reordered
+    yield 'max_five', max_five(reordered)
+
+
+def time_stages(tracks_dict, seed, repeats):
+    """
+    Returns:
+        tuple: (timings_ms, result) with the best time of each stage over the repeats and the final list.
+    """
+    best = {stage: float('inf') for stage in STAGES}
+    result = None
+    for _ in range(repeats):
+        # Collections triggered by earlier garbage would land on whichever stage happens to be running
+        gc.collect()
+        gc.disable()
+        try:
+            stages = run_pipeline(tracks_dict, seed)
+            while True:
+                started = time.perf_counter()
+                try:
+                    stage, result = next(stages)
+                except StopIteration:
+                    break
+                best[stage] = min(best[stage], (time.perf_counter() - started) * 1000)
+        finally:
+            gc.enable()
+
+    timings = {stage: round(ms, 2) for stage, ms in best.items()}
+    timings['total'] = round(sum(best.values()), 2)
+    return timings, result
+
+
+def measure_peak_memory(tracks_dict, seed):
+    """
+    Returns:
+        dict: Peak memory allocated by each stage on top of what was already live, in KiB.
+    """
+    peaks = {}
+    tracemalloc.start()
+    try:
+        stages = run_pipeline(tracks_dict, seed)
+        while True:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            try:
+                stage, _ = next(stages)
+            except StopIteration:
+                break
+            peaks[stage] = round((tracemalloc.get_traced_memory()[1] - before) / 1024, 1)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def score_ordering(tracks):
+    """
+    Scores how smooth a sorted playlist is.
+
+    Returns:
+        dict: mean_harmonic_cost and mean_transition_cost per transition (see scoring), the share of
+        transitions between unrelated keys, the longest run of one Camelot key and the number of tracks.
+    """
+    if not tracks:
+        return {'tracks': 0}
+    keys = [camelot_index[track['camelot']] for track in tracks]
+    bpms = [track['bpm'] for track in tracks]
+    transitions = max(len(tracks) - 1, 1)
+
+    harmonic = [float(camelot_cost_matrix[a, b]) for a, b in zip(keys, keys[1:])]
+    longest_run, run = 1, 1
+    for a, b in zip(keys, keys[1:]):
+        run = run + 1 if a == b else 1
+        longest_run = max(longest_run, run)
+
+    return {
+        'tracks': len(tracks),
+        'mean_harmonic_cost': round(sum(harmonic) / transitions, 4),
+        'mean_transition_cost': round(path_cost(keys, bpms, range(len(tracks))) / transitions, 4),
+        'unrelated_share': round(sum(cost == UNRELATED_KEY_COST for cost in harmonic) / transitions, 4),
+        'longest_run': longest_run,
+    }
+
+
+def measure_parallel(tracks_dict, seed, workers, repeats):
+    """
+    Compares the parallel BPM ordering (partition.order_partitioned()) with the single-process one.
+    Both run-limit their order, like tracks.sort_track_table() does, before being scored.
+
+    Args:
+        tracks_dict (dict): The playlist.
+        seed (int): Seed for the shuffle.
+        workers (list): Worker process counts to time the parallel ordering with.
+        repeats (int): Runs per count; the best time counts.  The first run also starts the process pool.
+
+    Returns:
+        dict: single_ms and mean_transition_cost of the single-process ordering, and per worker count
+        ms, speedup over single_ms, mean_transition_cost and quality_loss, how much higher that cost is
+        as a share of the single-process one.
+    """
+    table = TrackTable.from_tracks_dict(tracks_dict)
+    rows = shuffled_indices(len(table), random.Random(seed))
+    keys = [table.camelots[row] for row in rows]
+    bpms = [table.bpms[row] for row in rows]
+
+    def best_time(order_tracks, runs):
+        best, order = float('inf'), None
+        for _ in range(runs):
+            started = time.perf_counter()
+            order = order_tracks()
+            best = min(best, (time.perf_counter() - started) * 1000)
+        return best, order
+
+    def mean_cost(order):
+        order = [order[position] for position in limit_runs([keys[p] for p in order])]
+        return path_cost(keys, bpms, order) / max(len(order) - 1, 1)
+
+    # The single-process ordering is quadratic, so it only runs once on the biggest playlists
+    single_ms, single = best_time(lambda: order_by_transition_cost(keys, bpms), 1)
+    single_cost = mean_cost(single)
+    results = {'single_ms': round(single_ms, 1), 'mean_transition_cost': round(single_cost, 4), 'workers': {}}
+    for count in workers:
+        order_partitioned(keys, bpms, workers=count)
+        ms, order = best_time(lambda: order_partitioned(keys, bpms, workers=count), repeats)
+        cost = mean_cost(order)
+        results['workers'][str(count)] = {
+            'ms': round(ms, 1),
+            'speedup': round(single_ms / ms, 2),
+            'mean_transition_cost': round(cost, 4),
+            'quality_loss': round(cost / single_cost - 1, 4),
+        }
+    return results
+
+
+def check_parallel_quality(results, max_loss=PARALLEL_MAX_QUALITY_LOSS):
+    """
+    Returns:
+        list: One message per case whose parallel ordering loses more than max_loss of its quality.
+    """
+    failures = []
+    for name, case in results['cases'].items():
+        for count, run in case.get('parallel', {}).get('workers', {}).items():
+            if run['quality_loss'] > max_loss:
+                failures.append(f"{name} with {count} workers: quality_loss {run['quality_loss']} > {max_loss}")
+    return failures
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, distributions=DEFAULT_DISTRIBUTIONS, seed=DEFAULT_SEED,
+                  repeats=DEFAULT_REPEATS, workers=()):
+    """
+    Benchmarks the pipeline on one synthetic playlist per size and distribution.
+
+    Returns:
+        dict: The run's settings and, per case ("<distribution>-<size>"), timings_ms, peak_memory_kb
+        and quality, plus parallel (see measure_parallel()) for cases of at least
+        tracks.PARALLEL_MIN_TRACKS when worker counts are given.
+    """
+    cases = {}
+    for distribution in distributions:
+        for size in sizes:
+            tracks_dict = generate_tracks_dict(size, distribution, seed)
+            timings, result = time_stages(tracks_dict, seed, repeats)
+            cases[f"{distribution}-{size}"] = {
+                'distribution': distribution,
+                'tracks': size,
+                'timings_ms': timings,
+                'peak_memory_kb': measure_peak_memory(tracks_dict, seed),
+                'quality': score_ordering(result or []),
+            }
+            if workers and size >= PARALLEL_MIN_TRACKS:
+                cases[f"{distribution}-{size}"]['parallel'] = measure_parallel(tracks_dict, seed, workers, repeats)
+            print(f"{distribution}-{size}: {timings['total']} ms", file=sys.stderr)
+
+    return {
+        'seed': seed,
+        'repeats': repeats,
+        'python': platform.python_version(),
+        'cases': cases,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares a run with a stored one.  Timings and memory regress when they grow by more than the
+    tolerance and the minimum absolute amount; quality scores are deterministic for a given seed,
+    so any worsening counts.  Cases missing from either side are skipped.
+
+    Returns:
+        list: One message per regression; empty if there are none.
+    """
+    regressions = []
+    if baseline.get('seed') != results['seed']:
+        regressions.append(f"baseline was recorded with seed {baseline.get('seed')}, not {results['seed']}")
+        return regressions
+
+    for name, case in results['cases'].items():
+        old = baseline.get('cases', {}).get(name)
+        if old is None:
+            continue
+        for section, floor in (('timings_ms', MIN_REGRESSION_MS), ('peak_memory_kb', MIN_REGRESSION_KB)):
+            for stage, value in case[section].items():
+                before = old.get(section, {}).get(stage)
+                if before is not None and value > before * (1 + tolerance) and value - before > floor:
+                    regressions.append(f"{name} {section}.{stage}: {before} -> {value}")
+        for metric, value in case['quality'].items():
+            before = old.get('quality', {}).get(metric)
+            if before is None:
+                continue
+            worse = value < before if metric == 'tracks' else value > before + 1e-9
+            if worse:
+                regressions.append(f"{name} quality.{metric}: {before} -> {value}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the playlist sorting pipeline on synthetic playlists.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=DEFAULT_DISTRIBUTIONS)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--output', help="write the results here instead of stdout")
+    parser.add_argument('--baseline', help="compare against this earlier run and fail on regressions")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--save-baseline', action='store_true', help=f"store the results in {BASELINE_PATH}")
+    parser.add_argument('--workers', type=int, nargs='+', default=(),
+                        help=f"also time the parallel BPM ordering with these worker counts on playlists of "
+                             f"{PARALLEL_MIN_TRACKS}+ tracks, failing if it loses more than "
+                             f"{PARALLEL_MAX_QUALITY_LOSS:.0%} of the quality")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.sizes, args.distributions, args.seed, max(args.repeats, 1),
+                            [max(count, 1) for count in args.workers])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    regressions = check_parallel_quality(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions += compare_to_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    if regressions:
+        return 1
+    if args.baseline:
+        print("No regressions against the baseline", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
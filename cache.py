@@ -0,0 +1,381 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Redis connection string, e.g. redis://10.0.0.3:6379/0.  Without it only the in-process LRU is used.
+REDIS_URL = os.environ.get('REDIS_URL')
+
+# Audio features of a track don't change, so they can live for a long time
+FEATURES_TTL_SECONDS = 30 * 24 * 60 * 60
+FEATURES_KEY_PREFIX = 'bp:features:'
+
+# Number of tracks kept in memory per function instance
+LRU_MAX_SIZE = 50000
+
+# A sorted result is keyed by the source playlist's snapshot_id, so it never goes stale; the TTL only
+# keeps Redis from filling up with playlists nobody sorts anymore
+RESULT_TTL_SECONDS = 7 * 24 * 60 * 60
+RESULT_KEY_PREFIX = 'bp:result:'
+RESULT_LOCK_PREFIX = 'bp:result-lock:'
+
+# Sorted results kept in memory per function instance; each holds up to one URI per track
+RESULT_MEMORY_MAX_SIZE = 100
+
+# How long the instance computing a result holds its lock, i.e. the longest others wait for it, and how
+# often they check whether it is done
+RESULT_LOCK_SECONDS = 60
+RESULT_POLL_SECONDS = 0.2
+
+
+class FeatureCache:
+    """
+    Track ID -> audio features cache shared across function instances.
+
+    Lookups go to an in-process LRU first, so warm instances skip the network entirely, then to
+    Redis with a single MGET.  Only tracks missing from both need to be fetched from Spotify.
+    Each cached entry holds the Spotify tempo/key/mode plus the derived camelot/key_tonal.
+    """
+
+    def __init__(self, client=None, ttl=FEATURES_TTL_SECONDS, max_size=LRU_MAX_SIZE):
+        """
+        Args:
+            client (redis.Redis): Redis client to use, or None to run with the in-process LRU only.
+            ttl (int): Expiry of the Redis entries, in seconds.
+            max_size (int): Maximum number of tracks held in the in-process LRU.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def get_many(self, track_ids):
+        """
+        Looks up the audio features of several tracks.
+
+        Args:
+            track_ids (list): Spotify track IDs.
+
+        Returns:
+            dict: Track ID -> cached features, for the tracks that were found.
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for track_id in track_ids:
+                entry = self._lru.get(track_id)
+                if entry is None:
+                    missing.append(track_id)
+                else:
+                    self._lru.move_to_end(track_id)
+                    found[track_id] = entry
+            self.hits += len(found)
+
+        if missing and self.client is not None:
+            import redis
+            try:
+                values = self.client.mget([FEATURES_KEY_PREFIX + track_id for track_id in missing])
+            except redis.RedisError as e:
+                print(f"Error reading audio features from Redis: {e}")
+                values = [None] * len(missing)
+
+            from_redis = {track_id: json.loads(value) for track_id, value in zip(missing, values) if value}
+            found.update(from_redis)
+            self._remember(from_redis)
+            with self._lock:
+                self.redis_hits += len(from_redis)
+                self.misses += len(missing) - len(from_redis)
+        else:
+            with self._lock:
+                self.misses += len(missing)
+
+        return found
+
+    def set_many(self, entries):
+        """
+        Stores freshly fetched audio features in the LRU and, with one pipelined round trip, in Redis.
+
+        Args:
+            entries (dict): Track ID -> features, as returned by get_many().
+        """
+        if not entries:
+            return
+        self._remember(entries)
+
+        if self.client is not None:
+            import redis
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for track_id, entry in entries.items():
+                    pipe.set(FEATURES_KEY_PREFIX + track_id, json.dumps(entry), ex=self.ttl)
+                pipe.execute()
+            except redis.RedisError as e:
+                print(f"Error writing audio features to Redis: {e}")
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit/miss counters since this instance started.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'lru_size': len(self._lru),
+            }
+
+    def _remember(self, entries):
+        with self._lock:
+            for track_id, entry in entries.items():
+                self._lru[track_id] = entry
+                self._lru.move_to_end(track_id)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+
+class ResultCache:
+    """
+    Sorted orderings shared across requests and function instances, so a playlist many users sort at
+    the same time is fetched and sorted once.
+
+    Only seeded sorts are shared, since only they are meant to give the same order every time.  A result
+    is keyed by the source playlist, its snapshot_id and every sort option including the seed,
+    and holds the ordered track URIs plus the local search report.  get_or_compute() coalesces requests
+    for the same key: within an instance the first caller computes while the others wait for it, and
+    across instances the computing caller holds a lock in Redis that the others poll until the result
+    shows up.  Without Redis only the in-process part applies.
+    """
+
+    def __init__(self, client=None, ttl=RESULT_TTL_SECONDS, lock_seconds=RESULT_LOCK_SECONDS,
+                 poll_seconds=RESULT_POLL_SECONDS, max_size=RESULT_MEMORY_MAX_SIZE):
+        """
+        Args:
+            client (redis.Redis): Redis client to use, or None to share results within this instance only.
+            ttl (int): Expiry of the Redis entries, in seconds.
+            lock_seconds (int): Expiry of the single-flight lock, and how long others wait on it.
+            poll_seconds (float): Interval at which other instances check for the result.
+            max_size (int): Maximum number of results held in memory.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.lock_seconds = lock_seconds
+        self.poll_seconds = poll_seconds
+        self.max_size = max_size
+        self._memory = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    def key(self, playlist_id, snapshot_id, options):
+        """
+        Args:
+            playlist_id (str): ID of the source playlist.
+            snapshot_id (str): The source playlist's snapshot_id, which changes with every edit.
+            options (dict): Sort options, as returned by main.parse_sort_options().
+
+        Returns:
+            str: The cache key for the ordering these produce, or None when it mustn't be shared: without a
+            snapshot_id the version is unknown, and without a seed every sort is meant to be a fresh shuffle.
+        """
+        if not snapshot_id or options.get('seed') is None:
+            return None
+        fingerprint = json.dumps([playlist_id, snapshot_id, options], sort_keys=True)
+        return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns:
+            dict: The stored result, with uris and transition_cost, or None.
+        """
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                return result
+        if self.client is not None:
+            import redis
+            try:
+                value = self.client.get(RESULT_KEY_PREFIX + key)
+            except redis.RedisError as e:
+                print(f"Error reading a sorted result from Redis: {e}")
+                return None
+            if value:
+                result = json.loads(value)
+                self._remember(key, result)
+                return result
+        return None
+
+    def put(self, key, result):
+        """
+        Stores a result; empty orderings aren't worth sharing and are skipped.
+        """
+        if not result['uris']:
+            return
+        self._remember(key, result)
+        if self.client is not None:
+            import redis
+            try:
+                self.client.set(RESULT_KEY_PREFIX + key, json.dumps(result), ex=self.ttl)
+            except redis.RedisError as e:
+                print(f"Error writing a sorted result to Redis: {e}")
+
+    def get_or_compute(self, key, compute, trace=None):
+        """
+        Returns the stored result for key, waiting for another request that is computing it already,
+        or computes and stores it.
+
+        Args:
+            key (str): The key, as returned by key().
+            compute (callable): Returns the result when called without arguments.
+            trace (Trace): Optional trace to book the time spent waiting on, under 'result_wait'.
+
+        Returns:
+            tuple: (result, shared) where shared tells whether another request computed the result.
+        """
+        result = self.get(key)
+        if result is not None:
+            self._count(hits=1)
+            return result, True
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = {'done': threading.Event(), 'result': None}
+
+        if not leader:
+            with _stage(trace, 'result_wait'):
+                flight['done'].wait(self.lock_seconds)
+            if flight['result'] is not None:
+                self._count(coalesced=1)
+                return flight['result'], True
+            # The request computing it failed, or took too long
+            self._count(misses=1)
+            return compute(), False
+
+        try:
+            result, shared = self._lead(key, compute, trace)
+            flight['result'] = result
+            return result, shared
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight['done'].set()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit, coalesced and miss counters since this instance started.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'coalesced': self.coalesced, 'misses': self.misses,
+                    'memory_size': len(self._memory)}
+
+    def _lead(self, key, compute, trace):
+        token = self._acquire(key)
+        if token is None:
+            # Another instance is computing it
+            with _stage(trace, 'result_wait'):
+                result = self._wait(key)
+            if result is not None:
+                self._count(coalesced=1)
+                return result, True
+        self._count(misses=1)
+        try:
+            result = compute()
+            self.put(key, result)
+            return result, False
+        finally:
+            if token:
+                self._release(key, token)
+
+    def _acquire(self, key):
+        # Returns the lock's token, '' when there is no Redis to lock in, or None when someone else holds it
+        if self.client is None:
+            return ''
+        import redis
+        token = uuid.uuid4().hex
+        try:
+            acquired = self.client.set(RESULT_LOCK_PREFIX + key, token, nx=True, ex=self.lock_seconds)
+        except redis.RedisError as e:
+            print(f"Error locking a sorted result in Redis: {e}")
+            return ''
+        return token if acquired else None
+
+    def _release(self, key, token):
+        import redis
+        lock_key = RESULT_LOCK_PREFIX + key
+        try:
+            # Only delete the lock if it is still ours; it may have expired and gone to someone else
+            with self.client.pipeline() as pipe:
+                pipe.watch(lock_key)
+                value = pipe.get(lock_key)
+                if value is not None and (value.decode() if isinstance(value, bytes) else value) == token:
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+        except redis.RedisError as e:
+            print(f"Error unlocking a sorted result in Redis: {e}")
+
+    def _wait(self, key):
+        import redis
+        deadline = time.monotonic() + self.lock_seconds
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_seconds)
+            result = self.get(key)
+            if result is not None:
+                return result
+            try:
+                if not self.client.exists(RESULT_LOCK_PREFIX + key):
+                    # Released without a result, e.g. an empty playlist, or its holder died
+                    return self.get(key)
+            except redis.RedisError as e:
+                print(f"Error checking a sorted result's lock in Redis: {e}")
+                return None
+        return None
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def _count(self, **counters):
+        with self._lock:
+            for counter, value in counters.items():
+                setattr(self, counter, getattr(self, counter) + value)
+
+
+def _stage(trace, name):
+    return trace.stage(name) if trace is not None else contextlib.nullcontext()
+
+
+def get_redis_client():
+    """
+    Returns:
+        redis.Redis: A client for REDIS_URL, or None when no Redis is configured.
+    """
+    if not REDIS_URL:
+        return None
+    # Only imported when Redis is configured, so instances without it start faster
+    import redis
+    return redis.Redis.from_url(REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+
+
+# Module level so warm function instances keep their LRU between invocations
+feature_cache = FeatureCache(get_redis_client())
+result_cache = ResultCache(feature_cache.client)
@@ -0,0 +1,114 @@
+"""
+Peak memory check.
+
+Sorts synthetic playlists of a few sizes with make_playlist, each in a fresh interpreter talking to a
+fake_spotify.py server in a process of its own, and reports the peak RSS the request added on top of
+the loaded code, in total and per 1,000 tracks.  Use it to pick the function's memory tier: the
+instance needs its idle RSS plus the per-1k figure times the tracks of the biggest playlists it sorts
+at once.  Fails when a request goes over the budget.
+
+    python check_memory.py
+    python check_memory.py --sizes 1000 20000 --budget-mb 256
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+DEFAULT_SIZES = (1000, 5000, 10000)
+
+# Peak RSS one request may reach, idle interpreter included: the smallest Cloud Functions memory tier
+MEMORY_BUDGET_MB = 128
+
+# Runs in a fresh interpreter: load what a request needs, then sort one playlist and read the peak RSS.
+# ru_maxrss is in KiB on Linux.
+_PROBE = '''
+import json, resource, sys
+import flask, main, cache, fetch, spotify_client, writer
+app = flask.Flask(__name__)
+body = {'access_token': 'fake-token', 'playlist_url': 'https://open.spotify.com/playlist/' + sys.argv[1]}
+before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+with app.test_request_context(method='POST', json=body):
+    status = main.make_playlist(flask.request)[1]
+peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'status': status, 'idle_kb': before_kb, 'peak_kb': peak_kb}))
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fake_spotify():
+    """
+    Starts fake_spotify.py in its own process, so the playlists it serves don't count towards the peak.
+
+    Returns:
+        tuple: (process, prefix) where prefix is the API base URL to point SPOTIFY_API_PREFIX at.
+    """
+    port = free_port()
+    here = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable, os.path.join(here, 'fake_spotify.py'), '--port', str(port)],
+                               stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, f"http://127.0.0.1:{port}/v1/"
+
+
+def measure(sizes, prefix):
+    """
+    Returns:
+        dict: Per size, the request's status, the idle and peak RSS in MiB and the peak it added per
+        1,000 tracks in KiB.
+    """
+    env = dict(os.environ, SPOTIFY_API_PREFIX=prefix)
+    results = {}
+    for size in sizes:
+        output = subprocess.run([sys.executable, '-c', _PROBE, f"realistic{size}"], capture_output=True,
+                                text=True, check=True, env=env).stdout
+        probe = json.loads(output.strip().splitlines()[-1])
+        results[str(size)] = {
+            'status': probe['status'],
+            'idle_rss_mb': round(probe['idle_kb'] / 1024, 1),
+            'peak_rss_mb': round(probe['peak_kb'] / 1024, 1),
+            'peak_kb_per_1k_tracks': round((probe['peak_kb'] - probe['idle_kb']) / (size / 1000), 1),
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure make_playlist's peak RSS per 1,000 tracks.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--budget-mb', type=float, default=MEMORY_BUDGET_MB)
+    args = parser.parse_args(argv)
+
+    process, prefix = start_fake_spotify()
+    try:
+        results = measure(args.sizes, prefix)
+    finally:
+        process.terminate()
+        process.wait()
+
+    problems = []
+    for size, result in results.items():
+        if result['status'] != 200:
+            problems.append(f"sorting {size} tracks answered {result['status']}")
+        if result['peak_rss_mb'] > args.budget_mb:
+            problems.append(f"sorting {size} tracks peaked at {result['peak_rss_mb']} MiB, over {args.budget_mb:g} MiB")
+
+    print(json.dumps({'sizes': results, 'budget_mb': args.budget_mb, 'problems': problems}, indent=2))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Cold start check.
+
+Times `import main` in fresh interpreters, the way a new Cloud Functions instance loads it, and fails
+when the median goes over the budget, when an OPTIONS preflight pulls in Spotipy, requests, httpx,
+Redis or NumPy, or when the precomputed Camelot tables in utils no longer match the tables they come from.
+
+    python check_startup.py
+    python check_startup.py --runs 9 --budget-ms 40
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Median time `import main` may take once functions_framework is loaded, which the runtime does anyway
+IMPORT_BUDGET_MS = 50
+DEFAULT_RUNS = 5
+
+# Modules only the POST path may load
+HEAVY_MODULES = ('spotipy', 'requests', 'urllib3', 'redis', 'numpy', 'httpx')
+
+# Runs in a fresh interpreter: import main, answer a preflight, then load what the first POST needs
+_PROBE = '''
+import json, sys, time
+import functions_framework, flask
+started = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - started) * 1000
+
+with flask.Flask(__name__).test_request_context(method='OPTIONS'):
+    status = main.make_playlist(flask.request)[1]
+loaded = [name for name in %r if name in sys.modules]
+
+started = time.perf_counter()
+import cache, fetch, spotify_client, writer
+pipeline_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({'import_ms': import_ms, 'preflight_status': status, 'preflight_modules': loaded,
+                  'pipeline_import_ms': pipeline_ms}))
+''' % (HEAVY_MODULES,)
+
+
+def check_tables():
+    """
+    Returns:
+        list: What is wrong with the precomputed Camelot tables; empty if they match.
+    """
+    from utils import (camelot_by_pitch,
+                       camelot_codes,
+                       camelot_index,
+                       camelot_index_tables,
+                       camelot_neighbour_ranks,
+                       camelot_similarities,
+                       cw_map_string)
+
+    problems = []
+    codes, code_index, neighbour_ranks = camelot_index_tables(camelot_similarities)
+    if tuple(codes) != camelot_codes or code_index != camelot_index:
+        problems.append("camelot_codes doesn't follow camelot_similarities")
+    if neighbour_ranks != camelot_neighbour_ranks:
+        problems.append("camelot_neighbour_ranks doesn't match camelot_similarities")
+    if any(camelot_by_pitch[pcn * 2 + mode] != code_index[code] for (pcn, mode), code in cw_map_string.items()):
+        problems.append("camelot_by_pitch doesn't match cw_map_string")
+    return problems
+
+
+def measure(runs):
+    """
+    Returns:
+        list: One probe result per fresh interpreter.
+    """
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _PROBE], capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check cold start import time against a budget.")
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    problems = check_tables()
+    results = measure(max(args.runs, 1))
+    import_ms = statistics.median(result['import_ms'] for result in results)
+    pipeline_ms = statistics.median(result['pipeline_import_ms'] for result in results)
+    loaded = sorted({name for result in results for name in result['preflight_modules']})
+
+    if import_ms > args.budget_ms:
+        problems.append(f"import main took {import_ms:.1f} ms, over the {args.budget_ms:g} ms budget")
+    if loaded:
+        problems.append(f"an OPTIONS preflight loaded {', '.join(loaded)}")
+    if any(result['preflight_status'] != 204 for result in results):
+        problems.append("the OPTIONS preflight didn't answer 204")
+
+    print(json.dumps({
+        'import_main_ms': round(import_ms, 1),
+        'budget_ms': args.budget_ms,
+        'first_request_imports_ms': round(pipeline_ms, 1),
+        'runs': len(results),
+        'problems': problems,
+    }, indent=2))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,506 @@
+"""
+Local stand-in for the parts of the Spotify Web API that make_playlist uses, for load and end-to-end
+testing without touching real accounts.
+
+Playlist IDs name the synthetic playlist to serve, see synthetic.generate_tracks_dict():
+"realistic2000" is 2000 tracks with the realistic key distribution and "skewed500s7" is 500 tracks of
+the skewed one, generated with seed 7.  Any access token is accepted.  Tracks come as full Spotify
+track objects, album and market lists included, unless the request's fields filter leaves parts out.
+
+    python fake_spotify.py --port 8081 --latency-ms 40 --rate-limit 50
+    SPOTIFY_API_PREFIX=http://127.0.0.1:8081/v1/ functions-framework --target make_playlist
+"""
+import argparse
+import json
+import random
+import re
+import string
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from synthetic import DISTRIBUTIONS, generate_tracks_dict
+
+PAGE_SIZE = 100
+FEATURES_BATCH_SIZE = 100
+
+FAKE_USER_ID = 'fakeuser'
+
+# Spotify lists every market a track and its album can be played in, about 185 of them, and sends both
+# lists with every track object unless a fields filter leaves them out
+NUM_MARKETS = 185
+MARKETS = [a + b for a in string.ascii_uppercase for b in string.ascii_uppercase][:NUM_MARKETS]
+
+_PLAYLIST_ID = re.compile(rf"^({'|'.join(DISTRIBUTIONS)})(\d+)(?:s(\d+))?$")
+
+
+@lru_cache(maxsize=64)
+def synthetic_playlist(playlist_id):
+    """
+    Returns:
+        list: The (track_id, track) pairs of the synthetic playlist a playlist ID names, or None.
+    """
+    match = _PLAYLIST_ID.match(playlist_id)
+    if match is None:
+        return None
+    distribution, size, seed = match.group(1), int(match.group(2)), int(match.group(3) or 0)
+    return list(generate_tracks_dict(size, distribution, seed).items())
+
+
+def parse_fields(fields):
+    """
+    Parses a Spotify fields filter, e.g. "total,items(track(id,artists(name)))".
+
+    Returns:
+        dict: Field name -> nested filter of the same form, or None to keep the whole field.
+    """
+    def parse(position):
+        spec, name = {}, ''
+        while position < len(fields):
+            char = fields[position]
+            position += 1
+            if char == '(':
+                spec[name.strip()], position = parse(position)
+                name = None
+            elif char in ',)':
+                if name and name.strip():
+                    spec[name.strip()] = None
+                name = ''
+                if char == ')':
+                    return spec, position
+            elif name is not None:
+                name += char
+        if name and name.strip():
+            spec[name.strip()] = None
+        return spec, position
+    return parse(0)[0]
+
+
+def project(value, spec):
+    """
+    Returns:
+        The parts of a JSON value a parsed fields filter asks for; filters apply to every item of a list.
+    """
+    if spec is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, spec) for item in value]
+    if isinstance(value, dict):
+        return {name: project(value[name], sub) for name, sub in spec.items() if name in value}
+    return value
+
+
+def track_object(track_id, track):
+    """
+    Returns:
+        dict: A full Spotify track object for a synthetic track, album, images and markets included.
+    """
+    album_id = track_id[::-1]
+    artist = {
+        'external_urls': {'spotify': f"https://open.spotify.com/artist/{album_id}"},
+        'href': f"https://api.spotify.com/v1/artists/{album_id}",
+        'id': album_id,
+        'name': track['artist'],
+        'type': 'artist',
+        'uri': f"spotify:artist:{album_id}",
+    }
+    return {
+        'album': {
+            'album_type': 'album',
+            'artists': [artist],
+            'available_markets': MARKETS,
+            'external_urls': {'spotify': f"https://open.spotify.com/album/{album_id}"},
+            'href': f"https://api.spotify.com/v1/albums/{album_id}",
+            'id': album_id,
+            'images': [{'height': size, 'width': size, 'url': f"https://i.scdn.co/image/{album_id}{size}"}
+                       for size in (640, 300, 64)],
+            'name': f"Album of {track['name']}",
+            'release_date': '2023-01-01',
+            'release_date_precision': 'day',
+            'total_tracks': 12,
+            'type': 'album',
+            'uri': f"spotify:album:{album_id}",
+        },
+        'artists': [artist],
+        'available_markets': MARKETS,
+        'disc_number': 1,
+        'duration_ms': 200000,
+        'episode': False,
+        'explicit': False,
+        'external_ids': {'isrc': f"USRC1{track_id[:7].upper()}"},
+        'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"},
+        'href': f"https://api.spotify.com/v1/tracks/{track_id}",
+        'id': track_id,
+        'is_local': False,
+        'name': track['name'],
+        'popularity': 50,
+        'preview_url': f"https://p.scdn.co/mp3-preview/{track_id}",
+        'track': True,
+        'track_number': 1,
+        'type': 'track',
+        'uri': track['uri'],
+    }
+
+
+class FakeSpotifyServer:
+    """
+    Serves deterministic playlists, audio features, playlist creation and add-items from a local
+    HTTP server, with optional latency, rate limiting and error injection.
+
+    Point a Spotipy client at it with sp.prefix = server.prefix, or set SPOTIFY_API_PREFIX for main.py.
+    Playlists created through it are kept in server.created, so callers can check what was written, and
+    set_playlist() serves a playlist of your own that can be changed between requests.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, jitter_ms=0, rate_limit=None, retry_after=1,
+                 error_rate=0.0, seed=0):
+        """
+        Args:
+            host (str): Interface to listen on.
+            port (int): Port to listen on; 0 picks a free one.
+            latency_ms (float): Delay added to every response.
+            jitter_ms (float): Random extra delay of up to this much.
+            rate_limit (float): Requests per second accepted before answering 429, or None for no limit.
+                Short bursts of up to one second's worth are allowed, like a token bucket.
+            retry_after (int): Retry-After seconds sent with a 429.
+            error_rate (float): Share of requests that fail with a 503.
+            seed (int): Seed for the jitter and error injection.
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.created = {}
+        self.counts = {}
+        # Every track of the playlists served so far, so audio-features can answer for them
+        self.tracks = {}
+        self.playlists = {}
+        self._random = random.Random(seed)
+        self._tokens = rate_limit or 0
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+
+        self._httpd = ThreadingHTTPServer((host, port), _handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def prefix(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Requests served per endpoint and outcome, e.g. {'audio_features 200': 40, 'add_items 429': 2}.
+        """
+        with self._lock:
+            return dict(sorted(self.counts.items()))
+
+    def admit(self):
+        """
+        Decides how a request is answered before it is handled: sleeps for the configured latency and
+        returns 429 or 503 when the request is rate limited or picked for an injected error.
+
+        Returns:
+            int: The status to fail the request with, or None to serve it.
+        """
+        with self._lock:
+            delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+            status = None
+            if self.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                if self._tokens < 1:
+                    status = 429
+                else:
+                    self._tokens -= 1
+            if status is None and self._random.random() < self.error_rate:
+                status = 503
+        if delay:
+            time.sleep(delay / 1000)
+        return status
+
+    def count(self, endpoint, status):
+        with self._lock:
+            name = f"{endpoint} {status}"
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def set_playlist(self, playlist_id, tracks):
+        """
+        Serves (or replaces) a playlist with the given tracks; its snapshot_id changes every time.
+
+        Args:
+            playlist_id (str): Base-62 playlist ID.
+            tracks (dict): Track ID -> track, as made by synthetic.generate_tracks_dict().
+        """
+        with self._lock:
+            version = self.playlists.get(playlist_id, {}).get('version', 0) + 1
+            self.playlists[playlist_id] = {'tracks': list(tracks.items()), 'version': version}
+            self.tracks.update(tracks)
+
+    def page(self, playlist_id, tracks, offset, limit):
+        items = [
+            {
+                'added_at': '2023-01-01T00:00:00Z',
+                'added_by': {'id': FAKE_USER_ID, 'type': 'user', 'uri': f"spotify:user:{FAKE_USER_ID}"},
+                'is_local': False,
+                'primary_color': None,
+                'track': track_object(track_id, track),
+                'video_thumbnail': {'url': None},
+            }
+            for track_id, track in tracks[offset:offset + limit]
+        ]
+        href = f"{self.prefix}playlists/{playlist_id}/tracks?offset={offset}&limit={limit}"
+        following = offset + limit
+        return {
+            'href': href,
+            'items': items,
+            'limit': limit,
+            'offset': offset,
+            'total': len(tracks),
+            'next': f"{self.prefix}playlists/{playlist_id}/tracks?offset={following}&limit={limit}"
+            if following < len(tracks) else None,
+            'previous': None,
+        }
+
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.route('GET')
+
+        def do_POST(self):
+            self.route('POST')
+
+        def do_PUT(self):
+            self.route('PUT')
+
+        def do_DELETE(self):
+            self.route('DELETE')
+
+        def route(self, method):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = [part for part in url.path.split('/') if part][1:]
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'null') if length else None
+
+            if method == 'GET' and parts == ['me']:
+                endpoint, handle = 'current_user', lambda: (200, {'id': FAKE_USER_ID, 'display_name': 'Fake User'})
+            elif method == 'GET' and parts == ['audio-features']:
+                endpoint, handle = 'audio_features', lambda: self.audio_features(query)
+            elif method == 'GET' and len(parts) == 2 and parts[0] == 'playlists':
+                endpoint, handle = 'playlist', lambda: self.playlist(parts[1], query)
+            elif method == 'GET' and len(parts) == 3 and parts[0] == 'playlists' and parts[2] == 'tracks':
+                endpoint, handle = 'playlist_tracks', lambda: self.playlist_tracks(parts[1], query)
+            elif method == 'POST' and len(parts) == 3 and parts[0] == 'users' and parts[2] == 'playlists':
+                endpoint, handle = 'user_playlist_create', lambda: self.create_playlist(body)
+            elif method == 'POST' and len(parts) == 3 and parts[0] == 'playlists' and parts[2] == 'tracks':
+                endpoint, handle = 'add_items', lambda: self.add_items(parts[1], query, body)
+            elif method == 'PUT' and len(parts) == 3 and parts[0] == 'playlists' and parts[2] == 'tracks':
+                endpoint, handle = 'replace_or_reorder_items', lambda: self.replace_or_reorder_items(parts[1], body)
+            elif method == 'DELETE' and len(parts) == 3 and parts[0] == 'playlists' and parts[2] == 'tracks':
+                endpoint, handle = 'remove_items', lambda: self.remove_items(parts[1], body)
+            elif method == 'DELETE' and len(parts) == 3 and parts[0] == 'playlists' and parts[2] == 'followers':
+                endpoint, handle = 'unfollow', lambda: (200, None)
+            else:
+                endpoint, handle = 'unknown', lambda: (404, self.error(404, "Service not found"))
+
+            status = server.admit()
+            if status == 429:
+                payload, headers = self.error(429, "API rate limit exceeded"), {'Retry-After': str(server.retry_after)}
+            elif status is not None:
+                payload, headers = self.error(status, "Service unavailable"), {}
+            else:
+                status, payload = handle()
+                headers = {}
+            server.count(endpoint, status)
+            self.reply(status, payload, headers)
+
+        def reply(self, status, payload, headers):
+            data = b'' if payload is None else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def error(self, status, message):
+            return {'error': {'status': status, 'message': message}}
+
+        def audio_features(self, query):
+            ids = query.get('ids', [''])[0].split(',')
+            if len(ids) > FEATURES_BATCH_SIZE:
+                return 400, self.error(400, "Too many ids requested")
+            features = []
+            for track_id in ids:
+                track = server.tracks.get(track_id)
+                features.append(None if track is None else {
+                    'id': track_id,
+                    'type': 'audio_features',
+                    'uri': track['uri'],
+                    'tempo': track['bpm'],
+                    'key': track['key'],
+                    'mode': track['mode'],
+                })
+            return 200, {'audio_features': features}
+
+        def playlist(self, playlist_id, query):
+            tracks = self.tracks_of(playlist_id)
+            if tracks is None:
+                return 404, self.error(404, "Not found.")
+            return 200, self.filtered(query, {
+                'id': playlist_id,
+                'name': f"Synthetic {playlist_id}",
+                'description': "Generated by fake_spotify.py",
+                'snapshot_id': self.snapshot_of(playlist_id),
+                'tracks': server.page(playlist_id, tracks, 0, PAGE_SIZE),
+            })
+
+        def playlist_tracks(self, playlist_id, query):
+            tracks = self.tracks_of(playlist_id)
+            if tracks is None:
+                return 404, self.error(404, "Not found.")
+            offset = int(query.get('offset', ['0'])[0])
+            limit = min(int(query.get('limit', [str(PAGE_SIZE)])[0]), PAGE_SIZE)
+            return 200, self.filtered(query, server.page(playlist_id, tracks, offset, limit))
+
+        def filtered(self, query, payload):
+            fields = query.get('fields', [''])[0]
+            return project(payload, parse_fields(fields)) if fields else payload
+
+        def create_playlist(self, body):
+            with server._lock:
+                playlist_id = f"created{len(server.created) + 1}"
+                server.created[playlist_id] = {'name': body.get('name'), 'uris': [], 'version': 0}
+            return 201, {'id': playlist_id, 'name': body.get('name'), 'snapshot_id': f"{playlist_id}-0"}
+
+        def add_items(self, playlist_id, query, body):
+            playlist = server.created.get(playlist_id)
+            if playlist is None:
+                return 404, self.error(404, "Not found.")
+            uris = body.get('uris', []) if isinstance(body, dict) else body or []
+            if len(uris) > PAGE_SIZE:
+                return 400, self.error(400, "Too many tracks requested")
+            with server._lock:
+                position = int(query.get('position', [len(playlist['uris'])])[0])
+                if position > len(playlist['uris']):
+                    return 400, self.error(400, "Index out of bounds")
+                playlist['uris'][position:position] = uris
+                playlist['version'] += 1
+            return 201, {'snapshot_id': self.snapshot_of(playlist_id)}
+
+        def replace_or_reorder_items(self, playlist_id, body):
+            playlist = server.created.get(playlist_id)
+            if playlist is None:
+                return 404, self.error(404, "Not found.")
+            with server._lock:
+                uris = playlist['uris']
+                if 'uris' in body:
+                    if len(body['uris']) > PAGE_SIZE:
+                        return 400, self.error(400, "Too many tracks requested")
+                    uris[:] = body['uris']
+                else:
+                    start, length = body['range_start'], body.get('range_length', 1)
+                    insert_before = body['insert_before']
+                    if start + length > len(uris) or insert_before > len(uris):
+                        return 400, self.error(400, "Index out of bounds")
+                    block = uris[start:start + length]
+                    del uris[start:start + length]
+                    destination = insert_before if insert_before < start else insert_before - length
+                    uris[destination:destination] = block
+                playlist['version'] += 1
+            return 200, {'snapshot_id': self.snapshot_of(playlist_id)}
+
+        def remove_items(self, playlist_id, body):
+            playlist = server.created.get(playlist_id)
+            if playlist is None:
+                return 404, self.error(404, "Not found.")
+            removed = {track['uri'] for track in body.get('tracks', [])}
+            if len(removed) > PAGE_SIZE:
+                return 400, self.error(400, "Too many tracks requested")
+            with server._lock:
+                playlist['uris'][:] = [uri for uri in playlist['uris'] if uri not in removed]
+                playlist['version'] += 1
+            return 200, {'snapshot_id': self.snapshot_of(playlist_id)}
+
+        def tracks_of(self, playlist_id):
+            """
+            Returns:
+                list: (track_id, track) pairs of a playlist: one set with set_playlist(), one created
+                through the API or a synthetic one; None if there is no such playlist.
+            """
+            with server._lock:
+                if playlist_id in server.playlists:
+                    return server.playlists[playlist_id]['tracks']
+                if playlist_id in server.created:
+                    track_ids = [uri.rsplit(':', 1)[-1] for uri in server.created[playlist_id]['uris']]
+                    return [(track_id, server.tracks[track_id]) for track_id in track_ids]
+            tracks = synthetic_playlist(playlist_id)
+            if tracks is not None:
+                with server._lock:
+                    server.tracks.update(tracks)
+            return tracks
+
+        def snapshot_of(self, playlist_id):
+            with server._lock:
+                playlist = server.playlists.get(playlist_id) or server.created.get(playlist_id)
+                version = playlist['version'] if playlist else 'snapshot'
+            return f"{playlist_id}-{version}"
+
+    return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local fake of the Spotify Web API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, help="requests per second before answering 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = FakeSpotifyServer(args.host, args.port, args.latency_ms, args.jitter_ms, args.rate_limit,
+                               args.retry_after, args.error_rate, args.seed)
+    print(f"Fake Spotify API listening, set SPOTIFY_API_PREFIX={server.prefix}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
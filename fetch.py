@@ -0,0 +1,379 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cache import feature_cache
+from tracing import Trace
+from tracks import TrackTable
+from utils import pitch_to_camelot
+
+# Spotify caps both playlist item pages and audio-feature lookups at 100 per request
+PAGE_SIZE = 100
+FEATURES_BATCH_SIZE = 100
+
+# Bounded worker pool shared by the page and audio-feature requests of one playlist
+MAX_WORKERS = 8
+
+# Spotify's fields filters for the playlist object and its items pages.  Only what build_track_table() and
+# the sorted copy need is asked for, so every track comes without its album, images, available_markets
+# and the rest, which otherwise make up nearly all of a page
+PAGE_FIELDS = 'total,items(track(id,name,uri,artists(name)))'
+PLAYLIST_FIELDS = f"name,description,snapshot_id,tracks({PAGE_FIELDS})"
+
+# Key Spotify reports for tracks it couldn't detect a key in
+NO_KEY = -1
+
+# Worker threads for the async fetch's Redis reads and writes.  They are kept apart from the event loop's
+# default executor, whose threads may all be waiting on a fetch, see main.sort_playlist_async()
+CACHE_WORKERS = 8
+
+_cache_executor = None
+_cache_executor_lock = threading.Lock()
+
+def fetch_audio_features(sp, track_ids, cache=None, trace=None):
+    """
+    Fetches the audio features of up to FEATURES_BATCH_SIZE tracks, asking Spotify only for the ones
+    missing from the cache.
+
+    Args:
+        sp (spotipy.Spotify): An authenticated Spotipy client.
+        track_ids (list): Spotify track IDs.
+        cache (FeatureCache): Optional feature cache to read from and fill.
+        trace (Trace): Optional trace to book the Spotify calls on, under 'audio_features'.
+
+    Returns:
+        dict: Track ID -> {'bpm', 'key', 'mode', 'camelot', 'key_tonal'} for every track Spotify knows.
+    """
+    features = cache.get_many(track_ids) if cache is not None else {}
+    missing = [track_id for track_id in track_ids if track_id not in features]
+    if trace is not None:
+        trace.add('audio_features', tracks=len(track_ids), cache_hits=len(features))
+    if not missing:
+        return features
+
+    audio_features = sp.audio_features if trace is None else trace.timed('audio_features', sp.audio_features)
+    fetched = {
+        track_meta_obj['id']: audio_features_entry(track_meta_obj)
+        for track_meta_obj in audio_features(missing) if has_audio_features(track_meta_obj)
+    }
+
+    if cache is not None:
+        cache.set_many(fetched)
+    features.update(fetched)
+    return features
+
+
+def cache_executor():
+    """
+    Returns:
+        ThreadPoolExecutor: The instance's pool for blocking feature cache calls made from the event loop.
+    """
+    global _cache_executor
+    with _cache_executor_lock:
+        if _cache_executor is None:
+            _cache_executor = ThreadPoolExecutor(max_workers=CACHE_WORKERS, thread_name_prefix='feature-cache')
+        return _cache_executor
+
+
+def has_audio_features(track_meta_obj):
+    """
+    Returns:
+        bool: Whether a Spotify audio features object can be sorted on.  Spotify returns null for tracks
+        it hasn't analysed and NO_KEY for ones without a detectable key, and both are skipped like
+        tracks that are missing from the response.
+    """
+    return bool(track_meta_obj) and track_meta_obj['key'] != NO_KEY
+
+
+def audio_features_entry(track_meta_obj):
+    """
+    Returns:
+        dict: The parts of a Spotify audio features object the sorter uses, plus the Camelot code and
+        tonal name pitch_to_camelot() derives from them.
+    """
+    camelot, key_tonal = pitch_to_camelot(track_meta_obj['key'], track_meta_obj['mode'])
+    return {
+        'bpm': track_meta_obj['tempo'],
+        'key': track_meta_obj['key'],
+        'mode': track_meta_obj['mode'],
+        'camelot': camelot,
+        'key_tonal': key_tonal,
+    }
+
+
+def build_track_table(pages, features, trace):
+    """
+    Fills a track table from a playlist's pages, keeping the playlist order.  Duplicates, local files
+    and tracks without audio features are skipped.
+
+    Args:
+        pages (dict): Offset -> playlist items page, as returned by project_page().
+        features (dict): Track ID -> audio features, as returned by fetch_audio_features().
+        trace (Trace): Trace to book the convert stage on.
+
+    Returns:
+        TrackTable: The playlist's tracks.
+    """
+    table = TrackTable()
+    with trace.stage('convert'):
+        for offset in sorted(pages):
+            for track_id, name, artist, uri in pages[offset]['tracks']:
+                if track_id in table:
+                    continue
+                track_features = features.get(track_id)
+                if track_features is None:
+                    print(f"No audio features for track {track_id}, skipping it")
+                    continue
+
+                table.append(track_id, name, artist, uri,
+                             track_features['bpm'], track_features['key'], track_features['mode'])
+        trace.add('convert', tracks=len(table))
+    return table
+
+
+def project_page(page):
+    """
+    Boils a playlist items page down to what build_track_table() reads, as soon as it arrives, so the
+    decoded response can be freed while the rest of the playlist is still being fetched.
+
+    Returns:
+        dict: total, the playlist's track count, and tracks, an (id, name, first artist, uri) tuple per
+        track on the page.  Local files, which have no ID, and items that aren't tracks are left out.
+    """
+    return {
+        'total': page['total'],
+        'tracks': [
+            (track['id'], track['name'], track['artists'][0]['name'], track['uri'])
+            for track in (track_obj.get('track') for track_obj in page['items'])
+            if track and track.get('id')
+        ],
+    }
+
+
+def page_track_ids(page):
+    """
+    Returns:
+        list: IDs of the tracks on a page from project_page(), without duplicates.
+    """
+    return list(dict.fromkeys(track[0] for track in page['tracks']))
+
+
+class TrackFetcher:
+    """
+    Fetches playlists' tracks and audio features over one bounded worker pool.
+
+    For each playlist the playlist object is read first: it carries the name, description and first
+    page of tracks, which tells us the playlist's total.  The remaining pages are then requested in
+    parallel at offsets of PAGE_SIZE, and each page's audio features are requested as soon as that
+    page arrives instead of waiting for the whole playlist.  Several playlists can be fetched at once
+    from different threads; a track that appears in more than one of them has its audio features
+    requested only once.  Point sp.prefix at a local server to run this against a fake Spotify API.
+    """
+
+    def __init__(self, sp, max_workers=MAX_WORKERS, cache=feature_cache, trace=None):
+        """
+        Args:
+            sp (spotipy.Spotify): An authenticated Spotipy client.
+            max_workers (int): Size of the worker pool used for the concurrent requests.
+            cache (FeatureCache): Feature cache consulted before asking Spotify, or None to always fetch.
+            trace (Trace): Trace to book the fetch_pages, audio_features and convert stages on.
+        """
+        self.sp = sp
+        self.cache = cache
+        self.trace = trace or Trace('fetch')
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._feature_futures = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def fetch_playlist(self, playlist_id):
+        """
+        Returns:
+            dict: The playlist object, with its name, description, snapshot_id and first page of tracks.
+        """
+        playlist = self.trace.timed('fetch_pages', self.sp.playlist)
+        return playlist(playlist_id, fields=PLAYLIST_FIELDS, additional_types=('track',))
+
+    def fetch(self, playlist_id, on_playlist=None, playlist=None):
+        """
+        Fetches every track of a playlist along with its audio features.
+
+        Args:
+            playlist_id (str): The ID of the playlist.
+            on_playlist (callable): Called with the playlist object as soon as it arrives, e.g. to start
+                creating the sorted copy while the audio features are still being fetched.
+            playlist (dict): The playlist object, if fetch_playlist() already read it.
+
+        Returns:
+            TrackTable: The playlist's tracks, in playlist order.
+        """
+        trace = self.trace
+        pages = {}
+
+        if playlist is None:
+            playlist = self.fetch_playlist(playlist_id)
+        if on_playlist is not None:
+            on_playlist(playlist)
+
+        first_page = pages[0] = project_page(playlist['tracks'])
+        feature_futures = self._request_features(first_page)
+
+        playlist_tracks = trace.timed('fetch_pages', self.sp.playlist_tracks)
+        page_futures = {
+            self._executor.submit(playlist_tracks, playlist_id, fields=PAGE_FIELDS, limit=PAGE_SIZE,
+                                  offset=offset): offset
+            for offset in range(PAGE_SIZE, first_page['total'], PAGE_SIZE)
+        }
+        for future in as_completed(page_futures):
+            page = pages[page_futures[future]] = project_page(future.result())
+            feature_futures.update(self._request_features(page))
+
+        features = {}
+        for future in feature_futures:
+            features.update(future.result())
+
+        return build_track_table(pages, features, trace)
+
+    def _request_features(self, page):
+        page_ids = page_track_ids(page)
+        submitted = []
+        with self._lock:
+            ids = [track_id for track_id in page_ids if track_id not in self._feature_futures]
+            for i in range(0, len(ids), FEATURES_BATCH_SIZE):
+                batch = ids[i:i+FEATURES_BATCH_SIZE]
+                future = self._executor.submit(fetch_audio_features, self.sp, batch, self.cache, self.trace)
+                for track_id in batch:
+                    self._feature_futures[track_id] = future
+                submitted.append((future, batch))
+            # The batches holding this page's tracks, including ones another page or playlist asked for
+            futures = {self._feature_futures[track_id] for track_id in page_ids}
+        # Outside the lock: a batch that is done already runs its callback right here
+        for future, batch in submitted:
+            future.add_done_callback(lambda future, batch=batch: self._forget_failed(future, batch))
+        return futures
+
+    def _forget_failed(self, future, batch):
+        # A failed batch stays with the callers already waiting on it, but later ones ask Spotify again
+        if future.cancelled() or future.exception() is not None:
+            with self._lock:
+                for track_id in batch:
+                    if self._feature_futures.get(track_id) is future:
+                        del self._feature_futures[track_id]
+
+
+def fetch_playlist_tracks(sp, playlist_id, max_workers=MAX_WORKERS, cache=feature_cache, on_playlist=None):
+    """
+    Fetches every track of a single playlist along with its audio features, see TrackFetcher.
+
+    Args:
+        sp (spotipy.Spotify): An authenticated Spotipy client.
+        playlist_id (str): The ID of the playlist.
+        max_workers (int): Size of the worker pool used for the concurrent requests.
+        cache (FeatureCache): Feature cache consulted before asking Spotify, or None to always fetch.
+        on_playlist (callable): Called with the playlist object as soon as it arrives.
+
+    Returns:
+        TrackTable: The playlist's tracks, in playlist order.
+    """
+    with TrackFetcher(sp, max_workers, cache) as fetcher:
+        return fetcher.fetch(playlist_id, on_playlist)
+
+
+async def fetch_audio_features_async(sp, track_ids, cache=None, trace=None):
+    """
+    Async version of fetch_audio_features() for an async_spotify.AsyncSpotify client.  A cache backed
+    by Redis is read and written on cache_executor() so the event loop never blocks on it.
+
+    Returns:
+        dict: Track ID -> {'bpm', 'key', 'mode', 'camelot', 'key_tonal'} for every track Spotify knows.
+    """
+    loop = asyncio.get_running_loop()
+    blocking = cache is not None and cache.client is not None
+    if cache is None:
+        features = {}
+    elif blocking:
+        features = await loop.run_in_executor(cache_executor(), cache.get_many, track_ids)
+    else:
+        features = cache.get_many(track_ids)
+    missing = [track_id for track_id in track_ids if track_id not in features]
+    if trace is not None:
+        trace.add('audio_features', tracks=len(track_ids), cache_hits=len(features))
+    if not missing:
+        return features
+
+    fetched = {
+        track_meta_obj['id']: audio_features_entry(track_meta_obj)
+        for track_meta_obj in await sp.audio_features(missing) if has_audio_features(track_meta_obj)
+    }
+
+    if blocking:
+        await loop.run_in_executor(cache_executor(), cache.set_many, fetched)
+    elif cache is not None:
+        cache.set_many(fetched)
+    features.update(fetched)
+    return features
+
+
+async def fetch_playlist_tracks_async(sp, playlist_id, cache=feature_cache, trace=None, on_playlist=None, playlist=None):
+    """
+    Fetches every track of a playlist along with its audio features on the running event loop, the
+    way TrackFetcher does with threads: the remaining pages are requested together once the playlist
+    object tells the total, and each page's audio features as soon as that page arrives.  How many
+    requests run at once is up to the client.
+
+    Args:
+        sp (AsyncSpotify): An authenticated async client.
+        playlist_id (str): The ID of the playlist.
+        cache (FeatureCache): Feature cache consulted before asking Spotify, or None to always fetch.
+        trace (Trace): Trace to book the fetch_pages, audio_features and convert stages on.
+        on_playlist (callable): Called with the playlist object as soon as it arrives.
+        playlist (dict): The playlist object, if the caller already read it.
+
+    Returns:
+        TrackTable: The playlist's tracks, in playlist order.
+    """
+    trace = trace or Trace('fetch')
+    pages = {}
+    feature_tasks = {}
+
+    def request_features(page):
+        ids = [track_id for track_id in page_track_ids(page) if track_id not in feature_tasks]
+        for i in range(0, len(ids), FEATURES_BATCH_SIZE):
+            batch = ids[i:i+FEATURES_BATCH_SIZE]
+            task = asyncio.ensure_future(fetch_audio_features_async(sp, batch, cache, trace))
+            for track_id in batch:
+                feature_tasks[track_id] = task
+
+    async def fetch_page(offset):
+        pages[offset] = project_page(await sp.playlist_tracks(playlist_id, fields=PAGE_FIELDS, limit=PAGE_SIZE,
+                                                              offset=offset))
+        request_features(pages[offset])
+
+    if playlist is None:
+        playlist = await sp.playlist(playlist_id, fields=PLAYLIST_FIELDS, additional_types=('track',))
+    if on_playlist is not None:
+        on_playlist(playlist)
+
+    pages[0] = project_page(playlist['tracks'])
+    request_features(pages[0])
+    page_tasks = [asyncio.ensure_future(fetch_page(offset)) for offset in range(PAGE_SIZE, pages[0]['total'], PAGE_SIZE)]
+    try:
+        await asyncio.gather(*page_tasks)
+        features = {}
+        for batch_features in await asyncio.gather(*set(feature_tasks.values())):
+            features.update(batch_features)
+    except BaseException:
+        # Don't leave requests running for a playlist that failed
+        for task in page_tasks + list(feature_tasks.values()):
+            task.cancel()
+        raise
+
+    return build_track_table(pages, features, trace)
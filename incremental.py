@@ -0,0 +1,380 @@
+import json
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+import numpy as np
+from spotipy.exceptions import SpotifyException
+
+from cache import feature_cache
+from scoring import (camelot_cost_matrix,
+                     fold_octaves,
+                     log_tempos,
+                     resolve_weights,
+                     TEMPO_PERCENT_PER_OCTAVE)
+from tracing import Trace
+from tracks import ORDERING_BPM
+from utils import limit_runs
+
+# Where the last ordering of each (user, source playlist) lives in Redis, and for how long
+ORDERING_KEY_PREFIX = 'bp:ordering:'
+ORDERING_TTL_SECONDS = 90 * 24 * 60 * 60
+
+# Orderings kept in memory per function instance, for when Redis isn't configured or can't be reached
+MEMORY_MAX_SIZE = 1000
+
+# Above this share of added plus removed tracks, a full re-sort gives a better playlist than patching
+MAX_CHANGE_SHARE = 0.5
+
+# Spotify takes at most 100 tracks per add, remove or replace call
+ITEMS_BATCH_SIZE = 100
+
+# A rewrite sends every track again and resets their added dates, so patching is preferred until it
+# takes this many times as many calls
+REWRITE_CALL_WEIGHT = 2
+
+
+class OrderingStore:
+    """
+    Remembers the last sorted version of each playlist a user sorted incrementally: the source
+    playlist's snapshot_id, the sorted playlist's id and snapshot_id, the track ids in sorted order
+    and the options used.  Records go to Redis when it is configured, with an in-process copy in front
+    like cache.FeatureCache.
+    """
+
+    def __init__(self, client=None, ttl=ORDERING_TTL_SECONDS, max_size=MEMORY_MAX_SIZE):
+        """
+        Args:
+            client (redis.Redis): Redis client to use, or None to keep records in this instance only.
+            ttl (int): Expiry of the Redis entries, in seconds.
+            max_size (int): Maximum number of records held in memory.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.max_size = max_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user, playlist_id):
+        """
+        Returns:
+            dict: The last record stored for the user's playlist, or None.
+        """
+        key = f"{ORDERING_KEY_PREFIX}{user}:{playlist_id}"
+        if self.client is not None:
+            import redis
+            try:
+                value = self.client.get(key)
+                if value:
+                    return json.loads(value)
+            except redis.RedisError as e:
+                print(f"Error reading the last ordering from Redis: {e}")
+        with self._lock:
+            return self._memory.get(key)
+
+    def put(self, user, playlist_id, record):
+        """
+        Stores a record, as built by ordering_record().
+        """
+        key = f"{ORDERING_KEY_PREFIX}{user}:{playlist_id}"
+        with self._lock:
+            self._memory[key] = record
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+        if self.client is not None:
+            import redis
+            try:
+                self.client.set(key, json.dumps(record), ex=self.ttl)
+            except redis.RedisError as e:
+                print(f"Error writing the last ordering to Redis: {e}")
+
+
+def comparable_options(options):
+    """
+    Returns:
+        dict: The sort options that decide what an ordering looks like; a stored ordering is only
+        reused when these are unchanged.
+    """
+    return {
+        'ordering': options.get('ordering'),
+        'weights': options.get('weights'),
+        'max_run': options.get('max_run'),
+    }
+
+
+def ordering_record(options, source_snapshot_id, playlist_id, snapshot_id, track_ids):
+    """
+    Builds the record OrderingStore keeps for a sorted playlist.
+
+    Args:
+        options (dict): Sort options, as returned by main.parse_sort_options().
+        source_snapshot_id (str): snapshot_id of the source playlist that was sorted.
+        playlist_id (str): ID of the sorted playlist.
+        snapshot_id (str): snapshot_id of the sorted playlist after the last write.
+        track_ids (list): Track IDs in the sorted playlist, in order.
+    """
+    return {
+        'options': comparable_options(options),
+        'source_snapshot_id': source_snapshot_id,
+        'playlist_id': playlist_id,
+        'snapshot_id': snapshot_id,
+        'track_ids': list(track_ids),
+    }
+
+
+def insert_new_tracks(table, rows, new_rows, weights):
+    """
+    Inserts tracks one at a time into the gap where they add the least transition cost, see
+    scoring.transition_costs().  The first track stays first.
+
+    Args:
+        table (TrackTable): The playlist's tracks.
+        rows (list): Rows of the already ordered tracks, in play order.
+        new_rows (list): Rows to insert.
+        weights (dict): Complete harmonic/tempo weights.
+
+    Returns:
+        list: Rows in the new play order.
+    """
+    order = list(rows)
+    if not order and new_rows:
+        order, new_rows = [new_rows[0]], new_rows[1:]
+    if not new_rows:
+        return order
+
+    harmonic = weights['harmonic'] * camelot_cost_matrix
+    tempo_scale = weights['tempo'] * TEMPO_PERCENT_PER_OCTAVE
+
+    def costs(from_keys, from_log_bpms, to_keys, to_log_bpms):
+        return harmonic[from_keys, to_keys] + tempo_scale * fold_octaves(to_log_bpms - from_log_bpms)
+
+    keys = np.asarray([table.camelots[row] for row in order], dtype=np.intp)
+    log_bpms = log_tempos([table.bpms[row] for row in order])
+    new_log_bpms = log_tempos([table.bpms[row] for row in new_rows])
+    # forward[i] is the cost of playing order[i] then order[i+1]
+    forward = costs(keys[:-1], log_bpms[:-1], keys[1:], log_bpms[1:])
+
+    for new_row, new_log_bpm in zip(new_rows, new_log_bpms):
+        new_key = table.camelots[new_row]
+        into = costs(keys, log_bpms, new_key, new_log_bpm)
+        out_of = costs(new_key, new_log_bpm, keys[1:], log_bpms[1:])
+        # Gap g sits after order[g]; the last gap appends to the end
+        added = np.concatenate((into[:-1] + out_of - forward, into[-1:]))
+        gap = int(np.argmin(added))
+
+        order.insert(gap + 1, new_row)
+        keys = np.insert(keys, gap + 1, new_key)
+        log_bpms = np.insert(log_bpms, gap + 1, new_log_bpm)
+        if gap < len(forward):
+            forward = np.concatenate((forward[:gap], [into[gap], out_of[gap]], forward[gap + 1:]))
+        else:
+            forward = np.append(forward, into[gap])
+    return order
+
+
+def _kept_in_place(ranks):
+    """
+    Returns:
+        set: Positions of one longest increasing run of ranks (not necessarily contiguous), i.e. the
+        tracks that can stay where they are while the others move around them.
+    """
+    tails, tail_positions, previous = [], [], [None] * len(ranks)
+    for position, rank in enumerate(ranks):
+        i = bisect_left(tails, rank)
+        if i == len(tails):
+            tails.append(rank)
+            tail_positions.append(position)
+        else:
+            tails[i] = rank
+            tail_positions[i] = position
+        previous[position] = tail_positions[i - 1] if i else None
+
+    kept = set()
+    position = tail_positions[-1] if tail_positions else None
+    while position is not None:
+        kept.add(position)
+        position = previous[position]
+    return kept
+
+
+def plan_updates(current, target):
+    """
+    Plans the Spotify calls that turn one playlist into another: removals first, then moves of the
+    tracks that are out of order, then additions at their final positions.  Tracks that already are
+    in the right relative order never move, and neighbouring tracks are moved or added together.
+
+    Args:
+        current (list): Track IDs in the playlist now, without duplicates.
+        target (list): Track IDs the playlist should end up with, without duplicates.
+
+    Returns:
+        list: Operations in the order to apply them: ('remove', ids), ('move', range_start,
+        range_length, insert_before) with positions as Spotify's reorder endpoint reads them, and
+        ('add', position, ids).
+    """
+    target_ids = set(target)
+    current_ids = set(current)
+    ops = []
+
+    removed = [track_id for track_id in current if track_id not in target_ids]
+    for i in range(0, len(removed), ITEMS_BATCH_SIZE):
+        ops.append(('remove', removed[i:i + ITEMS_BATCH_SIZE]))
+
+    state = [track_id for track_id in current if track_id in target_ids]
+    wanted = [track_id for track_id in target if track_id in current_ids]
+    rank = {track_id: i for i, track_id in enumerate(wanted)}
+    kept = {state[position] for position in _kept_in_place([rank[track_id] for track_id in state])}
+
+    i = 0
+    while i < len(wanted):
+        track_id = wanted[i]
+        if track_id in kept:
+            i += 1
+            continue
+        # Take along the following tracks that also need to move and already sit right behind it
+        start = state.index(track_id)
+        length = 1
+        while (i + length < len(wanted) and wanted[i + length] not in kept
+               and start + length < len(state) and state[start + length] == wanted[i + length]):
+            length += 1
+        insert_before = state.index(wanted[i - 1]) + 1 if i else 0
+        if insert_before != start:
+            ops.append(('move', start, length, insert_before))
+            block = state[start:start + length]
+            del state[start:start + length]
+            destination = insert_before if insert_before < start else insert_before - length
+            state[destination:destination] = block
+        i += length
+
+    i = 0
+    while i < len(target):
+        if target[i] in current_ids:
+            i += 1
+            continue
+        end = i
+        while end < len(target) and end - i < ITEMS_BATCH_SIZE and target[end] not in current_ids:
+            end += 1
+        ops.append(('add', i, target[i:end]))
+        i = end
+    return ops
+
+
+def rewrite_ops(target):
+    """
+    Returns:
+        list: The operations replacing a playlist's whole content, for when patching takes more calls.
+    """
+    ops = [('replace', target[:ITEMS_BATCH_SIZE])]
+    for i in range(ITEMS_BATCH_SIZE, len(target), ITEMS_BATCH_SIZE):
+        ops.append(('add', i, target[i:i + ITEMS_BATCH_SIZE]))
+    return ops
+
+
+def apply_updates(sp, playlist_id, ops, snapshot_id, trace):
+    """
+    Applies planned operations to a playlist, each against the snapshot the previous one produced.
+
+    Returns:
+        str: The playlist's snapshot_id after the last operation.
+    """
+    remove_items = trace.timed('update_items', sp.playlist_remove_all_occurrences_of_items)
+    reorder_items = trace.timed('update_items', sp.playlist_reorder_items)
+    replace_items = trace.timed('update_items', sp.playlist_replace_items)
+    add_items = trace.timed('update_items', sp.playlist_add_items)
+    for op in ops:
+        if op[0] == 'remove':
+            result = remove_items(playlist_id, op[1], snapshot_id=snapshot_id)
+        elif op[0] == 'move':
+            _, range_start, range_length, insert_before = op
+            result = reorder_items(playlist_id, range_start, insert_before, range_length=range_length,
+                                   snapshot_id=snapshot_id)
+        elif op[0] == 'replace':
+            result = replace_items(playlist_id, op[1])
+        else:
+            result = add_items(playlist_id, op[2], position=op[1])
+        snapshot_id = result['snapshot_id']
+    return snapshot_id
+
+
+def resort_playlist(sp, fetcher, playlist_id, options, user, store=None, trace=None):
+    """
+    Re-sorts a playlist the user sorted incrementally before, by patching the previous result: tracks
+    removed from the source are removed, new ones are inserted where they fit best, and the sorted
+    playlist is updated in place with as few calls as possible.
+
+    Args:
+        sp (spotipy.Spotify): An authenticated Spotipy client.
+        fetcher (TrackFetcher): Fetcher to read the playlist's tracks with.
+        playlist_id (str): ID of the source playlist.
+        options (dict): Sorting options, as returned by main.parse_sort_options().
+        user (str): ID of the current user.
+        store (OrderingStore): Where the previous orderings live; ordering_store by default.
+        trace (Trace): Trace to book the Spotify calls on.
+
+    Returns:
+        tuple: (response_dict, status code), or None when there is nothing to patch (no previous
+        ordering, different options, the sorted playlist was deleted or edited, or too much changed)
+        and the playlist has to be sorted from scratch.
+    """
+    store = store or ordering_store
+    trace = trace or Trace('resort')
+    record = store.get(user, playlist_id)
+    if record is None or record['options'] != comparable_options(options):
+        return None
+
+    playlist_snapshot = trace.timed('fetch_pages', sp.playlist)
+    try:
+        sorted_snapshot = playlist_snapshot(record['playlist_id'], fields='snapshot_id')
+    except SpotifyException as e:
+        if e.http_status == 404:
+            return None
+        raise
+    if sorted_snapshot['snapshot_id'] != record['snapshot_id']:
+        print("The sorted playlist was changed since it was written, sorting from scratch")
+        return None
+
+    source_snapshot = playlist_snapshot(playlist_id, fields='snapshot_id')['snapshot_id']
+    if source_snapshot == record['source_snapshot_id']:
+        return response(record['playlist_id'], added=0, removed=0, calls=0)
+
+    table = fetcher.fetch(playlist_id)
+    previous = record['track_ids']
+    previous_ids = set(previous)
+    kept_rows = [table.row_of(track_id) for track_id in previous if track_id in table]
+    new_rows = [row for row, track_id in enumerate(table.ids) if track_id not in previous_ids]
+    removed = len(previous) - len(kept_rows)
+    if not len(table) or len(new_rows) + removed > MAX_CHANGE_SHARE * max(len(previous), 1):
+        return None
+
+    if options.get('ordering') == ORDERING_BPM:
+        weights = resolve_weights(options.get('weights'))
+    else:
+        # The Camelot ordering only looks at keys
+        weights = {'harmonic': 1.0, 'tempo': 0.0}
+    with trace.stage('reorder', len(table)):
+        rows = insert_new_tracks(table, kept_rows, new_rows, weights)
+    with trace.stage('max_five', len(table)):
+        rows = [rows[position] for position in limit_runs([table.camelots[row] for row in rows], options['max_run'])]
+    target = [table.ids[row] for row in rows]
+
+    ops = plan_updates(previous, target)
+    if len(ops) > REWRITE_CALL_WEIGHT * len(rewrite_ops(target)):
+        ops = rewrite_ops(target)
+    snapshot_id = apply_updates(sp, record['playlist_id'], ops, record['snapshot_id'], trace)
+
+    store.put(user, playlist_id, ordering_record(options, source_snapshot, record['playlist_id'], snapshot_id, target))
+    return response(record['playlist_id'], added=len(new_rows), removed=removed, calls=len(ops))
+
+
+def response(playlist_id, **changes):
+    print(f"Updated sorted playlist https://open.spotify.com/playlist/{playlist_id} in place: {changes}")
+    return ({
+        "message": "Success",
+        "sorted_playlist": f"spotify://playlist/{playlist_id}",
+        "incremental": changes,
+    }, 200)
+
+
+# Module level, sharing the feature cache's Redis connection
+ordering_store = OrderingStore(feature_cache.client)
@@ -0,0 +1,644 @@
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cache import feature_cache, result_cache
+from fetch import (build_track_table,
+                   fetch_audio_features,
+                   FEATURES_BATCH_SIZE,
+                   MAX_WORKERS,
+                   page_track_ids,
+                   PAGE_FIELDS,
+                   PAGE_SIZE,
+                   PLAYLIST_FIELDS,
+                   project_page)
+from spotify_client import spotify_client
+from tracing import Trace
+from tracks import sort_result
+from writer import ADD_ITEMS_BATCH_SIZE, add_batch, create_sorted_playlist, remove_playlist
+
+# Where jobs live in Redis, and for how long after their last checkpoint
+JOB_KEY_PREFIX = 'bp:job:'
+JOB_LEASE_PREFIX = 'bp:job-lease:'
+JOB_TOKEN_PREFIX = 'bp:job-token:'
+JOB_TTL_SECONDS = 24 * 60 * 60
+
+# Spotify access tokens last an hour, so a job keeps its copy of the user's token no longer than that
+TOKEN_TTL_SECONDS = 60 * 60
+
+# A running job's lease is renewed every LEASE_RENEW_SECONDS from a background thread, so long stages
+# don't lose it; a job whose lease ran out is taken to have died with its instance, and the next status
+# poll resumes it
+LEASE_SECONDS = 60
+LEASE_RENEW_SECONDS = LEASE_SECONDS / 3
+
+# Jobs one instance runs at the same time; more wait in line
+MAX_RUNNING_JOBS = 2
+
+# Jobs kept in memory per function instance, for when Redis isn't configured or can't be reached
+MEMORY_MAX_SIZE = 100
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Share of the progress percentage each stage takes, in the order they run
+STAGE_PROGRESS = (
+    ('fetch_pages', 30),
+    ('audio_features', 30),
+    ('sort', 5),
+    ('create', 5),
+    ('add_items', 30),
+)
+
+_executor = ThreadPoolExecutor(max_workers=MAX_RUNNING_JOBS)
+# Jobs queued or running on this instance, so status polls don't queue them again
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
+
+class LeaseLost(Exception):
+    """
+    Raised in a job run once another runner holds the job's lease, so the run stops without touching it.
+    """
+
+
+class JobStore:
+    """
+    Keeps background jobs and their checkpoints: the job's state (status, stage, progress and options)
+    plus every fetched page, audio feature batch, the sorted result and the number of tracks written.
+    With Redis each job is one hash that expires JOB_TTL_SECONDS after its last checkpoint, and a lease
+    key holding the runner's token tells which instance is working on it.  The user's access token is
+    kept apart for TOKEN_TTL_SECONDS at most, so another instance can pick the job up.  Without Redis,
+    or for a job whose checkpoint couldn't be written to it, jobs live in this instance only; such a job
+    is written back to Redis in full by its next checkpoint or read once Redis can be reached again.
+    """
+
+    def __init__(self, client=None, ttl=JOB_TTL_SECONDS, lease_seconds=LEASE_SECONDS, max_size=MEMORY_MAX_SIZE):
+        """
+        Args:
+            client (redis.Redis): Redis client to use, or None to keep jobs in this instance only.
+            ttl (int): Expiry of a job's Redis hash, in seconds.
+            lease_seconds (int): How long a job is left alone after its runner last renewed the lease.
+            max_size (int): Maximum number of jobs held in memory.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self.max_size = max_size
+        self._jobs = {}
+        self._leases = {}
+        self._tokens = {}
+        self._lock = threading.Lock()
+        # Held while a job moves between memory and Redis, so an older copy can't overwrite a newer checkpoint
+        self._write_lock = threading.Lock()
+
+    def create(self, job_id, state, access_token):
+        """
+        Stores a new job along with the access token to run it with.
+        """
+        self.checkpoint(job_id, state)
+        if self.client is not None:
+            import redis
+            try:
+                self.client.set(JOB_TOKEN_PREFIX + job_id, access_token, ex=TOKEN_TTL_SECONDS)
+                return
+            except redis.RedisError as e:
+                print(f"Error storing the access token of job {job_id} in Redis: {e}")
+        with self._lock:
+            self._tokens[job_id] = (access_token, time.monotonic() + TOKEN_TTL_SECONDS)
+
+    def state(self, job_id):
+        """
+        Returns:
+            dict: The job's state, or None for an unknown or expired job, or when Redis can't be reached.
+        """
+        job = self._memory_job(job_id)
+        if job is not None or self.client is None:
+            return job['state'] if job else None
+        import redis
+        try:
+            value = self.client.hget(JOB_KEY_PREFIX + job_id, 'state')
+        except redis.RedisError as e:
+            print(f"Error reading job {job_id} from Redis: {e}")
+            return None
+        return json.loads(value) if value else None
+
+    def load(self, job_id):
+        """
+        Returns:
+            tuple: (state, data) where data maps checkpoint names, e.g. 'page:200', to their contents.
+        """
+        job = self._memory_job(job_id)
+        if job is not None or self.client is None:
+            return (job['state'], job['data']) if job else (None, {})
+        import redis
+        try:
+            fields = self.client.hgetall(JOB_KEY_PREFIX + job_id)
+        except redis.RedisError as e:
+            print(f"Error reading job {job_id} from Redis: {e}")
+            return None, {}
+        values = {_text(name): json.loads(value) for name, value in fields.items()}
+        return values.pop('state', None), values
+
+    def checkpoint(self, job_id, state, data=None):
+        """
+        Saves progress.  When Redis can't take it, the job carries on from this instance's memory until a
+        later checkpoint or read gets it back into Redis.
+
+        Args:
+            job_id (str): The job.
+            state (dict): The job's complete state.
+            data (dict): New checkpoints to add, e.g. {'page:200': page}.
+        """
+        data = data or {}
+        if self.client is not None:
+            import redis
+            with self._write_lock:
+                # Checkpoints kept in memory while Redis was down go along, so Redis has all of the progress again
+                with self._lock:
+                    pending = self._jobs.pop(job_id, None)
+                if pending is not None:
+                    data = {**pending['data'], **data}
+                try:
+                    self._write(job_id, state, data)
+                    return
+                except redis.RedisError as e:
+                    print(f"Error checkpointing job {job_id} to Redis, keeping it in memory: {e}")
+                self._remember(job_id, state, data)
+        else:
+            self._remember(job_id, state, data)
+
+    def access_token(self, job_id):
+        """
+        Returns:
+            str: The access token to run the job with, or None once it has expired or been dropped.
+        """
+        with self._lock:
+            token, expires = self._tokens.get(job_id, (None, 0))
+            if token is not None and expires > time.monotonic():
+                return token
+        if self.client is None:
+            return None
+        import redis
+        try:
+            value = self.client.get(JOB_TOKEN_PREFIX + job_id)
+        except redis.RedisError as e:
+            print(f"Error reading the access token of job {job_id} from Redis: {e}")
+            return None
+        return _text(value) if value else None
+
+    def drop_access_token(self, job_id):
+        """
+        Forgets the job's access token, once the job is done or failed.
+        """
+        with self._lock:
+            self._tokens.pop(job_id, None)
+        if self.client is not None:
+            import redis
+            try:
+                self.client.delete(JOB_TOKEN_PREFIX + job_id)
+            except redis.RedisError as e:
+                print(f"Error removing the access token of job {job_id} from Redis: {e}")
+
+    def acquire(self, job_id):
+        """
+        Returns:
+            str: The lease's token if this runner got the job, i.e. nobody else is running it, '' when
+            Redis can't be reached to lock it in, or None when someone else holds it.
+        """
+        token = uuid.uuid4().hex
+        if self.client is None:
+            with self._lock:
+                if self._leases.get(job_id, ('', 0))[1] > time.monotonic():
+                    return None
+                self._leases[job_id] = (token, time.monotonic() + self.lease_seconds)
+                return token
+        import redis
+        try:
+            acquired = self.client.set(JOB_LEASE_PREFIX + job_id, token, nx=True, ex=self.lease_seconds)
+        except redis.RedisError as e:
+            print(f"Error leasing job {job_id} in Redis: {e}")
+            return ''
+        return token if acquired else None
+
+    def renew(self, job_id, token):
+        """
+        Extends the lease by lease_seconds, unless it has gone to another runner.
+
+        Returns:
+            bool: Whether the lease is still this runner's.
+        """
+        if self.client is None:
+            with self._lock:
+                held = self._leases.get(job_id, ('', 0))
+                if held[0] != token and held[1] > time.monotonic():
+                    return False
+                self._leases[job_id] = (token, time.monotonic() + self.lease_seconds)
+                return True
+        if not token:
+            return True
+        import redis
+        lease_key = JOB_LEASE_PREFIX + job_id
+        try:
+            with self.client.pipeline() as pipe:
+                pipe.watch(lease_key)
+                value = pipe.get(lease_key)
+                if value is not None and _text(value) != token:
+                    pipe.unwatch()
+                    return False
+                # Also takes the lease back if it ran out without anyone else picking the job up
+                pipe.multi()
+                pipe.set(lease_key, token, ex=self.lease_seconds)
+                pipe.execute()
+                return True
+        except redis.WatchError:
+            # Someone else took the lease in the meantime
+            return False
+        except redis.RedisError as e:
+            print(f"Error renewing the lease on job {job_id} in Redis: {e}")
+            return True
+
+    def release(self, job_id, token):
+        """
+        Gives up the lease, if it is still this runner's.
+        """
+        if self.client is None:
+            with self._lock:
+                if self._leases.get(job_id, ('', 0))[0] == token:
+                    del self._leases[job_id]
+            return
+        if not token:
+            return
+        import redis
+        lease_key = JOB_LEASE_PREFIX + job_id
+        try:
+            with self.client.pipeline() as pipe:
+                pipe.watch(lease_key)
+                value = pipe.get(lease_key)
+                if value is not None and _text(value) == token:
+                    pipe.multi()
+                    pipe.delete(lease_key)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+        except redis.RedisError as e:
+            print(f"Error releasing the lease on job {job_id} in Redis: {e}")
+
+    def leased(self, job_id):
+        """
+        Returns:
+            bool: Whether some instance is working on the job right now.  True when Redis can't tell, so
+            a poll doesn't start a second runner.
+        """
+        if self.client is None:
+            with self._lock:
+                return self._leases.get(job_id, ('', 0))[1] > time.monotonic()
+        import redis
+        try:
+            return bool(self.client.exists(JOB_LEASE_PREFIX + job_id))
+        except redis.RedisError as e:
+            print(f"Error checking the lease on job {job_id} in Redis: {e}")
+            return True
+
+    def _memory_job(self, job_id):
+        # Returns a copy of the job if it lives in this instance only.  A job checkpointed in memory during a
+        # Redis outage is moved back to Redis first, if it can be reached again, so reads never fall back
+        # to the older copy there
+        if self.client is not None:
+            with self._lock:
+                pending = job_id in self._jobs
+            if pending:
+                self._flush(job_id)
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return {'state': dict(job['state']), 'data': dict(job['data'])} if job else None
+
+    def _flush(self, job_id):
+        import redis
+        with self._write_lock:
+            with self._lock:
+                job = self._jobs.pop(job_id, None)
+            if job is None:
+                return
+            try:
+                self._write(job_id, job['state'], job['data'])
+            except redis.RedisError as e:
+                print(f"Error moving job {job_id} back to Redis, keeping it in memory: {e}")
+                self._remember(job_id, job['state'], job['data'])
+
+    def _remember(self, job_id, state, data):
+        with self._lock:
+            job = self._jobs.setdefault(job_id, {'state': {}, 'data': {}})
+            job['state'] = dict(state)
+            job['data'].update(data)
+            while len(self._jobs) > self.max_size:
+                self._jobs.pop(next(iter(self._jobs)))
+
+    def _write(self, job_id, state, data):
+        key = JOB_KEY_PREFIX + job_id
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(key, mapping={'state': json.dumps(state),
+                                **{name: json.dumps(value) for name, value in data.items()}})
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+
+class Lease:
+    """
+    A runner's hold on a job, renewed every LEASE_RENEW_SECONDS from a background thread while the job
+    runs, however long a single stage takes.  check() raises LeaseLost once a renewal found the lease
+    taken over by another runner.
+    """
+
+    def __init__(self, store, job_id, token, interval=LEASE_RENEW_SECONDS):
+        self.store = store
+        self.job_id = job_id
+        self.token = token
+        self.interval = min(interval, store.lease_seconds / 3)
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+        self.store.release(self.job_id, self.token)
+
+    def check(self):
+        if self.lost:
+            raise LeaseLost(f"Job {self.job_id} is being run by another instance")
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self.interval):
+            if not self.store.renew(self.job_id, self.token):
+                self.lost = True
+                return
+
+
+def progress(stage, done=0, total=1):
+    """
+    Returns:
+        int: Overall percentage once done out of total steps of the stage are finished.
+    """
+    before = 0
+    for name, share in STAGE_PROGRESS:
+        if name == stage:
+            return min(int(before + share * done / max(total, 1)), 99)
+        before += share
+    return 100
+
+
+class JobRun:
+    """
+    One attempt at running a job.  Every stage starts from the job's checkpoints, so an attempt that
+    picks up after a dead instance only fetches the pages and audio feature batches still missing,
+    reuses the sorted result and new playlist, and continues adding tracks where the new playlist ends.
+    """
+
+    def __init__(self, store, job_id, sp, trace, lease=None):
+        """
+        Args:
+            store (JobStore): Where the job and its checkpoints are kept.
+            job_id (str): The job.
+            sp (spotipy.Spotify): An authenticated Spotipy client for the job's user.
+            trace (Trace): Trace to book the stages on.
+            lease (Lease): The runner's lease on the job; the run stops at its next checkpoint once it's lost.
+        """
+        self.store = store
+        self.job_id = job_id
+        self.sp = sp
+        self.trace = trace
+        self.lease = lease
+        self.state, self.data = store.load(job_id)
+
+    def check_lease(self):
+        if self.lease is not None:
+            self.lease.check()
+
+    def checkpoint(self, data=None, **state):
+        self.check_lease()
+        self.state.update(state)
+        self.data.update(data or {})
+        self.store.checkpoint(self.job_id, self.state, data)
+
+    def run(self):
+        self.checkpoint(status=STATUS_RUNNING, attempts=self.state.get('attempts', 0) + 1)
+        playlist_id = self.state['playlist_id']
+
+        if 'playlist' not in self.state:
+            get_playlist = self.trace.timed('fetch_pages', self.sp.playlist)
+            playlist = get_playlist(playlist_id, fields=PLAYLIST_FIELDS, additional_types=('track',))
+            self.checkpoint({'page:0': project_page(playlist['tracks'])}, stage='fetch_pages',
+                            progress=progress('fetch_pages'), playlist={
+                                'name': playlist['name'],
+                                'description': playlist['description'],
+                                'snapshot_id': playlist.get('snapshot_id'),
+                                'total': playlist['tracks']['total'],
+                            })
+
+        result = self.data.get('result')
+        if result is None:
+            key = result_cache.key(playlist_id, self.state['playlist']['snapshot_id'], self.state['options'])
+            if key is not None:
+                result, _ = result_cache.get_or_compute(key, self.sort, self.trace)
+            else:
+                result = self.sort()
+            self.checkpoint({'result': result}, stage='sort', progress=progress('create'))
+
+        if not result['uris']:
+            self.checkpoint(status=STATUS_FAILED, message="Error! No tracks found.")
+            return
+
+        new_playlist_id = self.state.get('new_playlist_id')
+        if new_playlist_id is None:
+            # Another runner creating its own copy would leave two playlists behind
+            self.check_lease()
+            new_playlist_id = create_sorted_playlist(self.sp, self.state['playlist']['name'],
+                                                     self.state['playlist']['description'], trace=self.trace)
+            self.checkpoint(stage='create', new_playlist_id=new_playlist_id, written=0,
+                            progress=progress('add_items'))
+        self.add_items(new_playlist_id, result['uris'])
+
+        self.checkpoint(status=STATUS_DONE, stage=STATUS_DONE, progress=100,
+                        sorted_playlist=f"spotify://playlist/{new_playlist_id}")
+
+    def sort(self):
+        pages = self.fetch_pages()
+        features = self.fetch_features(pages)
+        table = build_track_table(pages, features, self.trace)
+        print(f"Audio feature cache: {feature_cache.stats()}")
+        return sort_result(table, self.state['options'], self.trace)
+
+    def fetch_pages(self):
+        total = self.state['playlist']['total']
+        offsets = range(0, total, PAGE_SIZE)
+        missing = [offset for offset in offsets if f"page:{offset}" not in self.data]
+        playlist_tracks = self.trace.timed('fetch_pages', self.sp.playlist_tracks)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(playlist_tracks, self.state['playlist_id'],
+                                       fields=PAGE_FIELDS, limit=PAGE_SIZE, offset=offset): offset for offset in missing}
+            for future in as_completed(futures):
+                self.checkpoint({f"page:{futures[future]}": project_page(future.result())}, stage='fetch_pages',
+                                progress=progress('fetch_pages', self._count('page:'), len(offsets)))
+        return {offset: self.data[f"page:{offset}"] for offset in offsets}
+
+    def fetch_features(self, pages):
+        ids = list(dict.fromkeys(track_id for offset in sorted(pages) for track_id in page_track_ids(pages[offset])))
+        batches = [ids[i:i+FEATURES_BATCH_SIZE] for i in range(0, len(ids), FEATURES_BATCH_SIZE)]
+        missing = [i for i in range(len(batches)) if f"features:{i}" not in self.data]
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(fetch_audio_features, self.sp, batches[i], feature_cache, self.trace): i
+                       for i in missing}
+            for future in as_completed(futures):
+                self.checkpoint({f"features:{futures[future]}": future.result()}, stage='audio_features',
+                                progress=progress('audio_features', self._count('features:'), len(batches)))
+        features = {}
+        for i in range(len(batches)):
+            features.update(self.data[f"features:{i}"])
+        return features
+
+    def add_items(self, new_playlist_id, uris):
+        written = self.state.get('written', 0)
+        if self.state.get('attempts', 1) > 1:
+            # A batch may have gone in just before the last attempt died, so trust the playlist itself
+            playlist_tracks = self.trace.timed('add_items', self.sp.playlist_tracks)
+            written = playlist_tracks(new_playlist_id, fields='total', limit=1)['total']
+        for start in range(written, len(uris), ADD_ITEMS_BATCH_SIZE):
+            batch = uris[start:start+ADD_ITEMS_BATCH_SIZE]
+            snapshot_id = add_batch(self.sp, new_playlist_id, batch, start, self.trace)
+            self.trace.add('add_items', tracks=len(batch))
+            self.checkpoint(stage='add_items', written=start + len(batch), snapshot_id=snapshot_id,
+                            progress=progress('add_items', start + len(batch), len(uris)))
+
+    def _count(self, prefix):
+        return sum(1 for name in self.data if name.startswith(prefix))
+
+
+def create_job(playlist_id, access_token, options, store=None):
+    """
+    Stores a new job for sorting a playlist.
+
+    Returns:
+        str: The job's ID.
+    """
+    store = store or job_store
+    job_id = uuid.uuid4().hex
+    store.create(job_id, {
+        'status': STATUS_QUEUED,
+        'stage': STATUS_QUEUED,
+        'progress': 0,
+        'playlist_id': playlist_id,
+        'options': options,
+        'created': time.time(),
+    }, access_token)
+    return job_id
+
+
+def run_job(job_id, prefix=None, store=None):
+    """
+    Runs or resumes a job in this thread, unless another instance holds its lease.
+
+    Args:
+        job_id (str): The job.
+        prefix (str): Optional API base URL, e.g. a fake_spotify.py server.
+        store (JobStore): Where the job is kept.
+    """
+    store = store or job_store
+    token = store.acquire(job_id)
+    if token is None:
+        return
+    trace = Trace('playlist_job', job_id=job_id)
+    sp = None
+    try:
+        with Lease(store, job_id, token) as lease:
+            try:
+                state = store.state(job_id)
+                if state is None or state['status'] in (STATUS_DONE, STATUS_FAILED):
+                    return
+                access_token = store.access_token(job_id)
+                if access_token is None:
+                    raise RuntimeError("the job's access token has expired, start the job again")
+                sp, _ = spotify_client(access_token, prefix)
+                trace.attach(sp)
+                run = JobRun(store, job_id, sp, trace, lease)
+                if run.state is None:
+                    # Redis can't be reached right now; the next status poll tries again
+                    return
+                run.run()
+            except LeaseLost as e:
+                print(f"Job {job_id} stopped: {e}")
+                return
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                state = store.state(job_id)
+                if state is not None:
+                    new_playlist_id = state.pop('new_playlist_id', None)
+                    if new_playlist_id is not None and sp is not None:
+                        # Don't leave an empty or half-written copy in the user's account
+                        remove_playlist(sp, new_playlist_id)
+                    store.checkpoint(job_id, {**state, 'status': STATUS_FAILED, 'message': f"Error: {e}"})
+            store.drop_access_token(job_id)
+    finally:
+        trace.log()
+
+
+def start_job(job_id, prefix=None, store=None):
+    """
+    Queues a job to run in the background on this instance, unless it is queued here already.
+    """
+    with _scheduled_lock:
+        if job_id in _scheduled:
+            return
+        _scheduled.add(job_id)
+
+    def run():
+        try:
+            run_job(job_id, prefix, store)
+        finally:
+            with _scheduled_lock:
+                _scheduled.discard(job_id)
+
+    _executor.submit(run)
+
+
+def job_status(job_id, prefix=None, store=None):
+    """
+    Reports on a job, resuming it in the background first when it stopped without finishing, e.g.
+    because the instance running it went away.
+
+    Returns:
+        dict: The job's status, stage, progress percentage and, once done, the sorted playlist; None for an
+        unknown job.
+    """
+    store = store or job_store
+    state = store.state(job_id)
+    if state is None:
+        return None
+    if state['status'] in (STATUS_QUEUED, STATUS_RUNNING) and not store.leased(job_id):
+        start_job(job_id, prefix, store)
+    status = {
+        'job_id': job_id,
+        'status': state['status'],
+        'stage': state['stage'],
+        'progress': state['progress'],
+    }
+    for field in ('sorted_playlist', 'message', 'written'):
+        if field in state:
+            status[field] = state[field]
+    return status
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+# Module level so the status endpoint sees the jobs this instance started
+job_store = JobStore(feature_cache.client)
@@ -0,0 +1,181 @@
+"""
+Load driver for make_playlist.
+
+Fires concurrent requests at the functions-framework app and reports latency percentiles and
+throughput as JSON.  By default both the app and a fake Spotify API (fake_spotify.py) run in this
+process; pass --url to drive an app that is already running, started with SPOTIFY_API_PREFIX pointing
+at a fake_spotify.py server.
+
+    python load_run.py --requests 200 --concurrency 16 --size 2000 --latency-ms 30
+    python load_run.py --target make_playlist_async --requests 200 --concurrency 64
+    python load_run.py --url http://127.0.0.1:8080 --playlists realistic2000 skewed500
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_spotify import FakeSpotifyServer
+from synthetic import DISTRIBUTION_REALISTIC, DISTRIBUTIONS
+
+DEFAULT_REQUESTS = 50
+DEFAULT_CONCURRENCY = 8
+DEFAULT_SIZE = 1000
+REQUEST_TIMEOUT = 120
+
+
+def percentile(sorted_values, share):
+    """
+    Nearest-rank percentile of an already sorted list, e.g. percentile(latencies, 0.99).
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(-(-share * len(sorted_values) // 1)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def start_app(target='make_playlist'):
+    """
+    Serves the Cloud Function from main.py on a free local port in a background thread.
+
+    Returns:
+        tuple: (url, server) where server.shutdown() stops it again.
+    """
+    import functions_framework
+    from werkzeug.serving import make_server
+
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    app = functions_framework.create_app(target=target, source=source)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def run_load(url, playlist_ids, num_requests, concurrency, options=None):
+    """
+    Sends num_requests make_playlist requests, concurrency at a time, cycling through playlist_ids.
+
+    Returns:
+        dict: Request count, wall time, throughput, status codes, the latency of the first request and
+        the latency percentiles in ms of all the others.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+
+    def send(i):
+        body = {
+            'access_token': 'fake-token',
+            'playlist_url': f"https://open.spotify.com/playlist/{playlist_ids[i % len(playlist_ids)]}",
+            **(options or {}),
+        }
+        started = time.perf_counter()
+        try:
+            status = session.post(url, json=body, timeout=REQUEST_TIMEOUT).status_code
+        except requests.RequestException:
+            status = 'error'
+        return status, (time.perf_counter() - started) * 1000
+
+    # The first request goes alone, so its latency shows what a cold client costs
+    first_status, first_ms = send(0)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [(first_status, first_ms)] + list(executor.map(send, range(1, num_requests)))
+    elapsed = time.perf_counter() - started + first_ms / 1000
+
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    latencies = sorted(ms for _, ms in results[1:])
+    return {
+        'requests': num_requests,
+        'concurrency': concurrency,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(num_requests / elapsed, 2) if elapsed else None,
+        'status_codes': statuses,
+        'first_request_ms': round(first_ms, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50), 1),
+            'p90': round(percentile(latencies, 0.90), 1),
+            'p99': round(percentile(latencies, 0.99), 1),
+            'max': round(latencies[-1], 1),
+            'mean': round(sum(latencies) / len(latencies), 1),
+        } if latencies else {},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test make_playlist against a fake Spotify API.")
+    parser.add_argument('--url', help="make_playlist URL of a running app; by default one is started here")
+    parser.add_argument('--target', choices=('make_playlist', 'make_playlist_async'), default='make_playlist',
+                        help="function to serve when starting the app here")
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help="tracks per synthetic playlist")
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default=DISTRIBUTION_REALISTIC)
+    parser.add_argument('--same-playlist', action='store_true',
+                        help="sort one playlist over and over, so the audio-feature cache stays warm")
+    parser.add_argument('--playlists', nargs='+', help="explicit fake playlist IDs, e.g. skewed5000s3")
+    parser.add_argument('--options', type=json.loads, default={},
+                        help="extra request json, e.g. '{\"ordering\": \"bpm\"}'")
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--verbose', action='store_true', help="keep the app's own log output")
+    args = parser.parse_args(argv)
+
+    if args.playlists:
+        playlist_ids = args.playlists
+    elif args.same_playlist:
+        playlist_ids = [f"{args.distribution}{args.size}"]
+    else:
+        # A different seed per request gives every request its own tracks, i.e. a cold feature cache
+        playlist_ids = [f"{args.distribution}{args.size}s{i}" for i in range(args.requests)]
+
+    fake = None
+    app_server = None
+    url = args.url
+    if url is None:
+        fake = FakeSpotifyServer(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_limit=args.rate_limit,
+                                 retry_after=args.retry_after, error_rate=args.error_rate).start()
+        os.environ['SPOTIFY_API_PREFIX'] = fake.prefix
+        url, app_server = start_app(args.target)
+
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            report = run_load(url, playlist_ids, args.requests, args.concurrency, args.options)
+    finally:
+        if app_server is not None:
+            app_server.shutdown()
+        if fake is not None:
+            fake.stop()
+
+    report['target'] = args.target if args.url is None else None
+    report['playlist_size'] = args.size if not args.playlists else None
+    if fake is not None:
+        report['fake_spotify'] = fake.stats()
+        # Playlists that were created but not filled, e.g. because their writes kept being rate limited
+        if not args.playlists:
+            report['incomplete_playlists'] = sum(1 for playlist in fake.created.values()
+                                                 if len(playlist['uris']) < args.size)
+        from scheduler import scheduler
+        report['scheduler'] = scheduler.stats()
+    print(json.dumps(report, indent=2))
+    return 0 if set(report['status_codes']) == {'200'} else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+import time
+
+import numpy as np
+
+from scoring import (camelot_cost_matrix,
+                     fold_octaves,
+                     log_tempos,
+                     resolve_weights,
+                     TEMPO_PERCENT_PER_OCTAVE)
+from utils import MAX_RUN_LENGTH
+
+# Upper bound on the time a request may spend improving its ordering, to stay clear of the function timeout
+MAX_BUDGET_MS = 5000
+
+# Longest run of consecutive tracks Or-opt tries to move elsewhere in one piece
+MAX_OR_OPT_SEGMENT = 3
+
+# Moves have to win at least this much to count, so float noise can't make the search cycle
+MIN_GAIN = 1e-4
+
+# Best moves tried per track before giving up on it when each would make a run longer than max_run
+MAX_MOVE_TRIES = 8
+
+
+class _Path:
+    """
+    A playlist order with the per-position data the move evaluation needs.  The first track never moves,
+    and no move may leave more than max_run tracks sharing a key in a row.
+    """
+
+    def __init__(self, keys, log_bpms, order, weights, max_run=None):
+        self.harmonic = weights['harmonic'] * camelot_cost_matrix
+        self.tempo_scale = weights['tempo'] * TEMPO_PERCENT_PER_OCTAVE
+        self.all_keys = keys
+        self.all_log_bpms = log_bpms
+        self.max_run = max_run
+        self.set_order(np.asarray(order, dtype=np.intp))
+
+    def set_order(self, order):
+        self.order = order
+        self.keys = self.all_keys[order]
+        self.log_bpms = self.all_log_bpms[order]
+        # forward[m] is the cost of playing m then m+1, backward[m] the cost of playing them the other way round
+        self.forward = self.costs(self.keys[:-1], self.log_bpms[:-1], self.keys[1:], self.log_bpms[1:])
+        backward = self.costs(self.keys[1:], self.log_bpms[1:], self.keys[:-1], self.log_bpms[:-1])
+        self.forward_sums = np.concatenate(([0.0], np.cumsum(self.forward)))
+        self.backward_sums = np.concatenate(([0.0], np.cumsum(backward)))
+
+    def costs(self, from_keys, from_log_bpms, to_keys, to_log_bpms):
+        return (self.harmonic[from_keys, to_keys]
+                + self.tempo_scale * fold_octaves(to_log_bpms - from_log_bpms))
+
+    def costs_from(self, position, targets):
+        return self.costs(self.keys[position], self.log_bpms[position], self.keys[targets], self.log_bpms[targets])
+
+    def costs_to(self, position, sources):
+        return self.costs(self.keys[sources], self.log_bpms[sources], self.keys[position], self.log_bpms[position])
+
+    def total(self):
+        return float(self.forward_sums[-1])
+
+    def runs_ok(self, source, junctions):
+        """
+        Checks a move for runs longer than max_run.  Only runs across the move's junctions can have
+        grown, and any such run lies within max_run tracks of one.
+
+        Args:
+            source (callable): Maps positions in the moved order to positions in the current one.
+            junctions (list): Positions in the moved order that follow a new neighbour.
+        """
+        if self.max_run is None:
+            return True
+        n = len(self.order)
+        for junction in junctions:
+            window = np.arange(max(junction - self.max_run, 0), min(junction + self.max_run, n))
+            keys = self.keys[source(window)]
+            run = 1
+            for previous, key in zip(keys, keys[1:]):
+                run = run + 1 if key == previous else 1
+                if run > self.max_run:
+                    return False
+        return True
+
+    def best_allowed(self, delta, source_for, junctions_for):
+        """
+        Returns:
+            int: Index of the most improving entry of delta whose move keeps runs within max_run, or None.
+        """
+        delta = delta.copy()
+        for _ in range(MAX_MOVE_TRIES):
+            best = int(np.argmin(delta))
+            if delta[best] > -MIN_GAIN:
+                return None
+            if self.runs_ok(source_for(best), junctions_for(best)):
+                return best
+            delta[best] = np.inf
+        return None
+
+    def try_two_opt(self, i):
+        """
+        Reverses order[i..j] for the j that saves the most, if any saves anything.
+        """
+        n = len(self.order)
+        if i >= n - 1:
+            return False
+        j = np.arange(i + 1, n)
+        delta = self.costs_from(i - 1, j) - self.forward[i - 1]
+        # The reversed segment is walked backwards, which costs differently in an asymmetric matrix
+        delta += (self.backward_sums[j] - self.backward_sums[i]) - (self.forward_sums[j] - self.forward_sums[i])
+        inner = j[:-1]
+        delta[:-1] += self.costs_from(i, inner + 1) - self.forward[inner]
+
+        def source_for(best):
+            end = j[best]
+            return lambda q: np.where((q >= i) & (q <= end), i + end - q, q)
+
+        best = self.best_allowed(delta, source_for, lambda best: (i, j[best] + 1))
+        if best is None:
+            return False
+        order = self.order.copy()
+        order[i:j[best] + 1] = order[i:j[best] + 1][::-1]
+        self.set_order(order)
+        return True
+
+    def try_or_opt(self, i, length):
+        """
+        Moves order[i..i+length-1] to the gap where it saves the most, if any saves anything.
+        """
+        n = len(self.order)
+        last = i + length - 1
+        if i < 1 or last >= n:
+            return False
+
+        removal_gain = self.forward[i - 1]
+        if last < n - 1:
+            removal_gain += self.forward[last] - self.costs_from(i - 1, np.array([last + 1]))[0]
+
+        # Gap p sits between positions p and p+1; p == n-1 appends to the end
+        gaps = np.concatenate((np.arange(0, i - 1), np.arange(last + 1, n)))
+        if not gaps.size:
+            return False
+        insertion = self.costs_to(i, gaps)
+        inner = gaps < n - 1
+        insertion[inner] += self.costs_from(last, gaps[inner] + 1) - self.forward[gaps[inner]]
+
+        def insert_position(best):
+            gap = int(gaps[best])
+            return gap + 1 if gap < i else gap + 1 - length
+
+        def source_for(best):
+            insert_at = insert_position(best)
+
+            def source(q):
+                rest = np.where(q < insert_at, q, q - length)
+                return np.where((q >= insert_at) & (q < insert_at + length), i + q - insert_at,
+                                np.where(rest < i, rest, rest + length))
+            return source
+
+        def junctions_for(best):
+            insert_at = insert_position(best)
+            # The track that followed the segment now follows the one that preceded it
+            closed = i if i < insert_at else i + length
+            return insert_at, insert_at + length, closed
+
+        best = self.best_allowed(insertion - removal_gain, source_for, junctions_for)
+        if best is None:
+            return False
+        segment = self.order[i:last + 1]
+        rest = np.concatenate((self.order[:i], self.order[last + 1:]))
+        insert_at = insert_position(best)
+        self.set_order(np.concatenate((rest[:insert_at], segment, rest[insert_at:])))
+        return True
+
+
+def path_cost(keys, bpms, order, weights=None):
+    """
+    Total transition cost of playing the tracks in the given order.
+
+    Args:
+        keys (list): Camelot bucket index of each track.
+        bpms (list): BPM of each track.
+        order (list): Positions into keys/bpms, in play order.
+        weights (dict): Optional {'harmonic': float, 'tempo': float}, see scoring.DEFAULT_WEIGHTS.
+
+    Returns:
+        float: Sum of scoring.transition_costs() over consecutive tracks.
+    """
+    if len(order) < 2:
+        return 0.0
+    path = _Path(np.asarray(keys, dtype=np.intp), log_tempos(bpms), order, resolve_weights(weights))
+    return path.total()
+
+
+def improve_order(keys, bpms, order, weights=None, budget_ms=0, max_run=MAX_RUN_LENGTH):
+    """
+    Improves an ordering's total transition cost with 2-opt and Or-opt local search.
+
+    The worst transitions are attacked first: for each, reversing the stretch that follows it (2-opt)
+    and moving the next one to three tracks anywhere else in the playlist (Or-opt) are evaluated
+    against every possible position at once, and the best improving move that leaves no more than
+    max_run tracks of one key in a row is applied.  This repeats until no transition can be improved
+    or the time budget runs out.  The first track stays first.
+
+    Start from an order that is already run-limited, see utils.limit_runs(): the search never creates
+    a run that is too long, so the order it returns is the one that gets played, and the costs it
+    reports are those of the starting and the played order.
+
+    Args:
+        keys (list): Camelot bucket index of each track.
+        bpms (list): BPM of each track.
+        order (list): Starting order, e.g. from utils.order_camelot_indices().
+        weights (dict): Optional {'harmonic': float, 'tempo': float}, see scoring.DEFAULT_WEIGHTS.
+        budget_ms (int): Time the search may take, capped at MAX_BUDGET_MS.
+        max_run (int): Longest run of tracks sharing a key a move may create, or None for no limit.
+
+    Returns:
+        tuple: (order, report) where order is the improved list of positions, or the starting one when
+        the search found nothing cheaper, and report is a dict with cost_before, cost_after, moves and
+        elapsed_ms.
+    """
+    started = time.perf_counter()
+    deadline = started + min(budget_ms, MAX_BUDGET_MS) / 1000
+    if len(order) < 3:
+        cost = path_cost(keys, bpms, order, weights)
+        return list(order), {'cost_before': cost, 'cost_after': cost, 'moves': 0, 'elapsed_ms': 0.0}
+
+    path = _Path(np.asarray(keys, dtype=np.intp), log_tempos(bpms), order, resolve_weights(weights), max_run)
+    cost_before = path.total()
+    moves = 0
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for edge in np.argsort(-path.forward, kind='stable'):
+            if path.forward[edge] <= MIN_GAIN or time.perf_counter() >= deadline:
+                break
+            i = int(edge) + 1
+            if path.try_two_opt(i) or any(path.try_or_opt(i, length)
+                                          for length in range(1, MAX_OR_OPT_SEGMENT + 1)):
+                moves += 1
+                improved = True
+                break
+
+    improved_order = path.order.tolist()
+    if path.total() > cost_before:
+        improved_order = list(order)
+    report = {
+        'cost_before': round(cost_before, 2),
+        'cost_after': round(min(path.total(), cost_before), 2),
+        'moves': moves,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+    return improved_order, report
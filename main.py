@@ -1,20 +1,269 @@
 import functions_framework # accessible to Google Cloud Functions
-import spotipy
-from pprint import pprint
+import os
+
+from tracing import Trace
+from tracks import ORDERINGS, ORDERING_CAMELOT, sort_result
+from utils import extract_playlist_id, MAX_RUN_LENGTH
+
+# Spotipy, requests, httpx, Redis and NumPy are imported by the functions below the first time a request
+# needs them, so a cold instance starts quickly and OPTIONS preflights never load them at all
+
+# Most playlists make_playlists accepts in one call, and how many of them are sorted at the same time
+MAX_BATCH_PLAYLISTS = 50
+MAX_CONCURRENT_PLAYLISTS = 4
+
+# Base URL of the Spotify Web API; point it at fake_spotify.py for load tests
+SPOTIFY_API_PREFIX = os.environ.get('SPOTIFY_API_PREFIX')
+
+# Worker pool shared by all playlists of a make_playlists call for page and audio-feature requests
+BATCH_FETCH_WORKERS = 16
+
+# Response message when no Spotify client could be created for the request's access token
+SPOTIFY_CLIENT_ERROR = "Error: could not create a Spotify client for the access_token"
+
+
+def preflight_response():
+    # Allows GET requests from any origin with the Content-Type
+    # header and caches preflight response for an 3600s
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET',
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Max-Age': '3600'
+    }
+
+    return ('', 204, headers)
+
+
+def parse_sort_options(request_json):
+    """
+    Reads the optional sorting options from the request json.
+
+    Args:
+        request_json (dict): The json body of the request.
+
+    Returns:
+        tuple: (options, error) where options holds ordering, weights, optimise_ms, max_run, seed and parallel
+        ready to pass to sort_track_table(), or is None and error says what is wrong with the request.
+        Weights left out stay None, which the scoring code reads as scoring.DEFAULT_WEIGHTS.
+    """
+    ordering = request_json.get('ordering', ORDERING_CAMELOT)
+    if ordering not in ORDERINGS:
+        return None, f"Error: ordering must be one of {', '.join(ORDERINGS)}"
+    weights = None
+    if 'weights' in request_json:
+        from scoring import resolve_weights
+        try:
+            weights = resolve_weights(request_json['weights'])
+        except ValueError as e:
+            return None, f"Error: invalid weights: {e}"
+    optimise_ms = request_json.get('optimise_ms', 0)
+    if 'optimise_ms' in request_json:
+        from local_search import MAX_BUDGET_MS
+        if isinstance(optimise_ms, bool) or not isinstance(optimise_ms, int) or not 0 <= optimise_ms <= MAX_BUDGET_MS:
+            return None, f"Error: optimise_ms must be an integer between 0 and {MAX_BUDGET_MS}"
+    max_run = request_json.get('max_run', MAX_RUN_LENGTH)
+    if isinstance(max_run, bool) or not isinstance(max_run, int) or max_run < 1:
+        return None, "Error: max_run must be a positive integer"
+    seed = request_json.get('seed')
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int)):
+        return None, "Error: seed must be an integer"
+    parallel = request_json.get('parallel', False)
+    if not isinstance(parallel, bool):
+        return None, "Error: parallel must be true or false"
+
+    options = {
+        'ordering': ordering,
+        'weights': weights,
+        'optimise_ms': optimise_ms,
+        'max_run': max_run,
+        'seed': seed,
+        'parallel': parallel,
+    }
+    return options, None
+
+
+def create_spotify_client(access_token):
+    # Create the Spotipy Client using Spotify access token, on top of the instance's pooled session.
+    # Returns (None, False) when that fails; callers answer with SPOTIFY_CLIENT_ERROR
+    from spotify_client import spotify_client
+    try:
+        return spotify_client(access_token, SPOTIFY_API_PREFIX)
+    except Exception as e:
+        print(f"An error occurred initializing the Spotipy client: {e}")
+        return None, False
+
+
+def sort_playlist(sp, fetcher, playlist_url, options, user=None, trace=None, incremental=False):
+    """
+    Fetches, sorts and writes back one playlist.
+
+    Args:
+        sp (spotipy.Spotify): An authenticated Spotipy client.
+        fetcher (TrackFetcher): Fetcher to read the playlist's tracks with.
+        playlist_url (str): URL of the playlist to sort.
+        options (dict): Sorting options, as returned by parse_sort_options().
+        user (str): ID of the current user, if already known.
+        trace (Trace): Trace to book the sort and write stages on.
+        incremental (bool): Patch the sorted playlist from the user's last incremental run of this
+            playlist when possible, see incremental.resort_playlist(), and remember this run's result.
+
+    Returns:
+        tuple: (response_dict, status code)
+    """
+    from cache import feature_cache, result_cache
+    from writer import PlaylistWriter
+
+    # Get tracks and their audio features from a given playlist ID.
+    playlist_id = extract_playlist_id(playlist_url)
+
+    if incremental:
+        from incremental import ordering_record, ordering_store, resort_playlist
+        if user is None:
+            user = sp.current_user()['id']
+        result = resort_playlist(sp, fetcher, playlist_id, options, user, ordering_store, trace)
+        if result is not None:
+            return result
+
+    # The sorted playlist gets created in the background as soon as the source playlist is known
+    writer = PlaylistWriter(sp, user, trace=trace)
+    playlist = fetcher.fetch_playlist(playlist_id)
+    writer.create(playlist)
+
+    def compute():
+        track_table = fetcher.fetch(playlist_id, playlist=playlist)
+        print(f"Audio feature cache: {feature_cache.stats()}")
+        return sort_result(track_table, options, trace)
+
+    # Any failure from here on would leave an empty sorted playlist behind, so remove it again
+    try:
+        # Seeded requests for the same version of a playlist with the same options share one fetch and sort;
+        # only creating and filling the new playlist is done per request
+        key = result_cache.key(playlist_id, playlist.get('snapshot_id'), options)
+        if key is not None:
+            result, shared = result_cache.get_or_compute(key, compute, trace)
+            print(f"Sorted result cache: {result_cache.stats()}, shared: {shared}")
+        else:
+            result = compute()
+
+        num_tracks = len(result['uris'])
+        if num_tracks == 0:
+            print("Error! No tracks found.")
+            writer.abandon()
+            return ({'message': "Error! No tracks found."}, 404)
+
+        # Hand the track URIs to the writer, which adds them to the new playlist in batches of 100
+        new_playlist_id = writer.write(result['uris'])
+    except BaseException:
+        writer.abandon()
+        raise
+    new_playlist_url = f"https://open.spotify.com/playlist/{new_playlist_id}"
+    new_playlist_deeplink = f"spotify://playlist/{new_playlist_id}"
+    print(f"New playlist URL is {new_playlist_url}")
+
+    if incremental and writer.written == num_tracks:
+        ordering_store.put(user, playlist_id, ordering_record(
+            options, playlist.get('snapshot_id'), new_playlist_id, writer.snapshot_id,
+            (uri.rsplit(':', 1)[-1] for uri in result['uris'])))
+
+    if writer.written < num_tracks:
+        print(f"Error! Only {writer.written} of {num_tracks} tracks could be added.")
+        return ({'message': f"Error: only {writer.written} of {num_tracks} tracks could be added",
+                 'sorted_playlist': new_playlist_deeplink}, 404)
+
+    response_dict = {
+        "message": "Success",
+        "sorted_playlist": new_playlist_deeplink
+    }
+    if result['transition_cost']:
+        response_dict["transition_cost"] = result['transition_cost']
+
+    return (response_dict, 200)
+
+
+async def sort_playlist_async(sp, playlist_url, options, trace):
+    """
+    Async version of sort_playlist() for make_playlist_async.  The new playlist is created while the
+    pages and audio features are still coming in, and the result cache and the sort itself run in a
+    worker thread so the event loop keeps serving other invocations.
+
+    Args:
+        sp (AsyncSpotify): An authenticated async client.
+        playlist_url (str): URL of the playlist to sort.
+        options (dict): Sorting options, as returned by parse_sort_options().
+        trace (Trace): Trace to book the stages on.
+
+    Returns:
+        tuple: (response_dict, status code)
+    """
+    import asyncio
+    from cache import feature_cache, result_cache
+    from fetch import fetch_playlist_tracks_async, PLAYLIST_FIELDS
+    from writer import add_items_async, create_playlist_async, remove_playlist_async
+
+    loop = asyncio.get_running_loop()
+    playlist_id = extract_playlist_id(playlist_url)
+    playlist = await sp.playlist(playlist_id, fields=PLAYLIST_FIELDS, additional_types=('track',))
+    created = asyncio.ensure_future(create_playlist_async(sp, playlist))
+
+    def compute():
+        # Runs in a worker thread, which hands the fetch back to the event loop and then sorts
+        track_table = asyncio.run_coroutine_threadsafe(
+            fetch_playlist_tracks_async(sp, playlist_id, feature_cache, trace, playlist=playlist), loop).result()
+        print(f"Audio feature cache: {feature_cache.stats()}")
+        return sort_result(track_table, options, trace)
+
+    try:
+        key = result_cache.key(playlist_id, playlist.get('snapshot_id'), options)
+        if key is not None:
+            result, shared = await loop.run_in_executor(None, result_cache.get_or_compute, key, compute, trace)
+            print(f"Sorted result cache: {result_cache.stats()}, shared: {shared}")
+        else:
+            result = await loop.run_in_executor(None, compute)
+    except BaseException:
+        # Cancelling would not undo a create that already went out, so let it finish and remove the playlist
+        await remove_playlist_async(sp, created)
+        raise
+
+    num_tracks = len(result['uris'])
+    if num_tracks == 0:
+        print("Error! No tracks found.")
+        await remove_playlist_async(sp, created)
+        return ({'message': "Error! No tracks found."}, 404)
+    new_playlist_id = await created
+
+    written, _ = await add_items_async(sp, new_playlist_id, result['uris'], trace=trace)
+    new_playlist_url = f"https://open.spotify.com/playlist/{new_playlist_id}"
+    new_playlist_deeplink = f"spotify://playlist/{new_playlist_id}"
+    print(f"New playlist URL is {new_playlist_url}")
+
+    if written < num_tracks:
+        print(f"Error! Only {written} of {num_tracks} tracks could be added.")
+        return ({'message': f"Error: only {written} of {num_tracks} tracks could be added",
+                 'sorted_playlist': new_playlist_deeplink}, 404)
+
+    response_dict = {
+        "message": "Success",
+        "sorted_playlist": new_playlist_deeplink
+    }
+    if result['transition_cost']:
+        response_dict["transition_cost"] = result['transition_cost']
+
+    return (response_dict, 200)
 
-from utils import (pitch_to_camelot, 
-                    extract_playlist_id,
-                    shuffle_unsorted_tracks_list, 
-                    reorder_list, 
-                    camelot_similarities,
-                    convert_tracks_dict_to_list, 
-                    create_new_playlist)
 
 @functions_framework.http
 def make_playlist(request):
     """HTTP Cloud Function.
     Args:
-        request (flask.Request): The request object.  Expects access_token and playlist_url query string parameters
+        request (flask.Request): The request object.  Expects access_token and playlist_url in the json body,
+        and optionally ordering ("camelot" or "bpm"), weights ({"harmonic": float, "tempo": float}) and
+        optimise_ms, a time budget for smoothing the transitions further with local search, max_run,
+        the longest run of tracks in the same key (default 5), seed, an integer that makes the shuffle repeatable,
+        parallel, to order very large playlists by BPM in clusters across the instance's cores, timings, to get
+        per-stage timings back, and incremental, to update the playlist sorted by the last incremental run in
+        place instead of making a new one.  Seeded requests for the same version of a playlist with the same
+        options get the same order, which is only computed once, see cache.ResultCache
         <https://flask.palletsprojects.com/en/1.1.x/api/#incoming-request-data>
     Returns:
         The response text, or any set of values that can be turned into a
@@ -28,16 +277,7 @@ def make_playlist(request):
 
     # Set CORS headers for the preflight request
     if request.method == 'OPTIONS':
-        # Allows GET requests from any origin with the Content-Type
-        # header and caches preflight response for an 3600s
-        headers = {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET',
-            'Access-Control-Allow-Headers': 'Content-Type',
-            'Access-Control-Max-Age': '3600'
-        }
-
-        return ('', 204, headers)
+        return preflight_response()
 
     # Set CORS headers for the main request
     headers = {
@@ -52,105 +292,226 @@ def make_playlist(request):
         PLAYLIST_URL = request_json['playlist_url']
         assert PLAYLIST_URL != "https://open.spotify.com/playlist/...", "Playlist URL is not valid!"
 
-        # Create the Spotipy Client using Spotify access token
-        try: 
-            sp = spotipy.Spotify(auth=request_json['access_token'], requests_session=True, client_credentials_manager=None, 
-                                        oauth_manager=None, auth_manager=None, proxies=None, 
-                                        requests_timeout=7, status_forcelist=None, retries=1, 
-                                        status_retries=1, backoff_factor=0.3, language=None)
-        except Exception as e:
-            print(f"An error occurred initializing the Spotipy client: {e}")
-
-        # Create a dictionary that we'll use for storing track metadata
-        tracks_dict = dict()
-        # Get tracks from a given playlist ID.
-        playlist_id = extract_playlist_id(PLAYLIST_URL)
-        playlist_tracks = sp.playlist_tracks(playlist_id, limit=50)
-
-        while playlist_tracks:
-            for track_obj in playlist_tracks['items']:
-                track = track_obj['track']
-                tracks_dict[track['id']] = {
-                    'artist': track['artists'][0]['name'],
-                    'bpm': None,
-                    'camelot': None,
-                    'key': None,
-                    'key_tonal': None,
-                    'mode': None,
-                    'name': track['name'],
-                    'uri': track['uri']
-                }
-
-            if playlist_tracks['next']:
-                playlist_tracks = sp.next(playlist_tracks)
-            else:
-                playlist_tracks = None
-
-        num_tracks = len(tracks_dict)
-        if num_tracks == 0:
-            print("Error! No tracks found.")
-            return ({'message': "Error! No tracks found."}, 404, headers)
-        
-        # In case tracks_dict contains more than 100 tracks, we need to query for audio features in chunks 
-        # Divide the track ids into chunks of max_track_ids, creating a list of lists of the track ids
-        max_track_ids = 100
-        track_ids_chunks = [list(tracks_dict.keys())[i:i+max_track_ids] for i in range(0, num_tracks, max_track_ids)]
-
-        # Fetch audio features for each track in the chunk
-        for chunk in track_ids_chunks:
-            tracks_meta = sp.audio_features(chunk)
-
-            for track_meta_obj in tracks_meta:
-                track_id = track_meta_obj['id']
-                tracks_dict[track_id].update({
-                    'bpm': track_meta_obj['tempo'],
-                    'key': track_meta_obj['key'],
-                    'mode': track_meta_obj['mode'],
-                })
-
-                # Use the pitch_to_camelot() function to get additional data for each track
-                camelot, key_tonal = pitch_to_camelot(track_meta_obj['key'], track_meta_obj['mode'])
-                tracks_dict[track_id].update({
-                    'camelot': camelot,
-                    'key_tonal': key_tonal,
-                })
-
-        # Convert the dictionary to a list of objects
-        unsorted_tracks_list = convert_tracks_dict_to_list(tracks_dict)
-
-        # Shuffle the unsorted list, except the first song, to add slight variance to the final playlist
-        shuffled_unsorted_tracks_list = shuffle_unsorted_tracks_list(unsorted_tracks_list)
-
-        # Assess the similarity between all tracks and then reorder the list
-        sorted_tracks_list = reorder_list(shuffled_unsorted_tracks_list, camelot_similarities)
-
-        # print("length of sorted_tracks_list is " + str(len(sorted_tracks_list)))
-        # for track in sorted_tracks_list:
-        #     print(track['camelot'] + " " + track['name'] + " " + track['id'])
-
-        # Create a list containing just the track URIs
-        sorted_track_uris_list = []
-
-        for track in sorted_tracks_list:
-            sorted_track_uris_list.append(track['uri'])
-
-        # Experiment - reverse order for energizing style?
-        # sorted_track_uris_list.reverse()
-
-        # Get the current user id (inherited from access token)
-        user = sp.current_user()['id']
-        pprint(f"User is {user}")
-        new_playlist_id = create_new_playlist(user, sp, playlist_id, sorted_track_uris_list)
-        new_playlist_url = f"https://open.spotify.com/playlist/{new_playlist_id}"
-        new_playlist_deeplink = f"spotify://playlist/{new_playlist_id}"
-        print(f"New playlist URL is {new_playlist_url}")
-        
-        response_dict = {
-            "message": "Success", 
-            "sorted_playlist": new_playlist_deeplink 
-        }
-
-        return (response_dict, 200, headers)
+        # Check the ordering options before doing any work
+        options, error = parse_sort_options(request_json)
+        if error:
+            return ({'message': error}, 404, headers)
+
+        from fetch import TrackFetcher
+        from spotify_client import session_stats
+
+        sp, warm = create_spotify_client(request_json['access_token'])
+        if sp is None:
+            return ({'message': SPOTIFY_CLIENT_ERROR}, 404, headers)
+        trace = Trace('make_playlist', playlist_url=PLAYLIST_URL, warm=warm)
+        trace.attach(sp)
+        try:
+            with TrackFetcher(sp, trace=trace) as fetcher:
+                response_dict, status = sort_playlist(sp, fetcher, PLAYLIST_URL, options, trace=trace,
+                                                      incremental=bool(request_json.get('incremental')))
+        finally:
+            trace.log(**session_stats())
+
+        if request_json.get('timings'):
+            response_dict["timings"] = {**trace.to_dict(), 'warm': warm}
+
+        return (response_dict, status, headers)
     else:
         return ({'message': "Error: access_token or playlist_url missing from request json"}, 404, headers)
 
+
+@functions_framework.http
+def make_playlists(request):
+    """HTTP Cloud Function sorting several playlists in one call.
+    Args:
+        request (flask.Request): The request object.  Expects access_token and playlist_urls, a list of up to
+        MAX_BATCH_PLAYLISTS playlist urls, in the json body, plus the same optional settings as make_playlist.
+    Returns:
+        One result per playlist url, in request order, each with the url and either the sorted playlist
+        or an error message.  The Spotify client, user lookup, audio feature lookups and fetch worker pool
+        are shared by all playlists, which are sorted and written back concurrently.
+    """
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        return preflight_response()
+
+    # Set CORS headers for the main request
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+
+    # Extract the json body
+    request_json = request.get_json()
+
+    if not (request_json and request_json.get('access_token') and request_json.get('playlist_urls')):
+        return ({'message': "Error: access_token or playlist_urls missing from request json"}, 404, headers)
+
+    playlist_urls = request_json['playlist_urls']
+    if not isinstance(playlist_urls, list) or len(playlist_urls) > MAX_BATCH_PLAYLISTS:
+        return ({'message': f"Error: playlist_urls must be a list of at most {MAX_BATCH_PLAYLISTS} urls"}, 404, headers)
+
+    options, error = parse_sort_options(request_json)
+    if error:
+        return ({'message': error}, 404, headers)
+
+    from concurrent.futures import ThreadPoolExecutor
+    from fetch import TrackFetcher
+    from spotify_client import session_stats
+
+    sp, warm = create_spotify_client(request_json['access_token'])
+    if sp is None:
+        return ({'message': SPOTIFY_CLIENT_ERROR}, 404, headers)
+    trace = Trace('make_playlists', playlists=len(playlist_urls), warm=warm)
+    trace.attach(sp)
+
+    # Get the current user id (inherited from access token) once for all playlists, on a stage of its own
+    # so the per-playlist create numbers stay comparable with make_playlist's
+    current_user = trace.timed('user', sp.current_user)
+    user = current_user()['id']
+    print(f"User is {user}")
+
+    def sort_one(playlist_url):
+        try:
+            if not isinstance(playlist_url, str) or "/playlist/" not in playlist_url:
+                return {'playlist_url': playlist_url, 'message': "Error: Playlist URL is not valid!", 'status': 404}
+            response_dict, status = sort_playlist(sp, fetcher, playlist_url, options, user, trace,
+                                                  bool(request_json.get('incremental')))
+        except Exception as e:
+            print(f"An error occurred sorting playlist {playlist_url}: {e}")
+            response_dict, status = {'message': f"Error: {e}"}, getattr(e, 'http_status', 500)
+        return {'playlist_url': playlist_url, **response_dict, 'status': status}
+
+    try:
+        with TrackFetcher(sp, max_workers=BATCH_FETCH_WORKERS, trace=trace) as fetcher, \
+                ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PLAYLISTS) as executor:
+            results = list(executor.map(sort_one, playlist_urls))
+    finally:
+        trace.log(**session_stats())
+
+    response_dict = {
+        "message": "Success",
+        "results": results
+    }
+    if request_json.get('timings'):
+        response_dict["timings"] = {**trace.to_dict(), 'warm': warm}
+
+    return (response_dict, 200, headers)
+
+
+@functions_framework.http
+def make_playlist_async(request):
+    """HTTP Cloud Function doing what make_playlist does on an asyncio event loop.
+    Args:
+        request (flask.Request): The request object, with the same json body as make_playlist.
+    Returns:
+        The same response as make_playlist.  Pagination, audio feature fetches and playlist writes of
+        every concurrent invocation share one event loop and HTTP connection pool per instance, with at
+        most async_spotify.MAX_CONCURRENCY requests in flight per invocation, so an instance can take
+        a higher concurrency setting.  Incremental runs are served by make_playlist.
+    """
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        return preflight_response()
+
+    # Set CORS headers for the main request
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+
+    # Extract the json body
+    request_json = request.get_json()
+
+    if not (request_json and request_json.get('access_token') and request_json.get('playlist_url')):
+        return ({'message': "Error: access_token or playlist_url missing from request json"}, 404, headers)
+
+    # Patching a playlist in place needs the sync client, see incremental.resort_playlist()
+    if request_json.get('incremental'):
+        return make_playlist(request)
+
+    PLAYLIST_URL = request_json['playlist_url']
+    assert PLAYLIST_URL != "https://open.spotify.com/playlist/...", "Playlist URL is not valid!"
+
+    options, error = parse_sort_options(request_json)
+    if error:
+        return ({'message': error}, 404, headers)
+
+    from async_spotify import AsyncSpotify, client_stats, run
+
+    warm = client_stats()['invocations'] > 0
+    trace = Trace('make_playlist_async', playlist_url=PLAYLIST_URL, warm=warm)
+
+    async def sort():
+        try:
+            sp = AsyncSpotify(request_json['access_token'], SPOTIFY_API_PREFIX, trace=trace)
+        except Exception as e:
+            print(f"An error occurred initializing the async Spotify client: {e}")
+            return ({'message': SPOTIFY_CLIENT_ERROR}, 404)
+        async with sp:
+            return await sort_playlist_async(sp, PLAYLIST_URL, options, trace)
+
+    try:
+        response_dict, status = run(sort())
+    finally:
+        trace.log(**client_stats())
+
+    if request_json.get('timings'):
+        response_dict["timings"] = {**trace.to_dict(), 'warm': warm}
+
+    return (response_dict, status, headers)
+
+
+@functions_framework.http
+def playlist_job(request):
+    """HTTP Cloud Function sorting a playlist in the background, for playlists too big to sort within one request.
+    Args:
+        request (flask.Request): The request object.  A POST takes the same json body as make_playlist, except
+        for incremental, and starts a job.  A GET with ?job_id=... reports on it.
+    Returns:
+        For a POST, status 202 with the job_id to poll.  For a GET, the job's status (queued, running, done
+        or failed), stage, progress percentage and, once done, the sorted playlist.  Progress is checkpointed
+        after every stage, page and batch, and a job whose instance went away is resumed from its checkpoints
+        by the next GET, see jobs.JobRun.
+    """
+
+    # Set CORS headers for the preflight request
+    if request.method == 'OPTIONS':
+        return preflight_response()
+
+    # Set CORS headers for the main request
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+
+    if request.method == 'GET':
+        job_id = request.args.get('job_id')
+        if not job_id:
+            return ({'message': "Error: job_id missing from request"}, 404, headers)
+        from jobs import job_status
+        status = job_status(job_id, SPOTIFY_API_PREFIX)
+        if status is None:
+            return ({'message': "Error: unknown job_id"}, 404, headers)
+        return (status, 200, headers)
+
+    # Extract the json body
+    request_json = request.get_json()
+
+    if not (request_json and request_json.get('access_token') and request_json.get('playlist_url')):
+        return ({'message': "Error: access_token or playlist_url missing from request json"}, 404, headers)
+    if request_json.get('incremental'):
+        return ({'message': "Error: incremental isn't supported for jobs"}, 404, headers)
+
+    PLAYLIST_URL = request_json['playlist_url']
+    assert PLAYLIST_URL != "https://open.spotify.com/playlist/...", "Playlist URL is not valid!"
+
+    options, error = parse_sort_options(request_json)
+    if error:
+        return ({'message': error}, 404, headers)
+
+    from jobs import create_job, start_job, STATUS_QUEUED
+
+    job_id = create_job(extract_playlist_id(PLAYLIST_URL), request_json['access_token'], options)
+    start_job(job_id, SPOTIFY_API_PREFIX)
+
+    return ({'message': "Accepted", 'job_id': job_id, 'status': STATUS_QUEUED}, 202, headers)
@@ -0,0 +1,183 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from local_search import path_cost
+from scoring import log_tempos, order_by_transition_cost, resolve_weights, transition_costs
+from utils import MAX_RUN_LENGTH
+
+# Tracks per cluster the partitioning aims for.  The number of clusters only depends on the playlist,
+# never on the number of cores, so a seed gives the same order on every instance.
+CLUSTER_TRACKS = 2500
+MAX_CLUSTERS = 48
+
+# The Camelot wheel is cut into this many arcs of neighbouring numbers, and each arc into tempo bands.
+# Clusters are ordered with max_run, which needs a choice of keys to leave a run for cheaply; cut into
+# arcs of six keys they came out two to six times costlier per track, so the whole wheel is one arc.
+HARMONIC_ARCS = 1
+WHEEL_NUMBERS = 12
+
+# Most worker processes one instance starts, whatever os.cpu_count() says
+MAX_WORKERS = 8
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def default_workers():
+    """
+    Returns:
+        int: Worker processes to use on this instance: one per core it may run on, up to MAX_WORKERS.
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    return max(1, min(cores, MAX_WORKERS))
+
+
+def get_pool(workers):
+    """
+    Returns:
+        ProcessPoolExecutor: The instance's pool of worker processes of this size, started on first use
+        and kept for later requests.  Workers are spawned rather than forked, because the instance has
+        threads (the async event loop, background writers) that a fork would copy mid-flight.
+    """
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+        return pool
+
+
+def cluster_tracks(keys, bpms, num_clusters):
+    """
+    Splits a playlist into harmonic and tempo clusters.
+
+    Tracks are grouped by HARMONIC_ARCS arcs of neighbouring Camelot wheel numbers (both letters), so
+    most of the transitions the ordering wants stay inside one cluster.  Every arc is then cut into
+    bands of tempo, folded onto one octave like scoring.fold_octaves() does, with about CLUSTER_TRACKS
+    tracks each; an arc holding most of a skewed playlist gets most of the bands.
+
+    Args:
+        keys (list): Camelot bucket index of each track, in (shuffled) playlist order.
+        bpms (list): BPM of each track, in the same order.
+        num_clusters (int): Number of clusters to aim for.
+
+    Returns:
+        list: The non-empty clusters, each a list of positions into keys in ascending order.
+    """
+    keys = np.asarray(keys, dtype=np.intp)
+    arcs = keys % WHEEL_NUMBERS * HARMONIC_ARCS // WHEEL_NUMBERS
+    octave_positions = log_tempos(bpms) % 1
+    labels = np.zeros(len(keys), dtype=np.intp)
+    next_label = 0
+    for arc in range(HARMONIC_ARCS):
+        members = np.flatnonzero(arcs == arc)
+        if not members.size:
+            continue
+        bands = max(1, round(members.size * num_clusters / len(keys)))
+        # Rank within the arc, so every band gets its share of tracks even when tempos bunch up
+        ranks = np.argsort(np.argsort(octave_positions[members], kind='stable'), kind='stable')
+        labels[members] = next_label + ranks * bands // members.size
+        next_label += bands
+
+    clusters = [np.flatnonzero(labels == label) for label in range(next_label)]
+    return [cluster.tolist() for cluster in clusters if cluster.size]
+
+
+def order_cluster(keys, bpms, weights, max_run=MAX_RUN_LENGTH):
+    """
+    Orders one cluster with scoring.order_by_transition_cost(); runs in a worker process.
+
+    Returns:
+        list: Positions into the cluster's keys, in play order, starting with its first track.
+    """
+    return order_by_transition_cost(keys, bpms, weights, max_run)
+
+
+def stitch_segments(segments, keys, bpms, weights):
+    """
+    Joins ordered segments into one playlist.  Starting with the segment that holds the first track,
+    it keeps appending whichever remaining segment, played forwards or backwards, has the cheapest
+    transition from the current last track.  Playing a segment backwards also changes the cost of
+    its own transitions, which counts towards that choice.
+
+    Args:
+        segments (list): Lists of positions into keys, each in play order; the first one starts with 0.
+        keys (list): Camelot bucket index of each track.
+        bpms (list): BPM of each track.
+        weights (dict): Complete weights, as returned by scoring.resolve_weights().
+
+    Returns:
+        list: Positions into keys, in the order the tracks should be played.
+    """
+    keys = np.asarray(keys, dtype=np.intp)
+    bpms = np.asarray(bpms, dtype=np.float32)
+    log_bpms = log_tempos(bpms)
+    walk = list(segments[0])
+    remaining = segments[1:]
+    heads = np.array([segment[0] for segment in remaining], dtype=np.intp)
+    tails = np.array([segment[-1] for segment in remaining], dtype=np.intp)
+    reversal_costs = np.array([
+        path_cost(keys[segment], bpms[segment], range(len(segment) - 1, -1, -1), weights)
+        - path_cost(keys[segment], bpms[segment], range(len(segment)), weights)
+        for segment in remaining
+    ])
+    left = np.ones(len(remaining), dtype=bool)
+
+    for _ in range(len(remaining)):
+        tail = walk[-1]
+        forwards = transition_costs(keys[tail], log_bpms[tail], keys[heads], log_bpms[heads], weights)
+        backwards = transition_costs(keys[tail], log_bpms[tail], keys[tails], log_bpms[tails], weights)
+        backwards = backwards + reversal_costs
+        forwards[~left], backwards[~left] = np.inf, np.inf
+
+        best = int(np.argmin(np.minimum(forwards, backwards)))
+        segment = remaining[best]
+        walk.extend(segment if forwards[best] <= backwards[best] else reversed(segment))
+        left[best] = False
+    return walk
+
+
+def order_partitioned(keys, bpms, weights=None, workers=None, max_run=MAX_RUN_LENGTH):
+    """
+    Parallel counterpart of scoring.order_by_transition_cost() for large playlists: the tracks are split
+    with cluster_tracks(), every cluster is ordered on its own in a pool of worker processes and
+    stitch_segments() joins the results.  The first track stays first.  Clusters are ordered with max_run,
+    but a join can still put two runs of one key together; limiting runs on the joined order, as
+    tracks.sort_track_table() does, keeps the max_run guarantee across the joins too.
+
+    Args:
+        keys (list): Camelot bucket index of each track, in (shuffled) playlist order.
+        bpms (list): BPM of each track, in the same order.
+        weights (dict): Optional {'harmonic': float, 'tempo': float}, see scoring.DEFAULT_WEIGHTS.
+        workers (int): Worker processes to use, default_workers() if None.  With 1 the clusters are
+            ordered in this process, which still beats ordering the whole playlist at once since the
+            work grows with the square of the tracks ordered together.
+        max_run (int): Longest run of tracks sharing a key within a cluster, see utils.limit_runs().
+
+    Returns:
+        list: Positions into keys, in the order the tracks should be played.
+    """
+    weights = resolve_weights(weights)
+    num_clusters = max(1, min(len(keys) // CLUSTER_TRACKS, MAX_CLUSTERS))
+    clusters = cluster_tracks(keys, bpms, num_clusters)
+    # The cluster holding the first track goes first, so it starts the playlist
+    clusters.sort(key=lambda cluster: cluster[0] != 0)
+
+    jobs = [([keys[p] for p in cluster], [bpms[p] for p in cluster], weights, max_run) for cluster in clusters]
+    workers = default_workers() if workers is None else workers
+    if workers > 1 and len(clusters) > 1:
+        # Biggest clusters first, so no worker is left with a big one at the end
+        by_size = sorted(range(len(jobs)), key=lambda i: -len(clusters[i]))
+        orders = dict(zip(by_size, get_pool(workers).map(order_cluster, *zip(*(jobs[i] for i in by_size)))))
+    else:
+        orders = dict(enumerate(order_cluster(*job) for job in jobs))
+
+    segments = [[cluster[position] for position in orders[i]] for i, cluster in enumerate(clusters)]
+    return stitch_segments(segments, keys, bpms, weights)
@@ -0,0 +1,185 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+# Request priorities.  Reads go first: every request's fetch and sort waits on them, while writes only
+# finish off a playlist that is already sorted.
+READ = 'read'
+WRITE = 'write'
+PRIORITIES = (READ, WRITE)
+
+# Requests per second an instance allows itself.  It starts at the top, so nothing is held back until
+# Spotify first answers 429; then the rate drops to what was getting through and creeps back up.
+MAX_RATE = 500.0
+MIN_RATE = 1.0
+
+# A 429 cuts the rate to this share of the rate requests were actually sent at over the last
+# RATE_WINDOW_SECONDS, and each second without one adds RATE_INCREASE requests per second again
+RATE_DECREASE = 0.8
+RATE_INCREASE = 2.0
+RATE_WINDOW_SECONDS = 2.0
+
+# Seconds' worth of requests the bucket holds, i.e. the burst allowed after a quiet spell
+BURST_SECONDS = 1.0
+
+# How long a write checks back while reads are waiting, and the pause for a 429 without Retry-After
+WRITE_POLL_SECONDS = 0.005
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class RequestScheduler:
+    """
+    Token bucket shared by every Spotify request of a function instance, sync or async.
+
+    A request takes a token before it goes out.  Tokens refill at the current rate, which is learned
+    from Spotify's answers: a 429 pauses every request for its Retry-After and cuts the rate, and
+    time without one lets it grow again (additive increase, multiplicative decrease).  Writes only
+    get a token while no read is waiting for one.  stats() reports the queue depth and wait times.
+    Safe to use from several threads and the async event loop at once.
+    """
+
+    def __init__(self, max_rate=MAX_RATE, clock=time.monotonic, sleep=time.sleep):
+        """
+        Args:
+            max_rate (float): Most requests per second the scheduler ever lets through.
+            clock (callable): Returns the current time in seconds, e.g. a test's fake clock.
+            sleep (callable): Blocks acquire() for a number of seconds; acquire_async() uses asyncio.sleep().
+        """
+        self.max_rate = max_rate
+        self._clock = clock
+        self._sleep = sleep
+        self._rate = max_rate
+        self._tokens = max_rate * BURST_SECONDS
+        self._refilled = clock()
+        self._paused_until = 0.0
+        self._sent = deque()
+        self._first_sent = None
+        self._waiting = {priority: 0 for priority in PRIORITIES}
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'throttled': 0, 'rate_limited': 0, 'max_queue_depth': 0,
+                       'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+
+    def acquire(self, priority=READ):
+        """
+        Blocks until a request of this priority may go out.
+        """
+        delay = self._try_acquire(priority)
+        if delay <= 0:
+            return
+        started = self._enqueue(priority)
+        try:
+            while delay > 0:
+                self._sleep(delay)
+                delay = self._try_acquire(priority)
+        finally:
+            self._dequeue(priority, started)
+
+    async def acquire_async(self, priority=READ):
+        """
+        Waits on the running event loop until a request of this priority may go out.
+        """
+        delay = self._try_acquire(priority)
+        if delay <= 0:
+            return
+        started = self._enqueue(priority)
+        try:
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self._try_acquire(priority)
+        finally:
+            self._dequeue(priority, started)
+
+    def rate_limited(self, retry_after=None):
+        """
+        Takes a 429 into account: holds every request back for its Retry-After and, unless it came in
+        during the pause of an earlier one, cuts the rate to RATE_DECREASE of the rate recently sent.
+
+        Args:
+            retry_after (str): The response's Retry-After header, if any.
+
+        Returns:
+            float: Seconds until requests go out again.
+        """
+        try:
+            retry_after = float(retry_after)
+        except (TypeError, ValueError):
+            retry_after = DEFAULT_RETRY_AFTER
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._stats['rate_limited'] += 1
+            # Requests that were in flight when the pause began come back 429 too; they don't cut it again
+            if now >= self._paused_until:
+                sent = self._prune(now)
+                # A young instance hasn't been sending for a whole window yet
+                window = min(RATE_WINDOW_SECONDS, now - self._first_sent) if sent else RATE_WINDOW_SECONDS
+                sent_rate = len(sent) / max(window, 1 / self.max_rate)
+                self._rate = max(MIN_RATE, min(self._rate, sent_rate) * RATE_DECREASE)
+            self._paused_until = max(self._paused_until, now + retry_after)
+            self._tokens = 0.0
+            return retry_after
+
+    def stats(self):
+        """
+        Returns:
+            dict: The current rate and queue depth per priority, plus since the instance started: requests
+            let through, how many had to wait, the 429s seen, the deepest queue and the total and
+            longest wait in ms.
+        """
+        with self._lock:
+            self._refill(self._clock())
+            stats = {'rate': round(self._rate, 1), 'queue_depth': dict(self._waiting), **self._stats}
+        stats['wait_ms_total'] = round(stats['wait_ms_total'], 1)
+        stats['wait_ms_max'] = round(stats['wait_ms_max'], 1)
+        return stats
+
+    def _try_acquire(self, priority):
+        """
+        Returns:
+            float: 0 if a token was taken, otherwise how long to wait before trying again.
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            if now < self._paused_until:
+                return self._paused_until - now
+            if priority == WRITE and self._waiting[READ]:
+                return WRITE_POLL_SECONDS
+            if self._tokens < 1:
+                return (1 - self._tokens) / self._rate
+            self._tokens -= 1
+            self._prune(now).append(now)
+            if self._first_sent is None:
+                self._first_sent = now
+            self._stats['requests'] += 1
+            return 0.0
+
+    def _refill(self, now):
+        # Neither tokens nor rate build up during a pause, so it doesn't end in a burst
+        elapsed = now - max(self._refilled, min(self._paused_until, now))
+        self._refilled = now
+        self._rate = min(self.max_rate, self._rate + RATE_INCREASE * elapsed)
+        self._tokens = min(max(self._rate * BURST_SECONDS, 1.0), self._tokens + elapsed * self._rate)
+
+    def _prune(self, now):
+        while self._sent and self._sent[0] < now - RATE_WINDOW_SECONDS:
+            self._sent.popleft()
+        return self._sent
+
+    def _enqueue(self, priority):
+        with self._lock:
+            self._waiting[priority] += 1
+            self._stats['throttled'] += 1
+            self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], sum(self._waiting.values()))
+        return self._clock()
+
+    def _dequeue(self, priority, started):
+        waited_ms = (self._clock() - started) * 1000
+        with self._lock:
+            self._waiting[priority] -= 1
+            self._stats['wait_ms_total'] += waited_ms
+            self._stats['wait_ms_max'] = max(self._stats['wait_ms_max'], waited_ms)
+
+
+scheduler = RequestScheduler()
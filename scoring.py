@@ -0,0 +1,200 @@
+import math
+
+import numpy as np
+
+from utils import camelot_neighbour_ranks, MAX_RUN_LENGTH
+
+# Harmonic cost of moving between two keys that don't appear in each other's camelot_similarities list
+UNRELATED_KEY_COST = 8.0
+
+# Relative weight of the harmonic and the tempo term; one harmonic rank step costs as much as
+# a 4% tempo change with these defaults
+DEFAULT_WEIGHTS = {
+    'harmonic': 1.0,
+    'tempo': 0.25,
+}
+
+# Tempo distances are expressed as 100 * ln(tempo ratio), i.e. roughly a percentage change
+TEMPO_PERCENT_PER_OCTAVE = 100 * np.log(2)
+
+# Spotify reports 0 BPM for tracks it couldn't analyse; treat them as very slow instead of dividing by 0
+MIN_BPM = 1.0
+
+
+def build_camelot_cost_matrix(neighbour_ranks=camelot_neighbour_ranks):
+    """
+    Precomputes the harmonic distance between every pair of Camelot keys.
+
+    Args:
+        neighbour_ranks (tuple): Ranked similar keys per key, as returned by utils.camelot_index_tables().
+
+    Returns:
+        numpy.ndarray: 24x24 float32 matrix; entry [a, b] is the rank of key b in key a's similarity
+        list (0 for the same key), or UNRELATED_KEY_COST when b isn't listed at all.
+    """
+    num_keys = len(neighbour_ranks)
+    matrix = np.full((num_keys, num_keys), UNRELATED_KEY_COST, dtype=np.float32)
+    for key, ranks in enumerate(neighbour_ranks):
+        for rank, similar in enumerate(ranks):
+            matrix[key, similar] = rank
+    return matrix
+
+
+camelot_cost_matrix = build_camelot_cost_matrix()
+
+
+def resolve_weights(weights=None):
+    """
+    Fills in DEFAULT_WEIGHTS for any weight the caller didn't provide.
+
+    Args:
+        weights (dict): Optional {'harmonic': float, 'tempo': float}.
+
+    Returns:
+        dict: The complete set of weights.
+
+    Raises:
+        ValueError: If a weight is unknown or isn't a finite, non-negative number.
+    """
+    if weights is not None and not isinstance(weights, dict):
+        raise ValueError("weights must be an object of name -> number")
+    resolved = dict(DEFAULT_WEIGHTS)
+    for name, value in (weights or {}).items():
+        if name not in DEFAULT_WEIGHTS:
+            raise ValueError(f"Unknown weight '{name}'")
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+            # A NaN or infinite weight would turn every cost into NaN, and used tracks would win argmin again
+            raise ValueError(f"Weight '{name}' must be a finite, non-negative number")
+        resolved[name] = float(value)
+    return resolved
+
+
+def log_tempos(bpms):
+    """
+    Returns:
+        numpy.ndarray: log2 of the BPMs, the space the tempo distance is measured in.
+    """
+    return np.log2(np.maximum(np.asarray(bpms, dtype=np.float32), MIN_BPM))
+
+
+def fold_octaves(octaves):
+    """
+    Folds log2 tempo ratios onto half/double time, so 70 -> 140 BPM counts as no change at all.
+    """
+    return np.abs(octaves - np.clip(np.rint(octaves), -1, 1))
+
+
+def tempo_distance(from_log_bpm, log_bpms):
+    """
+    Tempo distance from one track to many, matching half and double time.
+
+    Args:
+        from_log_bpm (float): log2 BPM of the current track.
+        log_bpms (numpy.ndarray): log2 BPMs of the candidates.
+
+    Returns:
+        numpy.ndarray: Logarithmic percentage tempo change to each candidate (100 * ln of the
+        tempo ratio, so 120 -> 126 BPM costs about 4.9), after halving or doubling the candidate's
+        tempo if that brings it closer.
+    """
+    return fold_octaves(log_bpms - from_log_bpm) * TEMPO_PERCENT_PER_OCTAVE
+
+
+def transition_costs(from_key, from_log_bpm, keys, log_bpms, weights):
+    """
+    Cost of moving from one track to each of many candidates.
+
+    Args:
+        from_key (int): Camelot bucket index of the current track.
+        from_log_bpm (float): log2 BPM of the current track.
+        keys (numpy.ndarray): Camelot bucket indices of the candidates.
+        log_bpms (numpy.ndarray): log2 BPMs of the candidates.
+        weights (dict): Complete weights, as returned by resolve_weights().
+
+    Returns:
+        numpy.ndarray: One cost per candidate; lower is smoother.
+    """
+    return (weights['harmonic'] * camelot_cost_matrix[from_key, keys]
+            + weights['tempo'] * tempo_distance(from_log_bpm, log_bpms))
+
+
+def order_by_transition_cost(keys, bpms, weights=None, max_run=MAX_RUN_LENGTH):
+    """
+    BPM-aware counterpart of utils.order_camelot_indices(): starting from the first track, always
+    move to the remaining track with the cheapest transition, ties going to the earliest track.
+    Each step scores all remaining candidates at once with NumPy.
+
+    Staying in the same key costs nothing, so once max_run tracks in a row share a key the walk moves
+    on to another key, as long as one is left.  That way utils.limit_runs() rarely has anything left to
+    break up, and the cost of the order that gets written is the cost this walk optimised.
+
+    Args:
+        keys (list): Camelot bucket index of each track, in (shuffled) playlist order.
+        bpms (list): BPM of each track, in the same order.
+        weights (dict): Optional {'harmonic': float, 'tempo': float}, see DEFAULT_WEIGHTS.
+        max_run (int): Longest run of tracks sharing a key, see utils.limit_runs().
+
+    Returns:
+        list: Positions into keys, in the order the tracks should be played.
+    """
+    weights = resolve_weights(weights)
+    num_tracks = len(keys)
+    if num_tracks == 0:
+        return []
+
+    # Taken tracks are moved to an extra key whose every transition costs inf, so they never win
+    # argmin and the candidate arrays only need compacting once in a while instead of every step
+    num_keys = len(camelot_cost_matrix)
+    taken = num_keys
+    harmonic_costs = np.full((num_keys + 1, num_keys + 1), np.inf, dtype=np.float32)
+    harmonic_costs[:num_keys, :num_keys] = weights['harmonic'] * camelot_cost_matrix
+    tempo_scale = np.float32(weights['tempo'] * TEMPO_PERCENT_PER_OCTAVE)
+
+    # Candidates stay in playlist order, so argmin's first-minimum rule breaks ties by position
+    candidate_positions = np.arange(1, num_tracks)
+    candidate_keys = np.asarray(keys, dtype=np.intp)[1:]
+    candidate_log_bpms = log_tempos(bpms)
+    current_key, current_log_bpm = keys[0], candidate_log_bpms[0]
+    candidate_log_bpms = candidate_log_bpms[1:]
+
+    # Tracks left per key, so the walk can tell when the biggest key needs every turn it can get
+    remaining = np.bincount(candidate_keys, minlength=num_keys)
+
+    order = [0]
+    num_taken = 0
+    run = 1
+    for step in range(num_tracks - 1):
+        harmonic_row = harmonic_costs[current_key]
+        biggest = int(np.argmax(remaining))
+        others = num_tracks - 1 - step - remaining[biggest]
+        if remaining[biggest] >= max_run * others and (biggest != current_key or run < max_run):
+            # Spending the other keys now would leave a run of the biggest one too long to break up
+            harmonic_row = np.full_like(harmonic_row, np.inf)
+            harmonic_row[biggest] = harmonic_costs[current_key, biggest]
+        elif run >= max_run:
+            # Rule out the current key; when only tracks in it are left, its row is used after all
+            harmonic_row = harmonic_row.copy()
+            harmonic_row[current_key] = np.inf
+        costs = harmonic_row.take(candidate_keys)
+        costs += tempo_scale * fold_octaves(candidate_log_bpms - current_log_bpm)
+        best = int(np.argmin(costs))
+        if not np.isfinite(costs[best]):
+            costs = harmonic_costs[current_key].take(candidate_keys)
+            costs += tempo_scale * fold_octaves(candidate_log_bpms - current_log_bpm)
+            best = int(np.argmin(costs))
+
+        next_key = int(candidate_keys[best])
+        remaining[next_key] -= 1
+        run = run + 1 if next_key == current_key else 1
+        order.append(int(candidate_positions[best]))
+        current_key, current_log_bpm = next_key, candidate_log_bpms[best]
+        candidate_keys[best] = taken
+        num_taken += 1
+
+        if num_taken * 2 > candidate_keys.size:
+            keep = candidate_keys != taken
+            candidate_positions = candidate_positions[keep]
+            candidate_keys = candidate_keys[keep]
+            candidate_log_bpms = candidate_log_bpms[keep]
+            num_taken = 0
+    return order
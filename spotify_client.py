@@ -0,0 +1,177 @@
+import random
+import threading
+
+import requests
+import spotipy
+import urllib3
+from urllib3.exceptions import InvalidHeader, MaxRetryError, ResponseError
+
+from scheduler import READ, WRITE, scheduler
+from tracing import record_retry
+
+# One function instance talks to a single host, but several request threads (page and audio-feature
+# fetches, playlist writers, concurrent invocations) share the pool, so keep plenty of connections
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 32
+
+# Seconds to wait for a connection and for a response
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 7
+
+# Retries done by the HTTP layer itself, before the caller gets to see a failure
+MAX_RETRIES = 3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BACKOFF_FACTOR = 0.3
+BACKOFF_MAX = 8
+
+# Longest Retry-After worth waiting for inside a request; longer ones are handed to the caller
+MAX_RETRY_AFTER = 10
+
+_session = None
+_session_lock = threading.Lock()
+_invocations = 0
+
+
+class AdaptiveRetry(urllib3.Retry):
+    """
+    Retry policy for the Spotify API: honours Retry-After on 503, otherwise backs off
+    exponentially with full jitter so concurrent requests that failed together don't retry together.
+    A Retry-After longer than MAX_RETRY_AFTER isn't waited out; the response goes back to the caller
+    with its headers so it can decide.  429s are left to ScheduledAdapter.
+    """
+
+    # urllib3 would otherwise retry a 429 with a Retry-After itself, behind the scheduler's back
+    RETRY_AFTER_STATUS_CODES = frozenset([413, 503])
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, min(backoff, BACKOFF_MAX)) if backoff else 0
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None:
+            try:
+                retry_after = self.get_retry_after(response)
+            except InvalidHeader:
+                retry_after = None
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER:
+                # With raise_on_status off this hands the response itself back to the caller
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After of {retry_after}s is too long"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class ScheduledAdapter(requests.adapters.HTTPAdapter):
+    """
+    Sends every request through the instance's scheduler.RequestScheduler, GETs as reads and the rest as
+    writes.  A 429 is reported to the scheduler, which holds back every request of the instance for its
+    Retry-After, and retried once the scheduler lets it go again; the last one, or one whose Retry-After
+    is longer than MAX_RETRY_AFTER, goes back to the caller.
+    """
+
+    def send(self, request, *args, **kwargs):
+        priority = READ if request.method == 'GET' else WRITE
+        attempt = 0
+        while True:
+            scheduler.acquire(priority)
+            response = super().send(request, *args, **kwargs)
+            if response.status_code != 429:
+                return response
+            retry_after = scheduler.rate_limited(response.headers.get('Retry-After'))
+            if attempt >= MAX_RETRIES or retry_after > MAX_RETRY_AFTER:
+                return response
+            attempt += 1
+            print(f"Rate limited by Spotify, retrying in {retry_after}s (attempt {attempt})")
+            # Reading the body hands the connection back to the pool
+            response.content
+            record_retry(response)
+
+
+class _PooledSpotify(spotipy.Spotify):
+    def __del__(self):
+        # The session is shared with the other requests of this instance, so it must outlive the client
+        pass
+
+
+def build_session(pool_maxsize=POOL_MAXSIZE):
+    """
+    Builds a requests session with a connection pool sized for the concurrent fetch and write paths.
+
+    Returns:
+        requests.Session: The session, with a ScheduledAdapter using AdaptiveRetry mounted for http and https.
+    """
+    retry = AdaptiveRetry(
+        total=MAX_RETRIES,
+        connect=None,
+        read=False,
+        # A 5xx on a write often means it went in anyway, so only reads are resent on one.  Failed
+        # connects are retried for every method, since the request never went out; writes are
+        # retried by their callers, e.g. writer.add_batch(), which check first
+        allowed_methods=frozenset(['GET']),
+        status=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        # 429s are retried by ScheduledAdapter, which holds the instance's other requests back too
+        status_forcelist=[status for status in RETRY_STATUSES if status != 429],
+        respect_retry_after_header=True,
+        # Hand the last response back instead of a bare RetryError, so a final 429 keeps its Retry-After
+        raise_on_status=False,
+    )
+    adapter = ScheduledAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Returns:
+        requests.Session: This instance's shared session, built on first use and kept while the
+        instance stays warm.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = build_session()
+        return _session
+
+
+def spotify_client(access_token, prefix=None):
+    """
+    Creates a Spotipy client for one request on top of the shared session.  The client only holds the
+    request's bearer token; connections, TLS sessions and keep-alive are reused across invocations.
+
+    Args:
+        access_token (str): The user's Spotify access token.
+        prefix (str): Optional API base URL, e.g. a fake_spotify.py server.
+
+    Returns:
+        tuple: (sp, warm) where warm tells whether an earlier invocation already set up the session.
+    """
+    global _invocations
+    with _session_lock:
+        warm = _session is not None
+        _invocations += 1
+    sp = _PooledSpotify(auth=access_token, requests_session=get_session(),
+                        requests_timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    if prefix:
+        sp.prefix = prefix
+    return sp, warm
+
+
+def session_stats():
+    """
+    Returns:
+        dict: Invocations served by this instance, connections its pools have opened so far and the
+        request scheduler's stats.
+    """
+    with _session_lock:
+        session = _session
+        invocations = _invocations
+    connections = 0
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+    return {'invocations': invocations, 'connections_opened': connections, 'scheduler': scheduler.stats()}
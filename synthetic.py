@@ -0,0 +1,81 @@
+import random
+import string
+
+from utils import pitch_to_camelot
+
+# Rough share of each pitch class (C, C#, ..., B) among popular tracks on Spotify
+PITCH_CLASS_WEIGHTS = (12, 10, 9, 3, 7, 8, 6, 11, 7, 9, 6, 7)
+
+# Share of tracks in a major key
+MAJOR_SHARE = 0.62
+
+# Tempo distribution; a few tracks have no tempo at all, like ones Spotify couldn't analyse
+BPM_MEAN = 120.0
+BPM_STDEV = 28.0
+MIN_BPM = 55.0
+MAX_BPM = 210.0
+ZERO_BPM_SHARE = 0.005
+
+# Share of tracks that share a single key in a "skewed" playlist
+SKEWED_KEY_SHARE = 0.8
+
+DISTRIBUTION_REALISTIC = 'realistic'
+DISTRIBUTION_SKEWED = 'skewed'
+DISTRIBUTION_UNIFORM = 'uniform'
+DISTRIBUTIONS = (DISTRIBUTION_REALISTIC, DISTRIBUTION_SKEWED, DISTRIBUTION_UNIFORM)
+
+_ID_CHARS = string.ascii_letters + string.digits
+
+
+def generate_tracks_dict(num_tracks, distribution=DISTRIBUTION_REALISTIC, seed=0):
+    """
+    Generates a synthetic playlist in the track ID -> metadata form the fetch code produces and
+    convert_tracks_dict_to_list() expects.  The same arguments always give the same playlist.
+
+    Args:
+        num_tracks (int): Number of tracks.
+        distribution (str): One of DISTRIBUTIONS.  "realistic" draws keys and modes like popular music,
+        "skewed" puts SKEWED_KEY_SHARE of the tracks in one key and "uniform" spreads them evenly.
+        seed (int): Seed for the generator; the global random state is left alone.
+
+    Returns:
+        dict: Track ID -> {'name', 'artist', 'uri', 'bpm', 'key', 'mode', 'camelot', 'key_tonal'}.
+    """
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f"Unknown distribution '{distribution}'")
+
+    rng = random.Random(f"{distribution}:{num_tracks}:{seed}")
+    skewed_key = (rng.randrange(12), int(rng.random() < MAJOR_SHARE))
+
+    tracks_dict = {}
+    while len(tracks_dict) < num_tracks:
+        track_id = ''.join(rng.choice(_ID_CHARS) for _ in range(22))
+        if track_id in tracks_dict:
+            continue
+
+        if distribution == DISTRIBUTION_SKEWED and rng.random() < SKEWED_KEY_SHARE:
+            key, mode = skewed_key
+        elif distribution == DISTRIBUTION_UNIFORM:
+            key, mode = rng.randrange(12), rng.randrange(2)
+        else:
+            key = rng.choices(range(12), weights=PITCH_CLASS_WEIGHTS)[0]
+            mode = int(rng.random() < MAJOR_SHARE)
+
+        if rng.random() < ZERO_BPM_SHARE:
+            bpm = 0.0
+        else:
+            bpm = round(min(max(rng.gauss(BPM_MEAN, BPM_STDEV), MIN_BPM), MAX_BPM), 3)
+
+        camelot, key_tonal = pitch_to_camelot(key, mode)
+        number = len(tracks_dict) + 1
+        tracks_dict[track_id] = {
+            'name': f"Track {number}",
+            'artist': f"Artist {rng.randrange(1, num_tracks // 10 + 2)}",
+            'uri': f"spotify:track:{track_id}",
+            'bpm': bpm,
+            'key': key,
+            'mode': mode,
+            'camelot': camelot,
+            'key_tonal': key_tonal,
+        }
+    return tracks_dict
@@ -8,8 +8,7 @@ from spotipy.oauth2 import SpotifyOAuth
 from utils import (pitch_to_camelot, 
                     extract_playlist_id, 
                     reorder_list, 
-                    convert_tracks_dict_to_list, 
-                    create_new_playlist)
+                    convert_tracks_dict_to_list)
 
 # Get environment variables
 # TIP: In Windows environements, you can set these in Windows > Edit the system environment variables > Environment Variables > User variables for <user>
@@ -0,0 +1,193 @@
+"""
+Tests for cache.py, run against fakeredis in place of a Redis server.
+
+    python -m pytest test_cache.py
+"""
+import threading
+import time
+
+import fakeredis
+import redis
+
+from cache import FEATURES_KEY_PREFIX, RESULT_LOCK_PREFIX, FeatureCache, ResultCache
+
+# Seconds a test waits on another thread before calling it hung
+TIMEOUT = 10
+
+OPTIONS = {'ordering': 'camelot', 'weights': None, 'optimise_ms': 0, 'max_run': 5, 'seed': 7, 'parallel': False}
+RESULT = {'uris': ['spotify:track:a', 'spotify:track:b'], 'transition_cost': None}
+
+
+def features(track_id):
+    return {'bpm': 120.0, 'key': len(track_id) % 12, 'mode': 1, 'camelot': '8B', 'key_tonal': 'C major'}
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """
+    Counts the MGET round trips and the keys they ask for.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mgets = []
+
+    def mget(self, keys, *args):
+        self.mgets.append(list(keys))
+        return super().mget(keys, *args)
+
+
+class BrokenRedis:
+    def mget(self, keys):
+        raise redis.ConnectionError("Redis is down")
+
+    def pipeline(self, transaction=True):
+        raise redis.ConnectionError("Redis is down")
+
+
+def test_lru_evicts_the_least_recently_used_track():
+    cache = FeatureCache(max_size=2)
+    cache.set_many({'a': features('a'), 'b': features('b')})
+    assert cache.get_many(['a']) == {'a': features('a')}
+    cache.set_many({'c': features('c')})
+    assert cache.get_many(['a', 'b', 'c']) == {'a': features('a'), 'c': features('c')}
+    assert cache.stats() == {'hits': 3, 'redis_hits': 0, 'misses': 1, 'lru_size': 2}
+
+
+def test_evicted_tracks_come_back_from_redis_in_one_mget():
+    client = CountingRedis()
+    cache = FeatureCache(client, max_size=2)
+    cache.set_many({track_id: features(track_id) for track_id in ('a', 'b', 'c', 'd')})
+
+    found = cache.get_many(['a', 'b', 'c', 'd', 'e'])
+    assert found == {track_id: features(track_id) for track_id in ('a', 'b', 'c', 'd')}
+    assert client.mgets == [[FEATURES_KEY_PREFIX + track_id for track_id in ('a', 'b', 'e')]]
+    assert cache.stats() == {'hits': 2, 'redis_hits': 2, 'misses': 1, 'lru_size': 2}
+
+    # What Redis served is in the LRU again
+    cache.get_many(['a', 'b'])
+    assert len(client.mgets) == 1
+    assert cache.stats()['hits'] == 4
+
+
+def test_redis_entries_expire_after_the_ttl():
+    client = fakeredis.FakeRedis()
+    FeatureCache(client, ttl=600).set_many({'a': features('a'), 'b': features('b')})
+    for track_id in ('a', 'b'):
+        assert 0 < client.ttl(FEATURES_KEY_PREFIX + track_id) <= 600
+    # A fresh instance, e.g. a cold one, finds them in Redis
+    assert FeatureCache(client).get_many(['a', 'b']) == {'a': features('a'), 'b': features('b')}
+
+
+def test_redis_errors_fall_back_to_the_lru():
+    cache = FeatureCache(BrokenRedis())
+    cache.set_many({'a': features('a')})
+    assert cache.get_many(['a', 'b']) == {'a': features('a')}
+    assert cache.stats() == {'hits': 1, 'redis_hits': 0, 'misses': 1, 'lru_size': 1}
+
+
+def test_key_is_only_given_for_seeded_sorts_of_a_known_snapshot():
+    cache = ResultCache()
+    key = cache.key('playlist', 'snapshot', OPTIONS)
+    assert key == cache.key('playlist', 'snapshot', dict(reversed(list(OPTIONS.items()))))
+    assert key != cache.key('playlist', 'snapshot', {**OPTIONS, 'seed': 8})
+    assert key != cache.key('playlist', 'other-snapshot', OPTIONS)
+    assert cache.key('playlist', 'snapshot', {**OPTIONS, 'seed': None}) is None
+    assert cache.key('playlist', None, OPTIONS) is None
+
+
+def test_concurrent_requests_in_one_instance_compute_once():
+    cache = ResultCache()
+    num_threads = 8
+    start = threading.Barrier(num_threads)
+    computed = []
+
+    def compute():
+        computed.append(1)
+        # Long enough for every other thread to join the flight
+        time.sleep(0.3)
+        return RESULT
+
+    def request():
+        start.wait(TIMEOUT)
+        return cache.get_or_compute('key', compute)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(request())) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(TIMEOUT)
+
+    assert len(computed) == 1
+    assert sorted(shared for _, shared in results) == [False] + [True] * (num_threads - 1)
+    assert all(result == RESULT for result, _ in results)
+    # A thread that only got to it after the compute finished reads the stored result instead
+    stats = cache.stats()
+    assert stats['hits'] + stats['coalesced'] == num_threads - 1 and stats['misses'] == 1
+    assert cache.get_or_compute('key', compute) == (RESULT, True)
+    assert len(computed) == 1
+
+
+def lead_in_thread(cache, compute):
+    """
+    Starts cache.get_or_compute() in a thread and returns once it holds the Redis lock.
+    """
+    locked, release = threading.Event(), threading.Event()
+
+    def held_compute():
+        locked.set()
+        release.wait(TIMEOUT)
+        return compute()
+
+    def run():
+        try:
+            cache.get_or_compute('key', held_compute)
+        except RuntimeError:
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert locked.wait(TIMEOUT)
+    return thread, release
+
+
+def test_second_instance_waits_on_the_redis_lock():
+    client = fakeredis.FakeRedis()
+    leader, follower = ResultCache(client), ResultCache(client, poll_seconds=0.01)
+    thread, release = lead_in_thread(leader, lambda: RESULT)
+    assert client.exists(RESULT_LOCK_PREFIX + 'key')
+
+    def compute():
+        raise AssertionError("the follower must not compute")
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(follower.get_or_compute('key', compute)))
+    waiter.start()
+    time.sleep(0.05)
+    assert not results
+    release.set()
+    thread.join(TIMEOUT)
+    waiter.join(TIMEOUT)
+
+    assert results == [(RESULT, True)]
+    assert follower.stats()['coalesced'] == 1
+    assert not client.exists(RESULT_LOCK_PREFIX + 'key')
+
+
+def test_second_instance_computes_when_the_lock_goes_without_a_result():
+    client = fakeredis.FakeRedis()
+    leader, follower = ResultCache(client), ResultCache(client, poll_seconds=0.01)
+
+    def fail():
+        raise RuntimeError("sort failed")
+
+    thread, release = lead_in_thread(leader, fail)
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(follower.get_or_compute('key', lambda: RESULT)))
+    waiter.start()
+    release.set()
+    thread.join(TIMEOUT)
+    waiter.join(TIMEOUT)
+
+    assert results == [(RESULT, False)]
+    assert follower.stats()['misses'] == 1
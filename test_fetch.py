@@ -0,0 +1,126 @@
+"""
+Tests for fetch.py, run against in-memory stand-ins for the Spotify clients.
+
+    python -m pytest test_fetch.py
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import FeatureCache
+from fetch import fetch_audio_features, fetch_playlist_tracks_async, NO_KEY, TrackFetcher
+
+# Seconds a fetch may take before the test calls it hung
+TIMEOUT = 10
+
+
+class FakeAsyncSpotify:
+    """
+    Serves one playlist of num_tracks tracks whose audio features come from features(track_number).
+    """
+
+    def __init__(self, num_tracks, features=None):
+        self.tracks = [{'id': f"track{i}", 'name': f"Track {i}", 'uri': f"spotify:track:track{i}",
+                        'artists': [{'name': f"Artist {i}"}]} for i in range(num_tracks)]
+        self.features = features or (lambda i: {'tempo': 120.0, 'key': i % 12, 'mode': i % 2})
+
+    def page(self, offset, limit=100):
+        return {'total': len(self.tracks), 'items': [{'track': track} for track in self.tracks[offset:offset+limit]]}
+
+    async def playlist(self, playlist_id, fields=None, additional_types=('track',)):
+        return {'name': 'Playlist', 'description': '', 'snapshot_id': 'snapshot', 'tracks': self.page(0)}
+
+    async def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0):
+        return self.page(offset, limit)
+
+    async def audio_features(self, track_ids):
+        await asyncio.sleep(0)
+        return [{'id': track_id, **self.features(int(track_id[len('track'):]))} for track_id in track_ids]
+
+
+class FakeRedisCache(FeatureCache):
+    """
+    An LRU-only FeatureCache that says it has a Redis client, so the async fetch treats its calls as blocking.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.client = object()
+
+    def get_many(self, track_ids):
+        found = {}
+        with self._lock:
+            for track_id in track_ids:
+                if track_id in self._lru:
+                    found[track_id] = self._lru[track_id]
+        return found
+
+    def set_many(self, entries):
+        self._remember(entries)
+
+
+def test_fetch_finishes_while_every_default_executor_thread_waits_on_a_fetch():
+    # The shape of main.sort_playlist_async(): a worker thread blocks on a fetch it hands back to the
+    # event loop.  With every one of those threads taken, the fetch's cache calls still need to run.
+    workers = 2
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=workers))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        sp, cache = FakeAsyncSpotify(250), FakeRedisCache()
+
+        def compute():
+            return asyncio.run_coroutine_threadsafe(
+                fetch_playlist_tracks_async(sp, 'playlist', cache), loop).result(TIMEOUT)
+
+        async def saturate():
+            return await asyncio.gather(*(loop.run_in_executor(None, compute) for _ in range(workers * 2)))
+
+        tables = asyncio.run_coroutine_threadsafe(saturate(), loop).result(TIMEOUT * 2)
+        assert [len(table) for table in tables] == [250] * workers * 2
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+
+def test_tracks_without_a_key_are_skipped():
+    sp = FakeAsyncSpotify(10, lambda i: {'tempo': 120.0, 'key': NO_KEY if i % 3 == 0 else i % 12, 'mode': 1})
+    table = asyncio.run(fetch_playlist_tracks_async(sp, 'playlist', FakeRedisCache()))
+    assert table.ids == [f"track{i}" for i in range(10) if i % 3]
+
+    class FakeSpotify:
+        def audio_features(self, track_ids):
+            return asyncio.run(sp.audio_features(track_ids))
+
+    features = fetch_audio_features(FakeSpotify(), [f"track{i}" for i in range(10)])
+    assert sorted(features) == sorted(table.ids)
+
+
+def test_failed_feature_batch_is_requested_again():
+    sp = FakeAsyncSpotify(150)
+    calls = []
+
+    class FakeSpotify:
+        def playlist(self, playlist_id, fields=None, additional_types=('track',)):
+            return asyncio.run(sp.playlist(playlist_id))
+
+        def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0):
+            return sp.page(offset, limit)
+
+        def audio_features(self, track_ids):
+            calls.append(track_ids)
+            if len(calls) == 1:
+                raise RuntimeError("audio features failed")
+            return asyncio.run(sp.audio_features(track_ids))
+
+    with TrackFetcher(FakeSpotify(), cache=None) as fetcher:
+        try:
+            fetcher.fetch('playlist')
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("the failed batch should fail the first fetch")
+        table = fetcher.fetch('playlist')
+    assert len(table) == 150
+    assert calls[0] in calls[1:]
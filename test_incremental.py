@@ -0,0 +1,165 @@
+"""
+Tests for incremental.py: the planned calls must turn the old sorted playlist into the new one, checked
+on random playlists and through resort_playlist() against an in-memory stand-in for Spotify.
+
+    python -m pytest test_incremental.py
+"""
+import random
+
+import pytest
+
+from incremental import OrderingStore, ordering_record, plan_updates, resort_playlist, rewrite_ops
+from test_utils import longest_run
+from tracks import TrackTable
+
+OPTIONS = {'ordering': 'camelot', 'weights': None, 'max_run': 3}
+
+
+def apply_ops(tracks, ops):
+    """
+    Applies planned operations to a list of track IDs the way Spotify's endpoints read them.
+    """
+    assert all(len(op[-1]) <= 100 for op in ops if op[0] != 'move')
+    tracks = list(tracks)
+    for op in ops:
+        if op[0] == 'remove':
+            tracks = [track_id for track_id in tracks if track_id not in op[1]]
+        elif op[0] == 'move':
+            _, range_start, range_length, insert_before = op
+            assert 0 <= range_start < range_start + range_length <= len(tracks)
+            assert 0 <= insert_before <= len(tracks)
+            assert not range_start < insert_before <= range_start + range_length
+            block = tracks[range_start:range_start + range_length]
+            destination = insert_before if insert_before < range_start else insert_before - range_length
+            del tracks[range_start:range_start + range_length]
+            tracks[destination:destination] = block
+        elif op[0] == 'replace':
+            tracks = list(op[1])
+        else:
+            _, position, track_ids = op
+            assert 0 <= position <= len(tracks)
+            tracks[position:position] = track_ids
+    return tracks
+
+
+def random_change(rnd, num_tracks, num_added, num_removed):
+    current = [f"track{i}" for i in range(num_tracks)]
+    kept = rnd.sample(current, num_tracks - num_removed)
+    target = kept + [f"new{i}" for i in range(num_added)]
+    rnd.shuffle(target)
+    return current, target
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_planned_updates_give_the_target(seed):
+    rnd = random.Random(seed)
+    num_tracks = rnd.randrange(0, 300)
+    current, target = random_change(rnd, num_tracks, rnd.randrange(0, 250), rnd.randrange(0, num_tracks + 1))
+    assert apply_ops(current, plan_updates(current, target)) == target
+    assert apply_ops(current, rewrite_ops(target)) == target
+
+
+def test_small_edits_take_few_calls():
+    current = [f"track{i}" for i in range(500)]
+    target = current[:100] + ['new0'] + current[100:250] + current[251:] + [current[250]]
+    ops = plan_updates(current, target)
+    assert apply_ops(current, ops) == target
+    assert len(ops) == 2
+
+
+class FakeSpotify:
+    """
+    Holds playlists as lists of track IDs and bumps a playlist's snapshot_id with every change.
+    """
+
+    def __init__(self, playlists):
+        self.playlists = {playlist_id: list(track_ids) for playlist_id, track_ids in playlists.items()}
+        self.snapshots = {playlist_id: f"{playlist_id}-0" for playlist_id in playlists}
+        self.calls = 0
+
+    def playlist(self, playlist_id, fields=None):
+        return {'snapshot_id': self.snapshots[playlist_id]}
+
+    def update(self, playlist_id, op, snapshot_id=None):
+        assert snapshot_id in (None, self.snapshots[playlist_id])
+        self.playlists[playlist_id] = apply_ops(self.playlists[playlist_id], [op])
+        self.calls += 1
+        self.snapshots[playlist_id] = f"{playlist_id}-{self.calls}"
+        return {'snapshot_id': self.snapshots[playlist_id]}
+
+    def playlist_remove_all_occurrences_of_items(self, playlist_id, items, snapshot_id=None):
+        return self.update(playlist_id, ('remove', items), snapshot_id)
+
+    def playlist_reorder_items(self, playlist_id, range_start, insert_before, range_length=1, snapshot_id=None):
+        return self.update(playlist_id, ('move', range_start, range_length, insert_before), snapshot_id)
+
+    def playlist_replace_items(self, playlist_id, items):
+        return self.update(playlist_id, ('replace', items))
+
+    def playlist_add_items(self, playlist_id, items, position=None):
+        return self.update(playlist_id, ('add', position, items))
+
+
+class FakeFetcher:
+    def __init__(self, table):
+        self.table = table
+
+    def fetch(self, playlist_id):
+        return self.table
+
+
+def track_table(track_ids, rnd):
+    table = TrackTable()
+    for track_id in track_ids:
+        table.append(track_id, track_id, 'Artist', f"spotify:track:{track_id}",
+                     rnd.uniform(80, 160), rnd.randrange(12), rnd.randrange(2))
+    return table
+
+
+def test_resort_patches_the_sorted_playlist():
+    rnd = random.Random(1)
+    previous = [f"track{i}" for i in range(200)]
+    source = [track_id for track_id in previous if track_id not in ('track5', 'track150')]
+    source += [f"new{i}" for i in range(20)]
+    sp = FakeSpotify({'source': source, 'sorted': previous})
+    store = OrderingStore()
+    store.put('user', 'source', ordering_record(OPTIONS, 'old-source', 'sorted', 'sorted-0', previous))
+
+    body, status = resort_playlist(sp, FakeFetcher(track_table(source, rnd)), 'source', OPTIONS, 'user', store)
+    assert status == 200
+    assert body['incremental'] == {'added': 20, 'removed': 2, 'calls': sp.calls}
+
+    record = store.get('user', 'source')
+    assert sp.playlists['sorted'] == record['track_ids']
+    assert sorted(record['track_ids']) == sorted(source)
+    assert record['snapshot_id'] == sp.snapshots['sorted']
+    assert record['source_snapshot_id'] == 'source-0'
+
+
+def test_resort_keeps_runs_limited():
+    rnd = random.Random(2)
+    table = track_table([f"track{i}" for i in range(120)], rnd)
+    previous = table.ids[:100]
+    sp = FakeSpotify({'source': table.ids, 'sorted': previous})
+    store = OrderingStore()
+    store.put('user', 'source', ordering_record(OPTIONS, 'old-source', 'sorted', 'sorted-0', previous))
+
+    resort_playlist(sp, FakeFetcher(table), 'source', OPTIONS, 'user', store)
+    camelots = [table.camelots[table.row_of(track_id)] for track_id in sp.playlists['sorted']]
+    assert longest_run(camelots) <= OPTIONS['max_run']
+
+
+@pytest.mark.parametrize('change', ['options', 'sorted_playlist_edited', 'too_many_changes'])
+def test_resort_falls_back_to_a_full_sort(change):
+    rnd = random.Random(3)
+    previous = [f"track{i}" for i in range(50)]
+    source = previous[:10] + [f"new{i}" for i in range(40)] if change == 'too_many_changes' else previous
+    sp = FakeSpotify({'source': source, 'sorted': previous})
+    store = OrderingStore()
+    store.put('user', 'source', ordering_record(OPTIONS, 'old-source', 'sorted', 'sorted-0', previous))
+    if change == 'sorted_playlist_edited':
+        sp.playlist_add_items('sorted', ['mine'], position=0)
+    options = {**OPTIONS, 'max_run': 5} if change == 'options' else OPTIONS
+
+    assert resort_playlist(sp, FakeFetcher(track_table(source, rnd)), 'source', options, 'user', store) is None
+    assert sp.playlists['sorted'][-50:] == previous
@@ -0,0 +1,82 @@
+"""
+Tests for jobs.py, run against an in-memory JobStore and a stand-in for the Spotify client.
+
+    python -m pytest test_jobs.py
+"""
+import jobs
+import writer
+from jobs import JobStore, STATUS_FAILED, create_job, run_job
+
+
+class FakeSpotify:
+    """
+    Serves one playlist of num_tracks tracks and records the playlists created and removed.  Adding
+    items fails when fail_add_items is set.
+    """
+
+    def __init__(self, num_tracks, fail_add_items=False):
+        self.tracks = [{'id': f"track{i}", 'name': f"Track {i}", 'uri': f"spotify:track:track{i}",
+                        'artists': [{'name': f"Artist {i}"}]} for i in range(num_tracks)]
+        self.fail_add_items = fail_add_items
+        self.created = []
+        self.unfollowed = []
+
+    def page(self, offset, limit=100):
+        return {'total': len(self.tracks), 'items': [{'track': track} for track in self.tracks[offset:offset+limit]]}
+
+    def playlist(self, playlist_id, fields=None, additional_types=('track',)):
+        if playlist_id in self.created:
+            return {'snapshot_id': 'new', 'tracks': {'total': 0}}
+        return {'name': 'Playlist', 'description': '', 'snapshot_id': 'snapshot', 'tracks': self.page(0)}
+
+    def playlist_tracks(self, playlist_id, fields=None, limit=100, offset=0):
+        return self.page(offset, limit)
+
+    def audio_features(self, track_ids):
+        return [{'id': track_id, 'tempo': 120.0, 'key': int(track_id[len('track'):]) % 12, 'mode': 1}
+                for track_id in track_ids]
+
+    def current_user(self):
+        return {'id': 'user'}
+
+    def user_playlist_create(self, user, name, public=True, collaborative=False, description=''):
+        self.created.append(f"new{len(self.created)}")
+        return {'id': self.created[-1]}
+
+    def playlist_add_items(self, playlist_id, items, position=None):
+        if self.fail_add_items:
+            raise RuntimeError("add items failed")
+        return {'snapshot_id': 'new'}
+
+    def current_user_unfollow_playlist(self, playlist_id):
+        self.unfollowed.append(playlist_id)
+
+
+def run_with(monkeypatch, sp):
+    monkeypatch.setattr(jobs, 'spotify_client', lambda access_token, prefix=None: (sp, False))
+    monkeypatch.setattr(writer, 'BATCH_RETRY_SECONDS', 0)
+    store = JobStore()
+    job_id = create_job('playlist', 'token', {}, store)
+    run_job(job_id, store=store)
+    return store.state(job_id)
+
+
+def test_failed_job_removes_its_new_playlist(monkeypatch):
+    sp = FakeSpotify(150, fail_add_items=True)
+    state = run_with(monkeypatch, sp)
+    assert state['status'] == STATUS_FAILED
+    assert sp.created == ['new0']
+    assert sp.unfollowed == ['new0']
+    assert 'new_playlist_id' not in state
+
+
+def test_job_failing_before_the_create_removes_nothing(monkeypatch):
+    sp = FakeSpotify(150)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("page fetch failed")
+
+    sp.playlist_tracks = fail
+    state = run_with(monkeypatch, sp)
+    assert state['status'] == STATUS_FAILED
+    assert sp.created == [] and sp.unfollowed == []
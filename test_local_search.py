@@ -0,0 +1,51 @@
+"""
+Property tests for local_search.improve_order() on synthetic playlists.
+
+    python -m pytest test_local_search.py
+"""
+import random
+
+import pytest
+
+from local_search import improve_order, path_cost
+from scoring import order_by_transition_cost
+from synthetic import DISTRIBUTIONS, generate_tracks_dict
+from test_utils import longest_run
+from tracks import ORDERING_BPM, ORDERING_CAMELOT, sort_track_table, TrackTable
+from utils import limit_runs
+
+BUDGET_MS = 100
+
+
+def playlist(distribution, size=300, seed=5):
+    table = TrackTable.from_tracks_dict(generate_tracks_dict(size, distribution, seed))
+    rng = random.Random(seed)
+    rows = [0] + rng.sample(range(1, len(table)), len(table) - 1)
+    return [table.camelots[row] for row in rows], [table.bpms[row] for row in rows]
+
+
+@pytest.mark.parametrize('distribution', DISTRIBUTIONS)
+@pytest.mark.parametrize('max_run', [1, 3])
+def test_improve_order_keeps_runs_limited_and_never_costs_more(distribution, max_run):
+    keys, bpms = playlist(distribution)
+    greedy = order_by_transition_cost(keys, bpms, max_run=max_run)
+    start = [greedy[position] for position in limit_runs([keys[position] for position in greedy], max_run)]
+    start_run = longest_run([keys[position] for position in start])
+
+    order, report = improve_order(keys, bpms, start, budget_ms=BUDGET_MS, max_run=max_run)
+    assert order[0] == 0 and sorted(order) == list(range(len(keys)))
+    assert longest_run([keys[position] for position in order]) <= max(max_run, start_run)
+    assert report['cost_before'] == round(path_cost(keys, bpms, start), 2)
+    assert report['cost_after'] == round(path_cost(keys, bpms, order), 2)
+    assert report['cost_after'] <= report['cost_before']
+
+
+@pytest.mark.parametrize('ordering', [ORDERING_CAMELOT, ORDERING_BPM])
+def test_sort_track_table_reports_the_cost_of_the_written_order(ordering):
+    table = TrackTable.from_tracks_dict(generate_tracks_dict(300, 'realistic', 7))
+    rows, report = sort_track_table(table, ordering, optimise_ms=BUDGET_MS, max_run=2, seed=7)
+    assert longest_run([table.camelots[row] for row in rows]) <= 2
+    assert report['cost_after'] == round(path_cost(table.camelots, table.bpms, rows), 2)
+
+    greedy_rows, _ = sort_track_table(table, ordering, max_run=2, seed=7)
+    assert report['cost_before'] == round(path_cost(table.camelots, table.bpms, greedy_rows), 2)
@@ -0,0 +1,84 @@
+"""
+Tests for partition.py on synthetic playlists.  Most cut them into clusters of CLUSTER_TRACKS tracks,
+so a few hundred tracks already give several clusters.
+
+    python -m pytest test_partition.py
+"""
+import random
+
+import pytest
+
+import partition
+from benchmark import PARALLEL_MAX_QUALITY_LOSS
+from local_search import path_cost
+from partition import cluster_tracks, order_partitioned, stitch_segments
+from scoring import DEFAULT_WEIGHTS, order_by_transition_cost
+from synthetic import DISTRIBUTIONS, generate_tracks_dict
+from test_utils import longest_run
+from tracks import TrackTable
+from utils import limit_runs
+
+CLUSTER_TRACKS = 200
+NUM_TRACKS = 1200
+
+
+@pytest.fixture
+def small_clusters(monkeypatch):
+    monkeypatch.setattr(partition, 'CLUSTER_TRACKS', CLUSTER_TRACKS)
+
+
+def playlist(distribution, size=NUM_TRACKS, seed=3):
+    table = TrackTable.from_tracks_dict(generate_tracks_dict(size, distribution, seed))
+    rng = random.Random(seed)
+    rows = [0] + rng.sample(range(1, len(table)), len(table) - 1)
+    return [table.camelots[row] for row in rows], [table.bpms[row] for row in rows]
+
+
+def run_limited(keys, order, max_run):
+    return [order[position] for position in limit_runs([keys[position] for position in order], max_run)]
+
+
+def test_clusters_cover_every_track_once(small_clusters):
+    keys, bpms = playlist('realistic')
+    clusters = cluster_tracks(keys, bpms, NUM_TRACKS // CLUSTER_TRACKS)
+    assert len(clusters) == NUM_TRACKS // CLUSTER_TRACKS
+    assert sorted(position for cluster in clusters for position in cluster) == list(range(NUM_TRACKS))
+    assert all(cluster == sorted(cluster) for cluster in clusters)
+
+
+@pytest.mark.parametrize('distribution', DISTRIBUTIONS)
+@pytest.mark.parametrize('max_run', [2, 5])
+def test_partitioned_order_is_a_run_limited_permutation(small_clusters, distribution, max_run):
+    keys, bpms = playlist(distribution)
+    order = order_partitioned(keys, bpms, workers=1, max_run=max_run)
+    assert order[0] == 0 and sorted(order) == list(range(len(keys)))
+
+    single = run_limited(keys, order_by_transition_cost(keys, bpms, max_run=max_run), max_run)
+    order = run_limited(keys, order, max_run)
+    assert order[0] == 0 and sorted(order) == list(range(len(keys)))
+    # Whatever the single-process ordering can avoid, the partitioned one avoids too
+    assert longest_run([keys[position] for position in order]) <= max(
+        max_run, longest_run([keys[position] for position in single]))
+
+
+@pytest.mark.parametrize('distribution', DISTRIBUTIONS)
+def test_partitioned_order_costs_about_as_much_as_the_single_process_one(distribution):
+    # Small clusters lose more at their joins, so this one keeps the real size: the smallest playlist
+    # that still splits, into two clusters
+    keys, bpms = playlist(distribution, size=2 * partition.CLUSTER_TRACKS)
+    single = run_limited(keys, order_by_transition_cost(keys, bpms), 5)
+    partitioned = run_limited(keys, order_partitioned(keys, bpms, workers=1), 5)
+    assert path_cost(keys, bpms, partitioned) <= (1 + PARALLEL_MAX_QUALITY_LOSS) * path_cost(keys, bpms, single)
+
+
+def test_worker_processes_give_the_same_order(small_clusters):
+    keys, bpms = playlist('realistic', size=600)
+    assert order_partitioned(keys, bpms, workers=2) == order_partitioned(keys, bpms, workers=1)
+
+
+def test_stitching_plays_a_segment_backwards_when_that_joins_better():
+    # Bucket 0 is 1A; the second segment ends on the same key and tempo the first one stops on
+    keys = [0, 0, 14, 16, 0]
+    bpms = [120.0, 120.0, 90.0, 150.0, 120.0]
+    walk = stitch_segments([[0, 1], [2, 3, 4]], keys, bpms, DEFAULT_WEIGHTS)
+    assert walk == [0, 1, 4, 3, 2]
@@ -0,0 +1,133 @@
+"""
+Tests for scheduler.py, run on a fake clock so no test waits for real time to pass.
+
+    python -m pytest test_scheduler.py
+"""
+import threading
+
+import pytest
+
+from scheduler import DEFAULT_RETRY_AFTER, RATE_DECREASE, RATE_INCREASE, READ, WRITE, RequestScheduler
+
+# Seconds a test waits on another thread before calling it hung
+TIMEOUT = 10
+
+
+class FakeClock:
+    """
+    A clock that only moves when told to.  With auto_advance, sleep() moves it on by the time slept,
+    at least a microsecond like a real sleep; otherwise sleep() blocks until another thread advances
+    the clock far enough.
+    """
+
+    def __init__(self, auto_advance=True):
+        self.now = 0.0
+        self.auto_advance = auto_advance
+        self._changed = threading.Condition()
+
+    def __call__(self):
+        with self._changed:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._changed:
+            if self.auto_advance:
+                self.now += max(seconds, 1e-6)
+                return
+            until = self.now + seconds
+            assert self._changed.wait_for(lambda: self.now >= until, TIMEOUT)
+
+    def advance(self, seconds):
+        with self._changed:
+            self.now += seconds
+            self._changed.notify_all()
+
+
+def scheduler_on(clock, max_rate):
+    return RequestScheduler(max_rate, clock=clock, sleep=clock.sleep)
+
+
+def test_bucket_allows_a_burst_then_the_rate():
+    clock = FakeClock()
+    scheduler = scheduler_on(clock, max_rate=10)
+    for _ in range(10):
+        scheduler.acquire()
+    assert clock.now == 0
+
+    for _ in range(20):
+        scheduler.acquire()
+    assert clock.now == pytest.approx(2.0)
+    stats = scheduler.stats()
+    assert stats['requests'] == 30 and stats['throttled'] == 20
+    assert stats['wait_ms_total'] == pytest.approx(2000, abs=1)
+
+
+def test_429_cuts_the_rate_and_pauses_every_request():
+    clock = FakeClock()
+    scheduler = scheduler_on(clock, max_rate=100)
+    # A burst of 100, then another 100 at 100 per second: 200 sent in the last second
+    for _ in range(200):
+        scheduler.acquire()
+    assert clock.now == pytest.approx(1.0)
+
+    assert scheduler.rate_limited('3') == 3.0
+    assert scheduler.stats()['rate'] == 100 * RATE_DECREASE
+    # Requests that were in flight come back 429 as well, without cutting the rate again
+    assert scheduler.rate_limited(None) == DEFAULT_RETRY_AFTER
+    assert scheduler.stats()['rate'] == 100 * RATE_DECREASE
+
+    scheduler.acquire(WRITE)
+    assert clock.now >= 4.0
+    # The rate only grows back once the pause is over
+    assert scheduler.stats()['rate'] == pytest.approx(100 * RATE_DECREASE, abs=0.1)
+    clock.advance(5)
+    assert scheduler.stats()['rate'] == pytest.approx(100 * RATE_DECREASE + 5 * RATE_INCREASE, abs=0.1)
+    assert scheduler.stats()['rate_limited'] == 2
+
+
+def test_429_cuts_to_the_rate_actually_sent():
+    clock = FakeClock()
+    scheduler = scheduler_on(clock, max_rate=100)
+    for i in range(20):
+        if i:
+            clock.advance(0.1)
+        scheduler.acquire()
+    # 20 requests over 1.9 seconds is about 10 per second, well below the bucket's rate
+    scheduler.rate_limited('1')
+    assert scheduler.stats()['rate'] == pytest.approx(20 / 1.9 * RATE_DECREASE, abs=0.1)
+
+
+def wait_for_queue(scheduler, priority):
+    for _ in range(TIMEOUT * 1000):
+        if scheduler.stats()['queue_depth'][priority]:
+            return
+        threading.Event().wait(0.001)
+    raise AssertionError(f"no {priority} request queued")
+
+
+def test_reads_go_before_writes_that_waited_longer():
+    clock = FakeClock(auto_advance=False)
+    scheduler = scheduler_on(clock, max_rate=10)
+    for _ in range(10):
+        scheduler.acquire()
+
+    served = []
+
+    def request(priority):
+        scheduler.acquire(priority)
+        served.append(priority)
+
+    writer = threading.Thread(target=request, args=(WRITE,))
+    writer.start()
+    wait_for_queue(scheduler, WRITE)
+    reader = threading.Thread(target=request, args=(READ,))
+    reader.start()
+    wait_for_queue(scheduler, READ)
+
+    # One token for the two of them: the read gets it, and the write waits for the next one
+    clock.advance(0.1)
+    reader.join(TIMEOUT)
+    assert served == [READ]
+    clock.advance(0.2)
+    writer.join(TIMEOUT)
+    assert served == [READ, WRITE]
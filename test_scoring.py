@@ -0,0 +1,43 @@
+"""
+Tests for scoring.py: the request weights and the BPM-aware ordering.
+
+    python -m pytest test_scoring.py
+"""
+import random
+
+import pytest
+
+from scoring import DEFAULT_WEIGHTS, order_by_transition_cost, resolve_weights
+from synthetic import DISTRIBUTIONS, generate_tracks_dict
+from test_utils import longest_run
+from tracks import TrackTable
+from utils import limit_runs, shuffled_indices
+
+
+def test_resolve_weights_fills_in_the_defaults():
+    assert resolve_weights({'tempo': 1}) == {**DEFAULT_WEIGHTS, 'tempo': 1.0}
+
+
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), float('-inf'), -1, True, '1'])
+def test_resolve_weights_rejects_weights_that_are_not_finite_non_negative_numbers(value):
+    with pytest.raises(ValueError):
+        resolve_weights({'harmonic': value})
+
+
+@pytest.mark.parametrize('distribution', DISTRIBUTIONS)
+@pytest.mark.parametrize('max_run', [1, 2, 5])
+def test_order_by_transition_cost_leaves_nothing_for_the_run_limiter(distribution, max_run):
+    table = TrackTable.from_tracks_dict(generate_tracks_dict(600, distribution, seed=3))
+    rows = shuffled_indices(len(table), random.Random(3))
+    keys = [table.camelots[row] for row in rows]
+    bpms = [table.bpms[row] for row in rows]
+
+    order = order_by_transition_cost(keys, bpms, max_run=max_run)
+    assert order[0] == 0 and sorted(order) == list(range(len(keys)))
+    ordered_keys = [keys[position] for position in order]
+    if longest_run(ordered_keys) <= max_run:
+        assert limit_runs(ordered_keys, max_run) == list(range(len(keys)))
+    else:
+        # Only a key holding too many of the tracks to spread out may run long
+        biggest = max(ordered_keys.count(key) for key in set(ordered_keys))
+        assert biggest > max_run * (len(keys) - biggest + 1)
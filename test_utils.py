@@ -0,0 +1,71 @@
+"""
+Property tests for utils.limit_runs(), checked against a brute-force search over every arrangement
+of small random key sequences.
+
+    python -m pytest test_utils.py
+"""
+import itertools
+import random
+
+import pytest
+
+from utils import limit_runs
+
+# Longest key sequence tried; brute force looks at up to (MAX_KEYS - 1)! arrangements of each
+MAX_KEYS = 8
+CASES_PER_LENGTH = 200
+
+
+def longest_run(keys):
+    longest, run, previous = 0, 0, object()
+    for key in keys:
+        run = run + 1 if key == previous else 1
+        previous = key
+        longest = max(longest, run)
+    return longest
+
+
+def feasible(keys, max_run):
+    """
+    Returns:
+        bool: Whether any arrangement keeping the first track first has no run longer than max_run.
+    """
+    if not keys:
+        return True
+    return any(longest_run((keys[0],) + rest) <= max_run for rest in set(itertools.permutations(keys[1:])))
+
+
+def random_cases(seed):
+    rng = random.Random(seed)
+    for length in range(MAX_KEYS + 1):
+        for _ in range(CASES_PER_LENGTH):
+            num_keys = rng.randint(1, 4)
+            yield [rng.randrange(num_keys) for _ in range(length)], rng.randint(1, 3)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_limit_runs_is_a_permutation_keeping_the_first_track(seed):
+    for keys, max_run in random_cases(seed):
+        order = limit_runs(keys, max_run)
+        assert sorted(order) == list(range(len(keys)))
+        if keys:
+            assert order[0] == 0
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_limit_runs_leaves_no_long_run_when_one_can_be_avoided(seed):
+    for keys, max_run in random_cases(seed):
+        if feasible(tuple(keys), max_run):
+            ordered = [keys[position] for position in limit_runs(keys, max_run)]
+            assert longest_run(ordered) <= max_run, (keys, max_run, ordered)
+
+
+def test_limit_runs_keeps_an_order_that_is_already_legal():
+    keys = ['8A', '8A', '9A', '8A', '10B', '10B']
+    assert limit_runs(keys, 2) == list(range(len(keys)))
+
+
+def test_limit_runs_spreads_a_long_run():
+    keys = ['8A'] * 6 + ['9A', '10A', '11A']
+    ordered = [keys[position] for position in limit_runs(keys, 2)]
+    assert longest_run(ordered) <= 2
@@ -0,0 +1,182 @@
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Stage and Spotify call currently running on this thread, so response hooks know where to book their bytes
+_active = threading.local()
+
+
+class Trace:
+    """
+    Per-request record of where the time went.
+
+    Every stage (user, fetch_pages, audio_features, convert, shuffle, reorder, optimise, max_five,
+    create, add_items) collects its wall time, the time spent inside it, the number of Spotify calls,
+    retries, response bytes and tracks handled.  Stages that run concurrently across worker threads, like the
+    page and audio-feature fetches, report wall_ms from their first start to their last end and busy_ms
+    as the sum of all their calls.  Safe to use from several threads.
+    """
+
+    def __init__(self, name, **fields):
+        """
+        Args:
+            name (str): What is being traced, e.g. the Cloud Function's name.
+            **fields: Extra fields to include in the log line, e.g. the playlist id.
+        """
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, tracks=None):
+        """
+        Times a block of code as (part of) a stage.
+
+        Args:
+            name (str): The stage's name.
+            tracks (int): Number of tracks the stage handles, if known.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, started, time.perf_counter(), tracks=tracks or 0)
+
+    def timed(self, stage, func):
+        """
+        Wraps a Spotipy client method so every call to it is booked on a stage.
+
+        Args:
+            stage (str): The stage's name.
+            func (callable): The Spotipy client method.
+
+        Returns:
+            callable: The wrapped method.  Retries below it are booked by the response hooks, see attach().
+        """
+        def call(*args, **kwargs):
+            _active.stage = (self, stage)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _active.stage = None
+                self._record(stage, started, time.perf_counter(), calls=1)
+        return call
+
+    def record_call(self, stage, started, ended, retries=0, bytes=0):
+        """
+        Books one Spotify call made outside trace.timed(), e.g. by async_spotify.AsyncSpotify.
+
+        Args:
+            stage (str): The stage's name.
+            started (float): time.perf_counter() when the call started.
+            ended (float): time.perf_counter() when it returned.
+            retries (int): Times it was retried.
+            bytes (int): Size of the response body.
+        """
+        self._record(stage, started, ended, calls=1, retries=retries, bytes=bytes)
+
+    def add(self, stage, **counters):
+        """
+        Adds to a stage's counters, e.g. trace.add('audio_features', tracks=100).
+        """
+        with self._lock:
+            stats = self._stats(stage)
+            for counter, value in counters.items():
+                stats[counter] = stats.get(counter, 0) + value
+
+    def attach(self, sp):
+        """
+        Counts response bytes and the retries urllib3 does on its own for the Spotify calls made
+        through trace.timed().  The 429s spotify_client.ScheduledAdapter sends again are booked by
+        record_retry().
+
+        Args:
+            sp (spotipy.Spotify): The Spotipy client; only its requests session is touched.
+        """
+        session = getattr(sp, '_session', None)
+        hooks = getattr(session, 'hooks', None)
+        if hooks is not None and _record_response not in hooks['response']:
+            hooks['response'].append(_record_response)
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: Total wall time and the stats of every stage, in the order the stages started.
+        """
+        with self._lock:
+            stages = {
+                name: {
+                    'wall_ms': round((stats.pop('_end') - stats.pop('_start')) * 1000, 1),
+                    'busy_ms': round(stats.pop('_busy') * 1000, 1),
+                    **stats,
+                }
+                for name, stats in ((name, dict(stats)) for name, stats in self.stages.items())
+            }
+        return {
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'stages': stages,
+        }
+
+    def log(self, **fields):
+        """
+        Prints the trace as one structured JSON log line, which Cloud Logging turns into a jsonPayload.
+
+        Args:
+            **fields: Extra fields only known at the end, e.g. connection pool counters.
+        """
+        print(json.dumps({
+            'severity': 'INFO',
+            'message': f"{self.name} timings",
+            'trace_id': self.trace_id,
+            **self.fields,
+            **fields,
+            **self.to_dict(),
+        }))
+
+    def _stats(self, stage):
+        stats = self.stages.get(stage)
+        if stats is None:
+            now = time.perf_counter()
+            stats = self.stages[stage] = {
+                '_start': now, '_end': now, '_busy': 0.0,
+                'calls': 0, 'retries': 0, 'bytes': 0, 'tracks': 0,
+            }
+        return stats
+
+    def _record(self, stage, started, ended, **counters):
+        with self._lock:
+            stats = self._stats(stage)
+            stats['_start'] = min(stats['_start'], started)
+            stats['_end'] = max(stats['_end'], ended)
+            stats['_busy'] += ended - started
+            for counter, value in counters.items():
+                stats[counter] += value
+
+
+def record_retry(response):
+    """
+    Books a response that is about to be sent again, e.g. a 429 spotify_client.ScheduledAdapter retries
+    once the scheduler's pause is over, on the stage running on this thread.  The session's response hook
+    only ever sees the last response of a call.
+    """
+    active = getattr(_active, 'stage', None)
+    if active is None:
+        return
+    _record_response(response)
+    trace, stage = active
+    trace.add(stage, retries=1)
+
+
+def _record_response(response, *args, **kwargs):
+    active = getattr(_active, 'stage', None)
+    if active is None:
+        return
+    trace, stage = active
+    retries = getattr(getattr(response.raw, 'retries', None), 'history', ())
+    trace.add(stage, bytes=len(response.content), retries=len(retries))
@@ -0,0 +1,184 @@
+import random
+import sys
+from array import array
+
+from tracing import Trace
+from utils import (camelot_by_pitch,
+                    camelot_neighbour_ranks,
+                    order_camelot_indices,
+                    limit_runs,
+                    MAX_RUN_LENGTH,
+                    shuffled_indices)
+
+
+class TrackTable:
+    """
+    Compact, array-backed store of a playlist's tracks.
+
+    Every track is a row, and each attribute lives in its own parallel array: int8 key/mode,
+    a small-int Camelot bucket index (0-23, see utils.camelot_codes) and float32 BPM, plus
+    interned strings for ids, uris, names and artists.  The sorting passes only ever handle row
+    indices, and responses only need the uris of the sorted rows.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.uris = []
+        self.names = []
+        self.artists = []
+        self.keys = array('b')
+        self.modes = array('b')
+        self.camelots = array('B')
+        self.bpms = array('f')
+        self._rows = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, track_id):
+        return track_id in self._rows
+
+    def append(self, track_id, name, artist, uri, bpm, key, mode):
+        """
+        Adds a track to the table.
+
+        Args:
+            track_id (str): Spotify track ID.
+            name (str): Track name.
+            artist (str): Name of the first artist.
+            uri (str): Spotify track URI.
+            bpm (float): Tempo reported by Spotify.
+            key (int): Pitch Class notation (0-11).
+            mode (int): 0 for minor, 1 for major.
+
+        Returns:
+            int: The row of the new track.
+
+        Raises:
+            ValueError: If the key or mode is out of range, e.g. Spotify's -1 for tracks without a detectable
+                key, which fetch.has_audio_features() filters out.
+        """
+        # A negative key would index camelot_by_pitch from the end and quietly give the wrong Camelot code
+        if not 0 <= key < 12 or mode not in (0, 1):
+            raise ValueError(f"Track {track_id} has no usable key: key {key}, mode {mode}")
+        row = len(self.ids)
+        self._rows[track_id] = row
+        self.ids.append(sys.intern(track_id))
+        self.uris.append(sys.intern(uri))
+        self.names.append(name)
+        self.artists.append(sys.intern(artist))
+        self.keys.append(key)
+        self.modes.append(mode)
+        self.camelots.append(camelot_by_pitch[key * 2 + mode])
+        self.bpms.append(bpm)
+        return row
+
+    def row_of(self, track_id):
+        return self._rows[track_id]
+
+    @classmethod
+    def from_tracks_dict(cls, tracks_dict):
+        """
+        Builds a table from the track ID -> metadata dict used by convert_tracks_dict_to_list().
+        """
+        table = cls()
+        for track_id, track in tracks_dict.items():
+            table.append(track_id, track['name'], track['artist'], track['uri'],
+                         track['bpm'], track['key'], track['mode'])
+        return table
+
+
+# Orderings selectable through the request JSON
+ORDERING_CAMELOT = 'camelot'
+ORDERING_BPM = 'bpm'
+ORDERINGS = (ORDERING_CAMELOT, ORDERING_BPM)
+
+# Playlists shorter than this are always ordered in one piece by the parallel mode: below it the
+# partitioned order loses too much smoothness (up to ~13% at 10,000 tracks) to be worth the time saved
+PARALLEL_MIN_TRACKS = 20000
+
+
+def sort_track_table(table, ordering=ORDERING_CAMELOT, weights=None, optimise_ms=0, max_run=MAX_RUN_LENGTH,
+                     seed=None, parallel=False, trace=None):
+    """
+    Shuffles (keeping the first track), orders and run-limits a table's rows.
+    The default ordering is the row-index equivalent of shuffle_unsorted_tracks_list(), reorder_list()
+    and max_five(); ORDERING_BPM also takes the tempo into account, see scoring.order_by_transition_cost().
+    With optimise_ms, the run-limited order is then improved by local_search.improve_order(), which keeps
+    it run-limited.
+    With parallel, ORDERING_BPM splits playlists of PARALLEL_MIN_TRACKS or more into clusters
+    ordered across the instance's cores, see partition.order_partitioned().
+
+    Args:
+        table (TrackTable): The playlist's tracks.
+        ordering (str): One of ORDERINGS.
+        weights (dict): Optional harmonic/tempo weights, used by ORDERING_BPM and the local search.
+        optimise_ms (int): Time budget for the local search; 0 skips it.
+        max_run (int): Longest run of tracks sharing a Camelot key, see utils.limit_runs().
+        seed (int): Seed for the shuffle, so the same table and options give the same order every time
+            (as long as optimise_ms is 0, the local search stops on the clock); None uses the global random.
+        parallel (bool): Order large playlists in parallel, trading a little smoothness for time.  The
+            Camelot ordering takes a few ms even for 50,000 tracks, so it always runs in one piece.
+        trace (Trace): Optional trace to book the shuffle, reorder, optimise and max_five stages on.
+
+    Returns:
+        tuple: (rows, report) where rows are the row indices in the order the tracks should be played
+        and report is the local search's cost report, or None when it didn't run.  Its cost_before is the
+        cost of the run-limited greedy order and cost_after the cost of the returned one.
+    """
+    trace = trace or Trace('sort')
+    num_tracks = len(table)
+    camelots = table.camelots
+
+    with trace.stage('shuffle', num_tracks):
+        rows = shuffled_indices(num_tracks, random if seed is None else random.Random(seed))
+        keys = [camelots[row] for row in rows]
+        bpms = [table.bpms[row] for row in rows]
+
+    with trace.stage('reorder', num_tracks):
+        if ordering == ORDERING_BPM and parallel and num_tracks >= PARALLEL_MIN_TRACKS:
+            from partition import order_partitioned
+            order = order_partitioned(keys, bpms, weights, max_run=max_run)
+        elif ordering == ORDERING_BPM:
+            # NumPy is only imported by the orderings that need it, which keeps cold starts short
+            from scoring import order_by_transition_cost
+            order = order_by_transition_cost(keys, bpms, weights, max_run)
+        elif ordering == ORDERING_CAMELOT:
+            order = order_camelot_indices(keys, camelot_neighbour_ranks)
+        else:
+            raise ValueError(f"Unknown ordering '{ordering}'")
+
+    with trace.stage('max_five', num_tracks):
+        order = [order[position] for position in limit_runs([keys[position] for position in order], max_run)]
+
+    report = None
+    if optimise_ms > 0:
+        from local_search import improve_order
+        with trace.stage('optimise', num_tracks):
+            order, report = improve_order(keys, bpms, order, weights, optimise_ms, max_run)
+
+    return [rows[position] for position in order], report
+
+
+def sort_result(track_table, options, trace=None):
+    """
+    Sorts a playlist's tracks into what cache.ResultCache stores for it.
+
+    Args:
+        track_table (TrackTable): The playlist's tracks.
+        options (dict): Sorting options, as returned by main.parse_sort_options().
+        trace (Trace): Trace to book the sort stages on.
+
+    Returns:
+        dict: uris, the track URIs in play order, and transition_cost, the local search report or None.
+    """
+    if len(track_table) == 0:
+        return {'uris': [], 'transition_cost': None}
+
+    # Shuffle (except the first song), assess the similarity between all tracks and then reorder them.
+    # This works on row indices into the track table, so no per-track dicts are built.
+    sorted_rows, optimise_report = sort_track_table(track_table, **options, trace=trace)
+    if optimise_report:
+        print(f"Local search: {optimise_report}")
+
+    return {'uris': [track_table.uris[row] for row in sorted_rows], 'transition_cost': optimise_report}
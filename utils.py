@@ -1,5 +1,8 @@
-import html
 import random
+from collections import deque
+
+# Longest run of tracks sharing a Camelot value that max_five() allows
+MAX_RUN_LENGTH = 5
 
 def extract_playlist_id(url):
     """
@@ -32,30 +35,80 @@ def pitch_to_camelot(pcn, major):
     
     return camelot, tonal
 
+def camelot_index_tables(camelot_similarities):
+    """
+    Precomputes the integer-indexed form of a Camelot similarity table.
+
+    Args:
+        camelot_similarities (dict): Camelot code -> ranked list of similar Camelot codes.
+
+    Returns:
+        tuple: (codes, code_index, neighbour_ranks) where codes is the list of Camelot codes,
+        code_index maps each code to its bucket index and neighbour_ranks holds, per bucket,
+        the tuple of similar bucket indices in priority order (duplicates dropped, as list.index would).
+    """
+    codes = list(camelot_similarities)
+    code_index = {code: i for i, code in enumerate(codes)}
+    neighbour_ranks = tuple(
+        tuple(dict.fromkeys(code_index[similar] for similar in camelot_similarities[code]))
+        for code in codes
+    )
+    return codes, code_index, neighbour_ranks
+
+
+def order_camelot_indices(keys, neighbour_ranks):
+    """
+    The ordering engine behind reorder_list().  Tracks are dropped into one FIFO bucket per
+    Camelot key and per-key counts are kept up to date as tracks are taken, so each pick only
+    looks at the buckets rather than rescanning every remaining track.
+
+    Args:
+        keys (list): Camelot bucket index of each track, in (shuffled) playlist order.
+        neighbour_ranks (tuple): As returned by camelot_index_tables().
+
+    Returns:
+        list: Positions into keys, in the order the tracks should be played.
+    """
+    num_tracks = len(keys)
+    if num_tracks == 0:
+        return []
+
+    buckets = [deque() for _ in neighbour_ranks]
+    for position in range(1, num_tracks):
+        buckets[keys[position]].append(position)
+    counts = [len(bucket) for bucket in buckets]
+
+    order = [0]
+    current_key = keys[0]
+    for _ in range(num_tracks - 1):
+        for key in neighbour_ranks[current_key]:
+            if counts[key]:
+                break
+        else:
+            # No similar key left - jump to the most "connected" remaining key.  Ties go to the
+            # key whose next track comes first in the playlist, exactly like max() over the list.
+            key, best_score, best_position = None, -1, num_tracks
+            for candidate, count in enumerate(counts):
+                if not count:
+                    continue
+                score = count * sum(counts[similar] for similar in neighbour_ranks[candidate])
+                front = buckets[candidate][0]
+                if score > best_score or (score == best_score and front < best_position):
+                    key, best_score, best_position = candidate, score, front
+
+        order.append(buckets[key].popleft())
+        counts[key] -= 1
+        current_key = key
+    return order
+
+
 # The special sauce algorithm
 def reorder_list(unsorted_tracks_list, camelot_similarities):
-    try: 
-        reordered_list = []
-        remaining_tracks = unsorted_tracks_list.copy()
-        current_track = remaining_tracks.pop(0)
-        reordered_list.append(current_track)
-        while remaining_tracks:
-            similarities = camelot_similarities[current_track['camelot']]
-            similar_tracks = [track for track in remaining_tracks if track['camelot'] in similarities]
-            if similar_tracks:
-                similar_tracks.sort(key=lambda track: similarities.index(track['camelot']))
-                current_track = similar_tracks.pop(0)
-                reordered_list.append(current_track)
-                remaining_tracks.remove(current_track)
-            else:
-                remaining_similarities = {track['camelot']: 0 for track in remaining_tracks}
-                for t1 in remaining_tracks:
-                    for t2 in remaining_tracks:
-                        if t2['camelot'] in camelot_similarities[t1['camelot']]:
-                            remaining_similarities[t1['camelot']] += 1
-                current_track = max(remaining_tracks, key=lambda track: remaining_similarities[track['camelot']])
-                reordered_list.append(current_track)
-                remaining_tracks.remove(current_track)
+    try:
+        codes, code_index, neighbour_ranks = camelot_index_tables(camelot_similarities)
+        keys = [code_index[track['camelot']] for track in unsorted_tracks_list]
+        order = order_camelot_indices(keys, neighbour_ranks)
+        reordered_list = [unsorted_tracks_list[position] for position in order]
         return max_five(reordered_list)
     except Exception as e:
         print(f"An error occurred sorting the tracks list: {e}")
@@ -65,42 +118,89 @@ def reorder_list(unsorted_tracks_list, camelot_similarities):
 # TODO - get audio_analysis key_confidence first and presort using confidence intervals to improve overall groups
 def max_five(lst):
     try:
-        # Initialize the list of unique camelot values and a counter
-        camelot_list = [lst[0]["camelot"]]
-        camelot_counter = 1
-
-        # Iterate through the list starting from the second element
-        for i in range(1, len(lst)):
-            # Check if the current camelot value is the same as the previous one
-            if lst[i]["camelot"] == lst[i-1]["camelot"]:
-                # Increment the counter and append the camelot value to the list if it is not already present
-                if lst[i]["camelot"] not in camelot_list:
-                    camelot_list.append(lst[i]["camelot"])
-                camelot_counter += 1
-            else:
-                # Reset the counter if the current camelot value is different from the previous one
-                camelot_counter = 1
-
-            # Check if we have 6 consecutive dictionaries with the same camelot value
-            if camelot_counter == 6:
-                # Get the index of the last dictionary with the same camelot value
-                last_index = i
-                while last_index < len(lst)-1 and lst[last_index+1]["camelot"] == lst[i]["camelot"]:
-                    last_index += 1
-
-                # Move the rest of the dictionaries with the same camelot value to the end of the list
-                rest = lst[i:last_index+1]
-                lst = lst[:i] + lst[last_index+1:] + rest
-
-                # Reset the camelot list and counter
-                camelot_list = []
-                camelot_counter = 1
-
-        return lst
+        order = limit_runs([track["camelot"] for track in lst], MAX_RUN_LENGTH)
+        return [lst[position] for position in order]
     except Exception as e:
         print(f"An error occurred sorting the tracks list: {e}")
 
 
+def limit_runs(keys, max_run=MAX_RUN_LENGTH):
+    """
+    Single-pass run limiter: no more than max_run tracks in a row share a Camelot value, whenever
+    that is possible at all.
+
+    Tracks that would make a run too long are set aside in a deque per key and put back as soon as a
+    different key makes that legal again, so the excess of a long run ends up spread just after it
+    rather than dumped at the end.  If a key is still left over once every track has been placed, it
+    is merged into the legal gaps of the finished list, filling each gap up to max_run.  The first
+    track never moves.  Runs only exceed max_run if one key outnumbers what the other tracks can
+    separate.
+
+    Args:
+        keys (list): Camelot value (code or bucket index) of each track, in play order.
+        max_run (int): Longest allowed run of the same Camelot value.
+
+    Returns:
+        list: Positions into keys in the new play order.
+    """
+    order = []
+    pending = {}
+    run_key, run_len = None, 0
+
+    for position, key in enumerate(keys):
+        if key == run_key and run_len >= max_run:
+            pending.setdefault(key, deque()).append(position)
+            continue
+
+        order.append(position)
+        if key == run_key:
+            run_len += 1
+        else:
+            run_key, run_len = key, 1
+
+        # Put set-aside tracks back while their key differs from the current run, biggest backlog first
+        while pending:
+            candidates = [k for k in pending if k != run_key]
+            if not candidates:
+                break
+            run_key = max(candidates, key=lambda k: len(pending[k]))
+            backlog = pending[run_key]
+            run_len = min(max_run, len(backlog))
+            for _ in range(run_len):
+                order.append(backlog.popleft())
+            if not backlog:
+                del pending[run_key]
+
+    if not pending:
+        return order
+
+    # Only the key of the final run can still have tracks left; merge them into the legal gaps
+    (key, backlog), = pending.items()
+    merged = []
+    run_key, run_len = None, 0
+    for i, position in enumerate(order):
+        if i > 0 and backlog and keys[position] != key:
+            room = max_run - run_len if run_key == key else max_run
+            if room > 0:
+                if run_key != key:
+                    run_key, run_len = key, 0
+                for _ in range(min(room, len(backlog))):
+                    merged.append(backlog.popleft())
+                    run_len += 1
+        merged.append(position)
+        if keys[position] == run_key:
+            run_len += 1
+        else:
+            run_key, run_len = keys[position], 1
+
+    # The gap after the last track, then whatever is left has no legal place at all
+    if backlog and merged:
+        room = max_run - run_len if run_key == key else max_run
+        for _ in range(min(max(room, 0), len(backlog))):
+            merged.append(backlog.popleft())
+    merged.extend(backlog)
+    return merged
+
 
 def convert_tracks_dict_to_list(tracks_dict):
     new_list = []
@@ -114,30 +214,39 @@ def convert_tracks_dict_to_list(tracks_dict):
     return new_list
 
 
-def shuffle_unsorted_tracks_list(tracks_list):
-    # Fisher-Yates algorithm, first index is excluded to preserve first song in original playlist
+def shuffle_unsorted_tracks_list(tracks_list, rng=random):
+    # Fisher-Yates algorithm, first index is excluded to preserve first song in original playlist.
+    # Pass a random.Random(seed) as rng to get the same shuffle every time
     n = len(tracks_list)
     for i in range(n - 1, 1, -1):
-        j = random.randint(1, i)
+        j = rng.randint(1, i)
         tracks_list[i], tracks_list[j] = tracks_list[j], tracks_list[i]
     return tracks_list
 
 
-def create_new_playlist(user, sp, playlist_id, sorted_track_uris_list):
+def shuffled_indices(n, rng=random):
     """
-    Get the current playlist name and description
-    Note the API returns fields in alphabetical order, not according to the order of fields passed as arguments
+    Index-based form of shuffle_unsorted_tracks_list(), drawing the same random numbers.
+
+    Args:
+        n (int): Number of tracks.
+        rng (random.Random): Source of the random numbers; the global one by default.
+
+    Returns:
+        list: A permutation of range(n) that keeps 0 first.
+    """
+    indices = list(range(n))
+    for i in range(n - 1, 1, -1):
+        j = rng.randint(1, i)
+        indices[i], indices[j] = indices[j], indices[i]
+    return indices
+
+
+def sorted_playlist_name(playlist_name):
+    """
+    Builds the name of the sorted copy of a playlist, keeping it within Spotify's 100 char limit.
     """
-    try:
-        # playlist_desc, playlist_name = sp.playlist(playlist_id, fields="description,name").values()
-        pnd = sp.playlist(playlist_id, fields="description,name")
-        playlist_desc = pnd['description']
-        playlist_name = pnd['name']
-    except Exception as e:
-        print(f"Error fetching playlist information via the playlist id: {e}")
-    
     new_playlist_name = f"{playlist_name} (sorted by Better Playlists)"
-    new_playlist_desc = html.unescape(playlist_desc)
 
     # Some logic to handle cases where the new playlist name ends up being longer than 100 chars
     if len(new_playlist_name) > 100:
@@ -147,28 +256,7 @@ def create_new_playlist(user, sp, playlist_id, sorted_track_uris_list):
             if len(new_playlist_name) > 100:
                 new_playlist_name = playlist_name
 
-    # Create a new playlist
-    try: 
-        new_playlist_id = sp.user_playlist_create(
-            user, 
-            new_playlist_name, 
-            public=True, # TODO - public=request_json['make_public'] 
-            collaborative=False, 
-            description=new_playlist_desc
-        )['id']
-    except Exception as e:
-        print(f"Error creating the playlist: {e}")
-
-    # Add the tracks to the new playlist in batches of 100
-    max_size = 100
-    split_uris = [sorted_track_uris_list[i:i+max_size] for i in range(0, len(sorted_track_uris_list), max_size)]
-    for uris in split_uris:
-        try:
-            sp.playlist_add_items(new_playlist_id, uris)
-        except Exception as e:
-            print(f"Error adding items to playlist {new_playlist_id}: {e}")
-
-    return new_playlist_id
+    return new_playlist_name
 
 
 """
@@ -235,6 +323,28 @@ camelot_similarities = {
     "12B": ["12B","1B", "11B", "12A", "1A", "7B", "9A"]
 }
 
+# Integer-indexed form of camelot_similarities, written out so nothing has to be derived at import time.
+# check_startup.py verifies it still matches camelot_index_tables(camelot_similarities) and cw_map_string.
+# Camelot code per bucket index (0-23)
+camelot_codes = ('1A', '2A', '3A', '4A', '5A', '6A', '7A', '8A', '9A', '10A', '11A', '12A',
+                 '1B', '2B', '3B', '4B', '5B', '6B', '7B', '8B', '9B', '10B', '11B', '12B')
+camelot_index = {code: i for i, code in enumerate(camelot_codes)}
+
+# Bucket index per pitch class and mode, at position pcn * 2 + mode
+camelot_by_pitch = (4, 19, 11, 14, 6, 21, 1, 16, 8, 23, 3, 18, 10, 13, 5, 20, 0, 15, 7, 22, 2, 17, 9, 12)
+
+# Ranked similar buckets per bucket, in camelot_similarities priority order
+camelot_neighbour_ranks = (
+    (0, 1, 11, 12, 23, 7, 15), (1, 2, 0, 13, 12, 8, 16), (2, 3, 1, 14, 13, 9, 17),
+    (3, 4, 2, 15, 14, 10, 18), (4, 5, 3, 16, 15, 11, 19), (5, 6, 4, 17, 16, 0, 20),
+    (6, 7, 5, 18, 17, 1, 21), (7, 8, 6, 19, 18, 2, 22), (8, 9, 7, 20, 19, 3, 23),
+    (9, 10, 8, 21, 20, 4, 12), (10, 11, 9, 22, 21, 5, 13), (11, 0, 10, 23, 22, 6, 14),
+    (12, 13, 23, 0, 1, 19, 9), (13, 14, 12, 1, 2, 20, 10), (14, 15, 13, 2, 3, 21, 11),
+    (15, 16, 14, 3, 4, 22, 0), (16, 17, 15, 4, 5, 23, 1), (17, 18, 16, 5, 6, 12, 2),
+    (18, 19, 17, 6, 7, 13, 3), (19, 20, 18, 7, 8, 14, 4), (20, 21, 19, 8, 9, 15, 5),
+    (21, 22, 20, 9, 10, 16, 6), (22, 23, 21, 10, 11, 17, 7), (23, 12, 22, 11, 0, 18, 8),
+)
+
 # Create a dictionary that maps the Pitch Class notation (PCN) to its corresponding musical key.
 pitch_class_dict = {
     0: "C",
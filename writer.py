@@ -0,0 +1,290 @@
+import asyncio
+import html
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import Trace
+from utils import sorted_playlist_name
+
+# Spotify accepts at most 100 items per playlist_add_items call
+ADD_ITEMS_BATCH_SIZE = 100
+
+# Tries for one batch beyond what the HTTP layer already did, and the pause between them.  A later try
+# first checks whether an earlier one went in after all.
+MAX_BATCH_ATTEMPTS = 3
+BATCH_RETRY_SECONDS = 1
+
+
+def create_sorted_playlist(sp, playlist_name, playlist_desc, user=None, trace=None):
+    """
+    Creates the empty sorted copy of a playlist.
+
+    Args:
+        sp (spotipy.Spotify): An authenticated Spotipy client.
+        playlist_name (str): Name of the source playlist.
+        playlist_desc (str): Description of the source playlist.
+        user (str): ID of the current user, if already known.
+        trace (Trace): Trace to book the calls on, under 'create'.
+
+    Returns:
+        str: The ID of the new playlist.
+    """
+    trace = trace or Trace('write')
+
+    # Get the current user id (inherited from access token)
+    if user is None:
+        current_user = trace.timed('create', sp.current_user)
+        user = current_user()['id']
+        print(f"User is {user}")
+
+    user_playlist_create = trace.timed('create', sp.user_playlist_create)
+    return user_playlist_create(
+        user,
+        sorted_playlist_name(playlist_name),
+        public=True, # TODO - public=request_json['make_public']
+        collaborative=False,
+        description=html.unescape(playlist_desc or '')
+    )['id']
+
+
+def batch_landed(playlist, position, uris):
+    """
+    Returns:
+        str: The playlist's snapshot_id if it already holds the batch at position, e.g. because a try
+        whose response got lost went in, otherwise None.
+    """
+    if playlist['tracks']['total'] >= position + len(uris):
+        return playlist['snapshot_id']
+    return None
+
+
+def add_batch(sp, playlist_id, uris, position, trace):
+    """
+    Adds one batch at its position, trying up to MAX_BATCH_ATTEMPTS times.
+
+    Args:
+        sp (spotipy.Spotify): An authenticated Spotipy client.
+        playlist_id (str): The ID of the playlist to add to.
+        uris (list): Track URIs of the batch.
+        position (int): Where the batch goes, i.e. the number of tracks already in.
+        trace (Trace): Trace to book the calls on, under 'add_items'.
+
+    Returns:
+        str: The playlist's snapshot_id after the batch.
+    """
+    get_playlist = trace.timed('add_items', sp.playlist)
+    add_items = trace.timed('add_items', sp.playlist_add_items)
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        try:
+            if attempt:
+                snapshot_id = batch_landed(get_playlist(playlist_id, fields='snapshot_id,tracks(total)'),
+                                           position, uris)
+                if snapshot_id is not None:
+                    return snapshot_id
+            return add_items(playlist_id, uris, position=position)['snapshot_id']
+        except Exception as e:
+            if attempt == MAX_BATCH_ATTEMPTS - 1:
+                raise
+            print(f"Error adding items to playlist {playlist_id} at {position}, trying again: {e}")
+            time.sleep(BATCH_RETRY_SECONDS)
+
+
+def remove_playlist(sp, playlist_id):
+    """
+    Removes a sorted copy again, e.g. when the request failed or the source playlist turned out to have
+    no usable tracks.  Errors are printed rather than raised, since the request has failed already.
+
+    Args:
+        sp (spotipy.Spotify): An authenticated Spotipy client.
+        playlist_id (str): The ID of the new playlist.
+    """
+    try:
+        sp.current_user_unfollow_playlist(playlist_id)
+    except Exception as e:
+        print(f"Error removing the new playlist: {e}")
+
+
+class PlaylistWriter:
+    """
+    Creates the sorted copy of a playlist while the rest of the request is still running.
+
+    create() starts creating the target playlist in the background as soon as the source playlist's
+    name and description are known, so it overlaps the page and audio-feature fetch.  write() then
+    adds the ordered track URIs in batches of ADD_ITEMS_BATCH_SIZE, each at an explicit position, so a
+    retried batch always lands in its own slot.  A batch that still fails after add_batch()'s tries
+    stops the writing, leaving written short of the playlist rather than a gap in it.
+
+    The URIs are only written once the whole order is known.  No ordering's output is final as it is
+    produced: utils.limit_runs() merges the leftover of the last run back into gaps from the start of
+    the playlist, which it does for most camelot orders, and the local search moves tracks anywhere.
+    The ordering itself takes milliseconds next to the fetch, so writing earlier would gain little.
+    """
+
+    def __init__(self, sp, user=None, batch_size=ADD_ITEMS_BATCH_SIZE, trace=None):
+        """
+        Args:
+            sp (spotipy.Spotify): An authenticated Spotipy client.
+            user (str): ID of the current user, if already known; otherwise it's looked up when creating.
+            batch_size (int): Number of URIs per playlist_add_items call.
+            trace (Trace): Trace to book the create and add_items stages on.
+        """
+        self.sp = sp
+        self.user = user
+        self.batch_size = batch_size
+        self.trace = trace or Trace('write')
+        self.written = 0
+        self.snapshot_id = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._created = None
+
+    def create(self, playlist):
+        """
+        Starts creating the sorted copy of a playlist in the background.
+
+        Args:
+            playlist (dict): The source playlist object; only its name and description are used.
+        """
+        self._created = self._executor.submit(self._create, playlist['name'], playlist['description'])
+
+    def write(self, uris):
+        """
+        Adds the ordered URIs to the new playlist once it has been created.
+
+        Args:
+            uris (list): Track URIs in playlist order.
+
+        Returns:
+            str: The ID of the new playlist.
+        """
+        if self._created is None:
+            raise RuntimeError("PlaylistWriter.create() must be called before write()")
+        try:
+            new_playlist_id = self._created.result()
+        finally:
+            self._executor.shutdown(wait=False)
+
+        for start in range(0, len(uris), self.batch_size):
+            batch = uris[start:start+self.batch_size]
+            try:
+                # The position only advances once a batch is in, so retries never leave gaps
+                self.snapshot_id = add_batch(self.sp, new_playlist_id, batch, self.written, self.trace)
+            except Exception as e:
+                # Later batches would land in this one's slot, so stop here
+                print(f"Error adding items to playlist {new_playlist_id}, stopping at track {self.written}: {e}")
+                break
+            self.written += len(batch)
+            self.trace.add('add_items', tracks=len(batch))
+
+        return new_playlist_id
+
+    def abandon(self):
+        """
+        Removes the new playlist again, e.g. when the request failed or the source playlist turned out to
+        have no usable tracks.
+        """
+        if self._created is None:
+            return
+        try:
+            remove_playlist(self.sp, self._created.result())
+        except Exception as e:
+            print(f"Error removing the new playlist: {e}")
+        finally:
+            self._executor.shutdown(wait=False)
+
+    def _create(self, playlist_name, playlist_desc):
+        return create_sorted_playlist(self.sp, playlist_name, playlist_desc, self.user, self.trace)
+
+
+async def create_playlist_async(sp, playlist, user=None):
+    """
+    Creates the sorted copy of a playlist with an async_spotify.AsyncSpotify client.
+
+    Args:
+        sp (AsyncSpotify): An authenticated async client.
+        playlist (dict): The source playlist object; only its name and description are used.
+        user (str): ID of the current user, if already known.
+
+    Returns:
+        str: The ID of the new playlist.
+    """
+    if user is None:
+        user = (await sp.current_user())['id']
+        print(f"User is {user}")
+
+    new_playlist = await sp.user_playlist_create(
+        user,
+        sorted_playlist_name(playlist['name']),
+        public=True, # TODO - public=request_json['make_public']
+        collaborative=False,
+        description=html.unescape(playlist['description'] or '')
+    )
+    return new_playlist['id']
+
+
+async def remove_playlist_async(sp, created):
+    """
+    Removes the sorted copy again once create_playlist_async() is done with it, e.g. when the request
+    failed or the source playlist turned out to have no usable tracks.
+
+    Args:
+        sp (AsyncSpotify): An authenticated async client.
+        created (asyncio.Future): The create_playlist_async() task.
+    """
+    try:
+        await sp.current_user_unfollow_playlist(await created)
+    except Exception as e:
+        print(f"Error removing the new playlist: {e}")
+
+
+async def add_batch_async(sp, playlist_id, uris, position):
+    """
+    add_batch() for an AsyncSpotify client.
+
+    Returns:
+        str: The playlist's snapshot_id after the batch.
+    """
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        try:
+            if attempt:
+                playlist = await sp.playlist(playlist_id, fields='snapshot_id,tracks(total)', stage='add_items')
+                snapshot_id = batch_landed(playlist, position, uris)
+                if snapshot_id is not None:
+                    return snapshot_id
+            return (await sp.playlist_add_items(playlist_id, uris, position=position))['snapshot_id']
+        except Exception as e:
+            if attempt == MAX_BATCH_ATTEMPTS - 1:
+                raise
+            print(f"Error adding items to playlist {playlist_id} at {position}, trying again: {e}")
+            await asyncio.sleep(BATCH_RETRY_SECONDS)
+
+
+async def add_items_async(sp, playlist_id, uris, batch_size=ADD_ITEMS_BATCH_SIZE, trace=None):
+    """
+    Adds the ordered URIs to a playlist in batches, each at its explicit position.  Batches go one at a
+    time because a position is only valid once everything before it is in; the event loop serves other
+    invocations meanwhile.  Stops at the first batch that still fails after add_batch_async()'s tries,
+    so the playlist never has gaps.
+
+    Args:
+        sp (AsyncSpotify): An authenticated async client.
+        playlist_id (str): The ID of the playlist to add to.
+        uris (list): Track URIs in playlist order.
+        batch_size (int): Number of URIs per playlist_add_items call.
+        trace (Trace): Trace to count the added tracks on.
+
+    Returns:
+        tuple: (written, snapshot_id) of the tracks that made it in.
+    """
+    written = 0
+    snapshot_id = None
+    for i in range(0, len(uris), batch_size):
+        batch = uris[i:i+batch_size]
+        try:
+            snapshot_id = await add_batch_async(sp, playlist_id, batch, written)
+        except Exception as e:
+            print(f"Error adding items to playlist {playlist_id}: {e}")
+            break
+        written += len(batch)
+        if trace is not None:
+            trace.add('add_items', tracks=len(batch))
+    return written, snapshot_id